@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from waveform import Waveform
+
+ADC_GAIN = 2e-5
+
+
+def parse_mask(mask):
+    """
+    Converts a channel mask like 0110 to the DAQ's list of 4 booleans
+    """
+    return [flag == "1" for flag in mask]
+
+
+def synthetic_codes(rng, record_length):
+    """
+    Baseline noise with a negative pulse, as 8 bit ADC codes in 16 bit words
+    """
+    samples = rng.normal(0, 2, record_length)
+    peak = rng.integers(record_length // 4, 3 * record_length // 4)
+    samples -= 100 * np.exp(-0.5 * ((np.arange(record_length) - peak) / 5.) ** 2)
+    return (np.clip(np.rint(samples), -128, 127) * 256).astype(np.int16)
+
+
+def synthetic_event(rng, channels, record_length):
+    return [Waveform(codes=synthetic_codes(rng, record_length), gain=ADC_GAIN, dt=5e-11) if active else None
+            for active in channels]
+
+
+def synthetic_inspect_reply(rng, channels, record_length):
+    """
+    Formats an event the way INSPECT? SIMPLE returns it
+    """
+    reply = ""
+    for channel_idx, active in enumerate(channels):
+        if not active:
+            continue
+        volts = synthetic_codes(rng, record_length) * ADC_GAIN
+        reply += 'C{}:INSP "\r\n'.format(channel_idx + 1)
+        for idx in range(0, record_length, 8):
+            reply += "  " + "  ".join("{:.4e}".format(volt) for volt in volts[idx:idx + 8]) + " \r\n"
+        reply += '"\n'
+    return reply
+
+
+def recorded_events(directory, num_events):
+    """
+    Reads the first events of the first sweep point of a real run
+    :param directory: run directory of DAQ output
+    :param num_events: events wanted
+    :return: tuple (events, channels)
+    """
+    from reader import RunCatalog
+
+    catalog = RunCatalog(directory)
+    if not catalog.points:
+        raise ValueError("No sweep points found in {}".format(directory))
+    point = catalog.points[0]
+    channels = [channel_number in point.channels for channel_number in range(1, max(point.channels) + 1)]
+    channels += [False] * (-len(channels) % 4)
+    chunk = next(point.iterate(chunk_events=num_events))
+    events = []
+    for event_idx in range(len(chunk["w{}".format(point.channels[0])])):
+        event = [None] * len(channels)
+        for channel_number in point.channels:
+            times = chunk["t{}".format(channel_number)][event_idx]
+            volts = chunk["w{}".format(channel_number)][event_idx]
+            event[channel_number - 1] = Waveform(volts, dt=float(times[1] - times[0]), horiz_offset=float(times[0]))
+        events.append(event)
+    return events, channels
+
+
+def output_size(path):
+    """
+    Bytes on disk of a writer output, a file or an npy directory
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def write_synthetic_dump(filename, rng, channels, record_length, num_events):
+    """
+    Writes a text dump in the format converter.py reads
+    """
+    with open(filename, "w") as dump_file:
+        for _ in range(num_events):
+            for channel_idx, active in enumerate(channels):
+                if not active:
+                    continue
+                dump_file.write("CHANNEL:{}\nDT:5e-11\n".format(channel_idx + 1))
+                volts = synthetic_codes(rng, record_length) * ADC_GAIN
+                dump_file.writelines("{},{}\n".format(idx * 5e-11, volt) for idx, volt in enumerate(volts))
+            dump_file.write("\n")
+
+
+def measure(name, run, num_events, num_bytes, repeat, **params):
+    """
+    Times a benchmark body and records its peak memory
+    :param name: benchmark name
+    :param run: callable doing one round of work
+    :param num_events: events handled per round
+    :param num_bytes: bytes handled per round
+    :param repeat: number of timed rounds, the fastest is reported
+    :param params: parameters recorded with the result
+    :return: result dict
+    """
+    run()
+    best = float("inf")
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - time_start)
+
+    tracemalloc.start()
+    run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "name": name,
+        "params": params,
+        "seconds": best,
+        "events_per_s": num_events / best,
+        "mb_per_s": num_bytes / best / 1e6,
+        "peak_memory_mb": peak_memory / 1e6,
+    }
+    print("{:<10} {:<50} {:>10.1f} events/s {:>8.1f} MB/s {:>8.1f} MB peak".format(
+        name, " ".join("{}={}".format(key, value) for key, value in sorted(params.items())),
+        result["events_per_s"], result["mb_per_s"], result["peak_memory_mb"]))
+    return result
+
+
+def bench_parse(args, rng):
+    from thorium import DaqRunner
+
+    # Only the parser is needed, so skip the acquisition in __init__
+    runner = DaqRunner.__new__(DaqRunner)
+    runner.dt = 5e-11
+
+    replies = []
+    for record_length in args.record_lengths:
+        for mask in args.masks:
+            reply = synthetic_inspect_reply(rng, parse_mask(mask), record_length)
+            replies.append(({"source": "synthetic", "record_length": record_length, "mask": mask}, reply))
+    for filename in args.recorded:
+        with open(filename) as reply_file:
+            replies.append(({"source": os.path.basename(filename)}, reply_file.read()))
+
+    results = []
+    for params, reply in replies:
+        results.append(measure("parse", lambda: runner.convert_to_vector(reply), 1, len(reply),
+                               args.repeat * 10, **params))
+    return results
+
+
+def bench_write(args, rng, work_dir):
+    from writer import WRITER_BACKENDS, open_writer
+
+    inputs = []
+    for record_length in args.record_lengths:
+        for mask in args.masks:
+            channels = parse_mask(mask)
+            inputs.append(({"record_length": record_length, "mask": mask}, channels,
+                           [synthetic_event(rng, channels, record_length) for _ in range(args.events)]))
+    if args.waveforms:
+        events, channels = recorded_events(args.waveforms, args.events)
+        inputs.append(({"source": os.path.basename(os.path.normpath(args.waveforms))}, channels, events))
+
+    results = []
+    for backend in args.backends:
+        for compression in args.compressions:
+            algorithm, _, level = compression.partition(":")
+            output_options = {}
+            if algorithm != "default":
+                output_options = {"compression": algorithm, "compression_level": int(level) if level else None}
+            if backend == "npy" and algorithm not in ("default", "none"):
+                continue
+            for params, channels, events in inputs:
+                base_filename = os.path.join(work_dir, "bench_write")
+
+                def run():
+                    writer = open_writer(backend, base_filename, channels, **output_options)
+                    for event in events:
+                        writer.fill(event)
+                    writer.close()
+
+                # Relative to the samples as float64, the way the DAQ holds them
+                num_bytes = sum(len(wfm) * 8 for event in events for wfm in event if wfm is not None)
+                result = measure("dump_data", run, len(events), num_bytes, args.repeat,
+                                 backend=backend, compression=compression, **params)
+                result["compression_ratio"] = num_bytes / output_size(base_filename + WRITER_BACKENDS[backend][1])
+                print("{:<10} {:<50} {:>10.2f}x compression".format("", "", result["compression_ratio"]))
+                results.append(result)
+    return results
+
+
+def bench_converter(args, rng, work_dir):
+    from converter import convert_file
+
+    results = []
+    for record_length in args.record_lengths:
+        for mask in args.masks:
+            dump_filename = os.path.join(work_dir, "bench_dump.txt")
+            write_synthetic_dump(dump_filename, rng, parse_mask(mask), record_length, args.events)
+            for backend in args.backends:
+                results.append(measure("converter", lambda: convert_file(dump_filename, work_dir, backend),
+                                       args.events, os.path.getsize(dump_filename), args.repeat,
+                                       backend=backend, record_length=record_length, mask=mask))
+    return results
+
+
+def compare(results, baseline_filename):
+    """
+    Prints the speedup of each benchmark relative to a saved run
+    """
+    with open(baseline_filename) as baseline_file:
+        baseline = {(result["name"], json.dumps(result["params"], sort_keys=True)): result
+                    for result in json.load(baseline_file)["results"]}
+    print("\nRelative to {}".format(baseline_filename))
+    for result in results:
+        old = baseline.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old is None:
+            continue
+        # Benchmarks that allocate nothing traced have no peak memory to compare
+        memory_ratio = "{:>6.2f}x".format(result["peak_memory_mb"] / old["peak_memory_mb"]) \
+            if old["peak_memory_mb"] else "{:>7}".format("n/a")
+        print("{:<10} {:<50} {:>6.2f}x events/s {} peak memory".format(
+            result["name"], " ".join("{}={}".format(key, value) for key, value in sorted(result["params"].items())),
+            result["events_per_s"] / old["events_per_s"], memory_ratio))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the parse, convert and write hot paths")
+    parser.add_argument("--events", type=int, default=200, help="Events per write/convert round")
+    parser.add_argument("--record-lengths", default="1002,10002", help="Comma separated samples per record")
+    parser.add_argument("--masks", default="0100,0110,1111", help="Comma separated channel masks, ch1 first")
+    parser.add_argument("--backends", default="root,npy", help="Comma separated writer backends")
+    parser.add_argument("--compressions", default="default",
+                        help="Comma separated write compressions like lz4:4,zstd:9,none, default for the backend's")
+    parser.add_argument("--waveforms", help="Run directory whose first point's events are also written")
+    parser.add_argument("--recorded", nargs="*", default=[], help="Files holding raw INSPECT? replies")
+    parser.add_argument("--suites", default="parse,write,converter", help="Comma separated suites to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed rounds per benchmark, fastest is kept")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="Earlier JSON output to compare against")
+    args = parser.parse_args()
+    args.record_lengths = [int(length) for length in args.record_lengths.split(",")]
+    args.masks = args.masks.split(",")
+    args.backends = args.backends.split(",")
+    args.compressions = args.compressions.split(",")
+
+    rng = np.random.default_rng(0)
+    work_dir = tempfile.mkdtemp(prefix="thorium_bench_")
+    suites = {
+        "parse": lambda: bench_parse(args, rng),
+        "write": lambda: bench_write(args, rng, work_dir),
+        "converter": lambda: bench_converter(args, rng, work_dir),
+    }
+
+    results = []
+    skipped = {}
+    try:
+        for suite in args.suites.split(","):
+            try:
+                results.extend(suites[suite]())
+            except ImportError as error:
+                print("Skipping {} benchmarks: {}".format(suite, error))
+                skipped[suite] = str(error)
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as output_file:
+        json.dump({
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "skipped": skipped,
+            "results": results,
+        }, output_file, indent=2)
+    print("Results saved to {}".format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
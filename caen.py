@@ -3,6 +3,16 @@ __email__ = "therickyross2@gmail.com"
 __project__ = "Thorium DAQ"
 
 import socket
+import threading
+import time
+
+from settings import SettingsCache
+
+STATUS_BITS = ["ON", "RAMP UP", "RAMP DOWN", "IMON>=ISET", "VMON>VSET+2.5V",
+               "VMON<VSET–2.5V", "VOUT in MAXV protection", "Ch OFF via TRIP (Imon>=Iset during TRIP)",
+               "Output Power > Max", "TEMP>105°C", "Ch disabled (REMOTE Mode and Switch on OFF position)",
+               "Ch in KILL via front panel", "Ch in INTERLOCK via front panel", "Calibration Error"
+               ]
 
 
 class Caen(object):
@@ -11,19 +21,25 @@ class Caen(object):
     """
     test_mode = False
 
-    def __init__(self, ip_address="", channel="2"):
+    def __init__(self, ip_address="", channel="2", timeout=10.):
         """
         Constructor for power supply object
-        :param ip_address: Ethernet address of supply
+        :param ip_address: Ethernet address of the CAEN server, optionally host:port
+        :param timeout: Socket timeout in s
         """
 
         self.caen_channel = channel
+        self.timeout = timeout
+        # Serializes exchanges when the DAQ and a monitor thread share the link
+        self.lock = threading.RLock()
+        # Settings are sent as one pipelined batch, every reply has to be OK
+        self.settings = SettingsCache(lambda commands: [self.check_return_status(response)
+                                                        for response in self.query_many(commands)])
 
         if ip_address:
-            # self.inst = ResourceManager().open_resource("TCPIP0::" + ip_address + "::inst0::INSTR")
-            self.caen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_address = (ip_address, 10000)
-            self.caen_sock.connect(server_address)
+            host, _, port = ip_address.partition(":")
+            self.server_address = (host, int(port or 10000))
+            self.connect()
 
             print(self.query("$BD:0,CMD:MON,PAR:BDNAME"))
             print(self.query("$BD:0,CMD:MON,PAR:BDFREL"))
@@ -32,11 +48,55 @@ class Caen(object):
             print("No ip address specified; Running in test mode.")
             self.test_mode = True
 
+    def connect(self):
+        """
+        Opens the connection to the CAEN server
+        :return: None
+        """
+        self.caen_sock = socket.create_connection(self.server_address, timeout=self.timeout)
+        self.caen_file = self.caen_sock.makefile("rb")
+
+    def reconnect(self):
+        """
+        Drops and reopens the connection after a link failure
+        :return: None
+        """
+        print("Lost connection to CAEN server, reconnecting")
+        self.close()
+        self.connect()
+
     def query(self, command):
-        payload = command.encode()
-        self.caen_sock.sendall(payload)
-        response = self.caen_sock.recv(2048)
-        return response.decode()
+        """
+        Sends one newline framed command and reads back its reply line
+        :param command: CAEN command string
+        :return: response string
+        """
+        return self.query_many([command])[0]
+
+    def query_many(self, commands):
+        """
+        Pipelines a batch of commands: all are sent in one write and the
+        replies, one line each, are collected in order
+        The batch is resent once over a fresh connection if the link drops
+        :param commands: list of CAEN command strings
+        :return: list of response strings
+        """
+        payload = "".join(command + "\n" for command in commands).encode()
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    self.caen_sock.sendall(payload)
+                    return [self.read_line() for _ in commands]
+                except (OSError, ConnectionError):
+                    if attempt:
+                        raise
+                    self.reconnect()
+
+    def read_line(self):
+        line = self.caen_file.readline()
+        if not line.endswith(b"\n"):
+            raise ConnectionError("CAEN server closed the connection")
+        return line.decode()
 
     def check_return_status(self, return_status=""):
         """
@@ -65,8 +125,10 @@ class Caen(object):
         if self.test_mode:
             return "TEST MODE: " + command_format
 
-        response = self.query(command_format)
-        return self.check_return_status(response)
+        with self.lock:
+            self.settings.set("CH{}:ISET".format(channel), float(compliance), command_format, invalidates=())
+            self.settings.flush()
+        return True
 
     def set_output(self, channel, voltage):
         """
@@ -82,10 +144,12 @@ class Caen(object):
         if self.test_mode:
             return "TEST MODE: " + command_format
 
-        # Send query to device
-        response = self.query(command_format)
-        # Verify command was executed successfully
-        return self.check_return_status(response)
+        # Skipped if the channel is already set there, but a ramp down is always sent
+        with self.lock:
+            self.settings.set("CH{}:VSET".format(channel), float(voltage), command_format, invalidates=(),
+                              force=float(voltage) == 0.)
+            self.settings.flush()
+        return True
 
     def enable_output(self, channel, enable=True):
         """
@@ -100,6 +164,7 @@ class Caen(object):
         if self.test_mode:
             return "TEST MODE: " + command_format
 
+        # Not cached, a trip or interlock turns the channel off behind our back
         response = self.query(command_format)
         return self.check_return_status(response)
 
@@ -111,18 +176,20 @@ class Caen(object):
         Checks status of channel
         :return:
         """
-        status_bits = ["ON", "RAMP UP", "RAMP DOWN", "IMON>=ISET", "VMON>VSET+2.5V",
-                       "VMON<VSET–2.5V", "VOUT in MAXV protection", "Ch OFF via TRIP (Imon>=Iset during TRIP)",
-                       "Output Power > Max", "TEMP>105°C", "Ch disabled (REMOTE Mode and Switch on OFF position)",
-                       "Ch in KILL via front panel", "Ch in INTERLOCK via front panel", "Calibration Error"
-                       ]
-        command_format = "$BD:0,CMD:MON,CH:{},PAR:STAT".format(self.caen_channel)
-        response = int(self.get_response_value(self.query(command_format)))
+        command_format = "$BD:0,CMD:MON,CH:{},PAR:STAT".format(step_channel)
+        return self.decode_status(int(self.get_response_value(self.query(command_format))))
+
+    def decode_status(self, response):
+        """
+        Converts a STAT register value to its list of flags
+        :param response: STAT value
+        :return: list of status strings
+        """
         status = []
         counter = 0
         while response != 0:
             if response & 0x1:
-                status.append(status_bits[counter])
+                status.append(STATUS_BITS[counter])
             response = response >> 1
             counter += 1
 
@@ -136,17 +203,89 @@ class Caen(object):
         command_format = "$BD:0,CMD:MON,CH:{},PAR:IMON".format(self.caen_channel)
         return float(self.get_response_value(self.query(command_format))) * 1e-6
 
+    def read_voltage(self, channel):
+        """
+        Reads the output voltage of a channel
+        :param channel: Channel number [0-3]
+        :return: float voltage in V
+        """
+        command_format = "$BD:0,CMD:MON,CH:{},PAR:VMON".format(channel)
+        return float(self.get_response_value(self.query(command_format)))
+
+    def get_ramp_rate(self, channel, ramp_up=True):
+        """
+        Reads the ramp rate setting of a channel
+        :param channel: Channel number [0-3]
+        :param ramp_up: True for RUP, False for RDW
+        :return: float ramp rate in V/s, cached until a setting changes
+        """
+        command_format = "$BD:0,CMD:MON,CH:{},PAR:{}".format(channel, "RUP" if ramp_up else "RDW")
+        with self.lock:
+            return self.settings.read("CH{}:{}".format(channel, "RUP" if ramp_up else "RDW"),
+                                      lambda: float(self.get_response_value(self.query(command_format))))
+
+    def wait_for_ramp(self, channel, start_voltage, target_voltage, poll_interval=0.5, tolerance=2.5):
+        """
+        Waits for a channel to reach its set voltage, polling at a fixed pace
+        The timeout is estimated from the channel ramp rate
+        :param channel: Channel number [0-3]
+        :param start_voltage: Voltage before the ramp in V
+        :param target_voltage: Set voltage in V
+        :param poll_interval: Time between status polls in s
+        :param tolerance: Allowed |VMON - VSET| in V, matches the supply status bits
+        :return: True if the ramp finished before the timeout
+        """
+        if self.test_mode:
+            return True
+
+        delta = float(target_voltage) - float(start_voltage)
+        ramp_rate = self.get_ramp_rate(channel, abs(float(target_voltage)) >= abs(float(start_voltage)))
+        # Allow 50% on top of the nominal ramp time plus a fixed settling margin
+        timeout = 1.5 * abs(delta) / max(ramp_rate, 1.) + 10.
+        deadline = time.time() + timeout
+
+        while time.time() < deadline:
+            time.sleep(poll_interval)
+            readings = self.monitor(channel)
+            if "RAMP UP" in readings["status"] or "RAMP DOWN" in readings["status"]:
+                continue
+            if abs(readings["vmon"] - float(target_voltage)) <= tolerance:
+                return True
+
+        print("Channel {} did not reach {} V within {:.0f} s".format(channel, target_voltage, timeout))
+        return False
+
+    def monitor(self, channel=None):
+        """
+        Reads VMON, IMON, STAT and BDALARM of a channel in one round trip
+        :param channel: Channel number [0-3], defaults to the stepped channel
+        :return: dict with vmon in V, imon in A, status flags and alarm
+        """
+        channel = self.caen_channel if channel is None else channel
+        vmon, imon, stat, alarm = [self.get_response_value(response) for response in self.query_many([
+            "$BD:0,CMD:MON,CH:{},PAR:VMON".format(channel),
+            "$BD:0,CMD:MON,CH:{},PAR:IMON".format(channel),
+            "$BD:0,CMD:MON,CH:{},PAR:STAT".format(channel),
+            "$BD:0,CMD:MON,PAR:BDALARM",
+        ])]
+        return {
+            "vmon": float(vmon),
+            "imon": float(imon) * 1e-6,
+            "status": self.decode_status(int(stat)),
+            "alarm": bool(int(alarm) & (1 << int(channel))),
+        }
+
     def overcurrent(self):
         """
         Checks device for errors, but mainly looking for IMON>ISET
         :return: True if device checks out
         """
         response = int(self.get_response_value(self.query("$BD:0,CMD:MON,PAR:BDALARM")))
-        # TODO Logic for discerning bits
-        if int(self.caen_channel) & response:
+        # Bits 0-3 correspond to channels; if one of these bits is set then trigger alarm
+        if (1 << int(self.caen_channel)) & response:
             return True
         return False
-        # Bits 0-3 correspond to channels; if one of these bits is set then trigger alarm
 
     def close(self):
+        self.caen_file.close()
         self.caen_sock.close()
@@ -1,131 +1,168 @@
+import argparse
+import glob
+import os
 import sys
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import ROOT
+import numpy as np
 
+from waveform import Waveform
+from writer import open_writer
 
-def dump_data(output_filename, current_trigger, current_voltage, list_events, channels):
+
+def parse_record(sample_lines):
     """
-    Writes data to file as a vectorized representation of the
-    events->channels->voltage readings
-    :return: None
+    Converts the "time,volt" lines of one channel record in a single call
+    :param sample_lines: list of raw text lines
+    :return: Waveform
     """
-
-    tree_file = ROOT.TFile(
-        "new_{}_{}_trig_{}V.root".format(
-            output_filename,
-            current_trigger,
-            current_voltage),
-        "recreate"
-    )
-
-    tree = ROOT.TTree("wfm", "tree with events/wfms")
-
-    vector_voltage_1 = ROOT.vector("double")()
-    vector_time_1 = ROOT.vector("double")()
-    vector_voltage_2 = ROOT.vector("double")()
-    vector_time_2 = ROOT.vector("double")()
-    vector_voltage_3 = ROOT.vector("double")()
-    vector_time_3 = ROOT.vector("double")()
-    vector_voltage_4 = ROOT.vector("double")()
-    vector_time_4 = ROOT.vector("double")()
-
-    if channels[0]:
-        tree.Branch("w1", vector_voltage_1)
-        tree.Branch("t1", vector_time_1)
-    if channels[1]:
-        tree.Branch("w2", vector_voltage_2)
-        tree.Branch("t2", vector_time_2)
-    if channels[2]:
-        tree.Branch("w3", vector_voltage_3)
-        tree.Branch("t3", vector_time_3)
-    if channels[3]:
-        tree.Branch("w4", vector_voltage_4)
-        tree.Branch("t4", vector_time_4)
-
-    for event in list_events:
-        if event[0]:
-            for data in event[0]:
-                vector_time_1.push_back(data[0])
-                vector_voltage_1.push_back(data[1])
-        if event[1]:
-            for data in event[1]:
-                vector_time_2.push_back(data[0])
-                vector_voltage_2.push_back(data[1])
-        if event[2]:
-            for data in event[2]:
-                vector_time_3.push_back(data[0])
-                vector_voltage_3.push_back(data[1])
-        if event[3]:
-            for data in event[3]:
-                vector_time_4.push_back(data[0])
-                vector_voltage_4.push_back(data[1])
-
-        tree.Fill()
-        vector_time_1.clear()
-        vector_time_2.clear()
-        vector_time_3.clear()
-        vector_time_4.clear()
-        vector_voltage_1.clear()
-        vector_voltage_2.clear()
-        vector_voltage_3.clear()
-        vector_voltage_4.clear()
-
-    tree_file.Write()
-    tree_file.Close()
+    samples = np.fromstring("".join(sample_lines).replace(",", " "), sep=" ").reshape(-1, 2)
+    dt = samples[1, 0] - samples[0, 0] if len(samples) > 1 else 0.
+    return Waveform(samples[:, 1], dt=float(dt), horiz_offset=float(samples[0, 0]), times=samples[:, 0])
 
 
-if __name__ == "__main__":
-    events = []
-    channels = [False] * 4
+def read_events(input_filename):
+    """
+    Streams events out of a text dump, holding only one event in memory
+    A channel record runs from its CHANNEL:n header to the next header or
+    blank line, so the record length is taken from the data
+    :param input_filename: text dump written by the DAQ
+    :return: generator of events, each a list of 4 Waveforms
+    :raises ValueError: for samples ahead of the first CHANNEL:n header
+    """
     list_channels = [None] * 4
-    cur_channel = 0
-    counter = 0
-    appended = False
-    with open(sys.argv[1]) as input_file:
-        waveform = []
-        for line in input_file:
-            if "5.005" in line:
-                x = 0
-                pass
-            if counter == 1002:
-                list_channels[cur_channel] = deepcopy(waveform)
-                counter = 0
-                waveform = []
+    cur_channel = None
+    sample_lines = []
+
+    with open(input_filename) as input_file:
+        for line_number, line in enumerate(input_file, 1):
             if "DT" in line:
                 continue
-            if "CHANNEL:1" in line:
-                cur_channel = 0
-                channels[0] = True
-                appended = False
-                continue
-            if "CHANNEL:2" in line:
-                cur_channel = 1
-                channels[1] = True
-                appended = False
-                continue
-            if "CHANNEL:3" in line:
-                cur_channel = 2
-                channels[2] = True
-                appended = False
-                continue
-            if "CHANNEL:4" in line:
-                cur_channel = 3
-                channels[3] = True
-                appended = False
-                continue
             if "," in line:
-                waveform.append((float(line.split(",")[0]), float(line.split(",")[1])))
-                counter = counter + 1
-                appended = False
+                if cur_channel is None:
+                    raise ValueError("{}:{}: samples before any CHANNEL: header".format(input_filename, line_number))
+                sample_lines.append(line)
                 continue
 
-            if len(line) < 2 and not appended:
-                events.append(list_channels)
+            # Any other line closes the record being read
+            if sample_lines:
+                list_channels[cur_channel] = parse_record(sample_lines)
+                sample_lines = []
+
+            if "CHANNEL:" in line:
+                cur_channel = int(line.split("CHANNEL:")[1].strip()[0]) - 1
+            elif len(line) < 2 and any(wfm is not None for wfm in list_channels):
+                yield list_channels
                 list_channels = [None] * 4
-                appended = True
+
+    if sample_lines:
+        list_channels[cur_channel] = parse_record(sample_lines)
+    if any(wfm is not None for wfm in list_channels):
+        yield list_channels
+
+
+def scan_channels(input_filename):
+    """
+    Finds every channel recorded in a text dump from its CHANNEL:n headers, without parsing samples
+    :param input_filename: text dump written by the DAQ
+    :return: list of 4 booleans, True for channels with at least one record
+    """
+    channels = [False] * 4
+    with open(input_filename) as input_file:
+        for line in input_file:
+            if "CHANNEL:" in line:
+                channels[int(line.split("CHANNEL:")[1].strip()[0]) - 1] = True
+    return channels
+
+
+def convert_file(input_filename, output_dir=None, backend="root", schema="compact", **output_options):
+    """
+    Converts one text dump, writing events as they are read
+    :param input_filename: text dump written by the DAQ
+    :param output_dir: directory for the output, next to the input if None
+    :param backend: output format, root, npy or hdf5
+    :param schema: ROOT tree layout, compact or legacy with t1..t4 time vectors
+    :param output_options: writer compression, compression_level, basket_size and auto_flush
+    :return: tuple (output name without extension, number of events)
+    """
+    stem = os.path.splitext(os.path.basename(input_filename))[0]
+    output_filename = os.path.join(output_dir or os.path.dirname(input_filename), "new_{}".format(stem))
+
+    events = read_events(input_filename)
+    first_event = next(events, None)
+    if first_event is None:
+        return output_filename, 0
+
+    # A channel missing from the first event may trigger later on
+    channels = scan_channels(input_filename)
+    record_length = max(len(wfm) for wfm in first_event if wfm is not None)
+    writer = open_writer(backend, output_filename, channels, record_length, schema=schema, **output_options)
+    try:
+        writer.fill(first_event)
+        num_events = 1
+        for event in events:
+            writer.fill(event)
+            num_events += 1
+    finally:
+        writer.close()
+
+    return output_filename, num_events
+
+
+def find_inputs(patterns):
+    """
+    Expands the command line inputs into a sorted list of dump files
+    :param patterns: files, directories or glob patterns
+    :return: list of filenames
+    """
+    input_filenames = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            input_filenames.update(glob.glob(os.path.join(pattern, "*.txt")))
+        else:
+            input_filenames.update(glob.glob(pattern))
+    return sorted(input_filenames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert DAQ text dumps to ROOT, npy or HDF5 files")
+    parser.add_argument("inputs", nargs="+", help="Text dumps, directories of dumps or glob patterns")
+    parser.add_argument("--outdir", help="Directory for the output files, defaults to next to each input")
+    parser.add_argument("--backend", default="root", choices=["root", "npy", "hdf5"],
+                        help="root for the wfm tree, npy or hdf5 for int16 codes with scale factors")
+    parser.add_argument("--schema", default="compact", choices=["compact", "legacy"],
+                        help="ROOT tree layout; legacy also stores the t1..t4 time vectors")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of files converted in parallel")
+    parser.add_argument("--compression", choices=["none", "zlib", "lzma", "lz4", "zstd"],
+                        help="Compression algorithm, defaults to the backend's; lzma or zstd 9 for archives")
+    parser.add_argument("--compression-level", type=int, help="Compression level 1-9")
+    parser.add_argument("--basket-size", type=int, help="ROOT branch buffer size in bytes")
+    args = parser.parse_args()
+    output_options = {"compression": args.compression, "compression_level": args.compression_level,
+                      "basket_size": args.basket_size}
+
+    input_filenames = find_inputs(args.inputs)
+    if not input_filenames:
+        print("No input files found")
+        sys.exit(1)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(convert_file, input_filename, args.outdir, args.backend, args.schema,
+                               **output_options): input_filename
+                   for input_filename in input_filenames}
+        failures = []
+        for future in as_completed(futures):
+            try:
+                output_filename, num_events = future.result()
+            except Exception as error:
+                # One bad dump should not cost the conversion of the others
+                failures.append((futures[future], error))
+                print("{} failed: {}".format(futures[future], error))
                 continue
-            else:
-                appended = False
-    print(len(events))
-    dump_data("_".join(sys.argv[1].split("_")[0:5]), "user", "200", events, channels)
+            print("{} -> {} ({} events)".format(futures[future], output_filename, num_events))
+
+    if failures:
+        print("{} of {} files failed:".format(len(failures), len(input_filenames)))
+        for input_filename, error in sorted(failures, key=lambda failure: failure[0]):
+            print("  {}: {}: {}".format(input_filename, type(error).__name__, error))
+        sys.exit(1)
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import argparse
+import configparser
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from queue import Queue
+
+from instruments import InstrumentPool
+from thorium import DaqRunner, load_config, queue_stop, signal_handler
+from writer import load_backend
+
+DAEMON_SOCKET = "/tmp/thorium_daq.sock"
+# Finished jobs kept for status requests
+MAX_FINISHED = 50
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one client request, a JSON line, with a JSON line
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            reply = self.server.daq_daemon.handle_request(request)
+        except (ValueError, KeyError, configparser.Error) as error:
+            reply = {"error": "{}: {}".format(type(error).__name__, error)}
+        self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class DaqDaemon(object):
+    """
+    Long lived DAQ process running queued sweep jobs one after the other
+    Scope and CAEN sessions stay open in an InstrumentPool and the writer
+    backend stays imported between jobs, so a job starts acquiring without
+    the connection and ROOT import delays of a fresh thorium.py. Jobs are
+    config files sent over a local Unix socket; a STOP, from Ctrl-C or the
+    HV monitor, ends the daemon rather than moving on to the next job
+    """
+
+    def __init__(self, socket_path=DAEMON_SOCKET, stop_queue=queue_stop):
+        """
+        Constructor for the daemon, starts listening for jobs
+        :param socket_path: path of the Unix socket clients connect to
+        :param stop_queue: Queue the runs poll for STOP requests
+        """
+        self.socket_path = socket_path
+        self.stop_queue = stop_queue
+        self.instruments = InstrumentPool()
+        self.job_queue = Queue()
+        self.jobs = []
+        self.num_submitted = 0
+        self.jobs_lock = threading.Lock()
+        self.running = None
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                raise RuntimeError("A DAQ daemon is already listening on {}".format(socket_path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a daemon that did not shut down cleanly
+                os.remove(socket_path)
+            finally:
+                probe.close()
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+        self.server.daemon_threads = True
+        self.server.daq_daemon = self
+        threading.Thread(target=self.server.serve_forever, name="JobServer", daemon=True).start()
+        print("Listening for DAQ jobs on {}".format(socket_path))
+
+    def warm_up(self, settings):
+        """
+        Connects the instruments and imports the writer backend of a config ahead of the first job
+        :param settings: load_config dict
+        :return: None
+        """
+        time_start = time.perf_counter()
+        for ip_address in [settings["scope_ip"]] + [ip_address for ip_address, _ in settings["extra_scopes"]]:
+            self.instruments.scope(ip_address)
+        if settings["using_caen"]:
+            self.instruments.caen(settings["caen_ip"], settings["caen_channel"])
+        load_backend(settings["backend"])
+        print("Instruments and {} backend ready in {:.1f} s".format(settings["backend"],
+                                                                   time.perf_counter() - time_start))
+
+    def handle_request(self, request):
+        """
+        Serves a client request, called from the socket server threads
+        :param request: dict with command submit (plus config text and outfile), status or shutdown
+        :return: reply dict
+        """
+        command = request.get("command", "submit")
+        if command == "submit":
+            config = configparser.RawConfigParser(allow_no_value=True)
+            config.read_string(request["config"])
+            settings = load_config(config)
+            with self.jobs_lock:
+                self.num_submitted += 1
+                job = {"id": self.num_submitted, "outfile": request["outfile"], "state": "queued"}
+                self.jobs.append(job)
+                position = self.job_queue.qsize() + (self.running is not None)
+            print("Queued job {} for {}".format(job["id"], job["outfile"]))
+            self.job_queue.put((job, settings))
+            return {"job": job["id"], "ahead": position}
+        if command == "status":
+            with self.jobs_lock:
+                return {"jobs": [dict(job) for job in self.jobs]}
+        if command == "shutdown":
+            self.job_queue.put(None)
+            return {"shutdown": True}
+        raise ValueError("Unknown command {}".format(command))
+
+    def run(self):
+        """
+        Runs queued jobs until shut down or stopped
+        :return: None
+        """
+        try:
+            while True:
+                item = self.job_queue.get()
+                if item is None:
+                    break
+                job, settings = item
+                if not self.stop_queue.empty():
+                    job["state"] = "cancelled"
+                    break
+                self.run_job(job, settings)
+                if not self.stop_queue.empty():
+                    print("DAQ stopped, not running further jobs")
+                    break
+        finally:
+            self.close()
+
+    def run_job(self, job, settings):
+        """
+        Runs one sweep on the pooled instruments
+        :param job: job dict, updated with its state and duration
+        :param settings: load_config dict of the job
+        :return: None
+        """
+        print("Starting job {} for {}".format(job["id"], job["outfile"]))
+        job["state"] = "running"
+        self.running = job
+        time_start = time.perf_counter()
+        try:
+            load_backend(settings["backend"])
+            DaqRunner(output_filename=job["outfile"], stop_queue=self.stop_queue, instruments=self.instruments,
+                      **settings)
+            job["state"] = "done"
+        except Exception as error:
+            # A failed job ends its run but not the daemon, its sweep already ramped the HV down
+            traceback.print_exc()
+            job["state"] = "failed"
+            job["error"] = "{}: {}".format(type(error).__name__, error)
+        job["seconds"] = time.perf_counter() - time_start
+        self.running = None
+        with self.jobs_lock:
+            finished = [old_job for old_job in self.jobs if old_job["state"] in ("done", "failed")]
+            for old_job in finished[:-MAX_FINISHED]:
+                self.jobs.remove(old_job)
+        print("Job {} {} after {:.1f} s".format(job["id"], job["state"], job["seconds"]))
+
+    def close(self):
+        """
+        Stops listening and closes the instrument sessions
+        :return: None
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        with self.jobs_lock:
+            for job in self.jobs:
+                if job["state"] == "queued":
+                    job["state"] = "cancelled"
+        self.instruments.close()
+
+
+def send_request(request, socket_path=DAEMON_SOCKET, timeout=10.):
+    """
+    Sends one request to a running daemon
+    :param request: request dict, see DaqDaemon.handle_request
+    :param socket_path: path of the daemon's Unix socket
+    :param timeout: reply timeout in s
+    :return: reply dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode())
+        with client.makefile("rb") as reply_file:
+            return json.loads(reply_file.readline().decode())
+
+
+def submit_job(config_filename, outfile, socket_path=DAEMON_SOCKET):
+    """
+    Queues a sweep on a running daemon
+    The config is sent as text, so it can be edited once submitted
+    :param config_filename: DAQ config file
+    :param outfile: output filename, relative to the current directory
+    :param socket_path: path of the daemon's Unix socket
+    :return: reply dict, with the job number or an error
+    """
+    with open(config_filename) as config_file:
+        config_text = config_file.read()
+    return send_request({"command": "submit", "config": config_text, "outfile": os.path.abspath(outfile)},
+                        socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs DAQ sweeps queued over a Unix socket on warm instruments")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help="Unix socket of the daemon")
+    parser.add_argument("--config", help="Start a daemon, connecting the instruments of this config up front")
+    parser.add_argument("--submit", metavar="CONFIG", help="Queue a sweep with this config on the running daemon")
+    parser.add_argument("--outfile", default="latest_daq", help="Output filename of a submitted sweep")
+    parser.add_argument("--status", action="store_true", help="List the jobs of the running daemon")
+    parser.add_argument("--shutdown", action="store_true", help="Stop the daemon once its queued jobs are done")
+    args = parser.parse_args()
+
+    if args.submit or args.status or args.shutdown:
+        if args.submit:
+            reply = submit_job(args.submit, args.outfile, args.socket)
+        else:
+            reply = send_request({"command": "status" if args.status else "shutdown"}, args.socket)
+        if "error" in reply:
+            print(reply["error"])
+            sys.exit(1)
+        if "jobs" in reply:
+            for job in reply["jobs"]:
+                print("{:>4d} {:<10} {:>8} {}".format(job["id"], job["state"], "{:.1f} s".format(job["seconds"])
+                                                      if "seconds" in job else "", job["outfile"]))
+        elif "job" in reply:
+            print("Queued job {}, {} ahead of it".format(reply["job"], reply["ahead"]))
+        else:
+            print("Daemon shutting down after its queued jobs")
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    daq_daemon = DaqDaemon(args.socket)
+    if args.config:
+        warm_config = configparser.RawConfigParser(allow_no_value=True)
+        warm_config.read_file(open(args.config))
+        daq_daemon.warm_up(load_config(warm_config))
+    daq_daemon.run()
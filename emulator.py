@@ -0,0 +1,521 @@
+#!/usr/bin/python3
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import argparse
+import socket
+import socketserver
+import threading
+import time
+from struct import pack, unpack
+
+import numpy as np
+
+from lecroy import VICP_EOI, VICP_DATA, VICP_PORT
+from waveform import encode_wavedesc
+
+SCOPE_IDN = "LECROY,WAVEPRO7200A,EMULATOR,1.0"
+CAEN_PORT = 10000
+
+
+def make_block(payload):
+    """
+    Wraps bytes in a #9 definite length block, as WF? replies are sent
+    """
+    return "#9{:09d}".format(len(payload)).encode() + payload + b"\n"
+
+
+class ScopeHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one VICP connection, answering each EOI terminated message in one reply
+    """
+
+    def handle(self):
+        emulator = self.server.emulator
+        message = b""
+        while True:
+            header = self.recv_exactly(8)
+            if header is None:
+                return
+            operation, _, sequence, _, length = unpack(">BBBBI", header)
+            message += self.recv_exactly(length) or b""
+            if not operation & VICP_EOI:
+                continue
+            reply = emulator.handle_message(message.decode())
+            message = b""
+            if reply:
+                self.request.sendall(pack(">BBBBI", VICP_DATA | VICP_EOI, 1, sequence, 0, len(reply)) + reply)
+
+    def recv_exactly(self, num_bytes):
+        data = b""
+        while len(data) < num_bytes:
+            chunk = self.request.recv(num_bytes - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class TriggerClock(object):
+    """
+    Trigger source shared by several scope emulators, like one trigger signal
+    fanned out to every scope. Trigger times are wall clock times with
+    exponential gaps, so a scope only sees the triggers after it was armed
+    """
+
+    def __init__(self, trigger_rate, seed=0):
+        """
+        Constructor for the trigger clock
+        :param trigger_rate: Mean trigger rate in Hz
+        :param seed: Random seed for the trigger gaps
+        """
+        if trigger_rate <= 0:
+            raise ValueError("A shared trigger clock needs a trigger rate")
+        self.trigger_rate = trigger_rate
+        self.rng = np.random.default_rng(seed)
+        self.times = np.array([time.time()])
+        self.lock = threading.Lock()
+
+    def next_triggers(self, num_triggers):
+        """
+        Triggers recorded by a scope armed now
+        :param num_triggers: number of segments to collect
+        :return: array of wall clock trigger times in s
+        """
+        now = time.time()
+        with self.lock:
+            # Triggers long past can no longer be seen by any scope
+            self.times = self.times[self.times >= now - 1.]
+            while not len(self.times) or self.times[-1] < now or \
+                    len(self.times) - np.searchsorted(self.times, now) < num_triggers:
+                last = self.times[-1] if len(self.times) else now
+                gaps = self.rng.exponential(1. / self.trigger_rate, max(num_triggers, 64))
+                self.times = np.append(self.times, last + np.cumsum(gaps))
+            idx = int(np.searchsorted(self.times, now))
+            return self.times[idx:idx + num_triggers]
+
+
+class ScopeEmulator(object):
+    """
+    Stand in for the LeCroy WavePro speaking VICP on a local port
+    Answers the ARM/WAIT, INSPECT?, WF? and sequence commands the DAQ sends with
+    synthetic pulses, at a configurable trigger rate and reply latency
+    """
+
+    def __init__(self, host="127.0.0.1", port=VICP_PORT, record_length=1002, dt=5e-11, trigger_rate=0.,
+                 latency=0., num_banks=16, seed=0, clock=None):
+        """
+        Constructor for the scope emulator
+        :param host: Address to listen on
+        :param port: VICP port, 0 for any free port
+        :param record_length: Samples per channel record
+        :param dt: Sample interval in s
+        :param trigger_rate: Mean trigger rate in Hz for WAIT, 0 to trigger immediately
+        :param latency: Extra delay in s before every reply
+        :param num_banks: Number of distinct precomputed acquisitions cycled through
+        :param seed: Random seed for the synthetic pulses
+        :param clock: TriggerClock shared with other emulators, replaces the trigger rate
+        """
+        self.record_length = record_length
+        self.dt = dt
+        self.trigger_rate = trigger_rate
+        self.latency = latency
+        self.gain = 2e-5
+        self.offset = 0.
+        self.horiz_offset = -record_length * dt / 2.
+        self.segments = 1
+        self.rng = np.random.default_rng(seed)
+        self.num_banks = num_banks
+        self.acquisition = 0
+        self.clock = clock
+        self.trigger_times = np.zeros(1)
+        self.trigger_stamp = time.time()
+        self.inspect_cache = {}
+        # Messages received, each one VICP transaction
+        self.num_messages = 0
+        self.lock = threading.Lock()
+        self.make_banks()
+
+        self.server = socketserver.ThreadingTCPServer((host, port), ScopeHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.emulator = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def make_banks(self):
+        """
+        Precomputes ADC codes of every channel so replies cost no more than a copy
+        Layout is (bank, channel, sample), one bank per segment of an acquisition
+        :return: None
+        """
+        num_records = self.num_banks * self.segments
+        samples = self.rng.normal(0, 2, (num_records, 4, self.record_length))
+        peaks = self.rng.integers(self.record_length // 4, 3 * self.record_length // 4, (num_records, 4, 1))
+        samples -= 100 * np.exp(-0.5 * ((np.arange(self.record_length) - peaks) / 5.) ** 2)
+        self.codes = (np.clip(np.rint(samples), -128, 127) * 256).astype("<i2")
+        self.inspect_cache = {}
+
+    def start(self):
+        """
+        Serves connections from a background thread
+        :return: None
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name="ScopeEmulator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_message(self, message):
+        """
+        Runs every command of a message and joins their replies
+        :param message: semicolon separated commands
+        :return: bytes of the reply, empty if no command returns data
+        """
+        replies = []
+        with self.lock:
+            self.num_messages += 1
+            for command in message.split(";"):
+                command = command.strip()
+                if command:
+                    reply = self.handle_command(command)
+                    if reply is not None:
+                        replies.append(reply)
+        if replies and self.latency:
+            time.sleep(self.latency)
+        return b"".join(replies)
+
+    def handle_command(self, command):
+        """
+        Executes one command
+        :param command: command without separators
+        :return: reply bytes, None for commands without a reply
+        """
+        upper = command.upper()
+        if upper == "*IDN?":
+            return SCOPE_IDN.encode()
+        if upper == "ARM":
+            self.acquisition = (self.acquisition + 1) % self.num_banks
+            return None
+        if upper == "WAIT":
+            self.wait_for_trigger()
+            return None
+        if upper.startswith("SEQUENCE"):
+            fields = upper.split(None, 1)[-1].split(",")
+            segments = int(fields[1]) if fields[0] == "ON" and len(fields) > 1 else 1
+            if segments != self.segments:
+                self.segments = segments
+                self.make_banks()
+            return None
+
+        channel, _, query = command.partition(":")
+        query = query.upper()
+        if not (len(channel) == 2 and channel[0].upper() == "C" and channel[1] in "1234"):
+            return None
+        channel_idx = int(channel[1]) - 1
+        if query.startswith("WF?"):
+            return self.waveform_block(channel_idx, query.split()[-1] if " " in query else "ALL")
+        if query.startswith("INSPECT?"):
+            return self.inspect(channel_idx, query.split()[-1].strip('"'))
+        return None
+
+    def wait_for_trigger(self):
+        """
+        Sleeps for the time the scope needs to collect every segment
+        Trigger gaps are exponential at the configured rate, or come from the shared clock
+        :return: None
+        """
+        now = time.time()
+        if self.clock is not None:
+            stamps = self.clock.next_triggers(self.segments)
+        elif not self.trigger_rate:
+            stamps = now + np.arange(self.segments, dtype=float) * 1e-6
+        else:
+            gaps = self.rng.exponential(1. / self.trigger_rate, self.segments)
+            stamps = now + np.cumsum(gaps)
+        time.sleep(max(stamps[-1] - now, 0.))
+        self.trigger_stamp = stamps[0]
+        self.trigger_times = stamps - stamps[0]
+
+    def current_codes(self, channel_idx):
+        start = self.acquisition * self.segments
+        return self.codes[start:start + self.segments, channel_idx]
+
+    def wavedesc(self, channel_idx, with_trigtime=False):
+        num_samples = self.segments * self.record_length
+        trigger_time = time.gmtime(self.trigger_stamp)
+        return encode_wavedesc(
+            trigtime_array=16 * self.segments if with_trigtime else 0,
+            wave_array_1=2 * num_samples,
+            wave_array_count=num_samples,
+            last_valid_pnt=num_samples - 1,
+            subarray_count=self.segments,
+            vertical_gain=self.gain,
+            vertical_offset=self.offset,
+            nominal_bits=8,
+            horiz_interval=self.dt,
+            horiz_offset=self.horiz_offset,
+            trigger_seconds=trigger_time.tm_sec + self.trigger_stamp % 1.,
+            trigger_minutes=trigger_time.tm_min,
+            trigger_hours=trigger_time.tm_hour,
+            trigger_days=trigger_time.tm_mday,
+            wave_source=channel_idx,
+        )
+
+    def waveform_block(self, channel_idx, block):
+        """
+        Builds a WF? reply
+        :param channel_idx: 0-3 channel index
+        :param block: DESC, DAT1 or ALL
+        :return: bytes of the #9 block
+        """
+        if block == "DESC":
+            return make_block(self.wavedesc(channel_idx))
+        data = self.current_codes(channel_idx).tobytes()
+        if block == "DAT1":
+            return make_block(data)
+        trigtime = np.column_stack((self.trigger_times, np.zeros(self.segments))).astype("<f8").tobytes()
+        return make_block(self.wavedesc(channel_idx, True) + trigtime + data)
+
+    def inspect(self, channel_idx, name):
+        """
+        Builds an INSPECT? reply, SIMPLE gives the voltages in the scope's text layout
+        :param channel_idx: 0-3 channel index
+        :param name: SIMPLE or a WAVEDESC variable name
+        :return: bytes of the reply
+        """
+        if name == "HORIZ_INTERVAL":
+            return 'C{}:INSP "HORIZ_INTERVAL    : {:.4e}          "\n'.format(channel_idx + 1, self.dt).encode()
+        if name == "HORIZ_OFFSET":
+            return 'C{}:INSP "HORIZ_OFFSET      : {:.4e}          "\n'.format(
+                channel_idx + 1, self.horiz_offset).encode()
+        if name != "SIMPLE":
+            return 'C{}:INSP "{}"\n'.format(channel_idx + 1, name).encode()
+
+        # Formatting text is far slower than serving it, so keep each reply around
+        key = (channel_idx, self.acquisition)
+        if key not in self.inspect_cache:
+            volts = self.current_codes(channel_idx)[0] * self.gain - self.offset
+            reply = 'C{}:INSP "\r\n'.format(channel_idx + 1)
+            for idx in range(0, len(volts), 8):
+                reply += "  " + "  ".join("{:.4e}".format(volt) for volt in volts[idx:idx + 8]) + " \r\n"
+            self.inspect_cache[key] = (reply + '"\n').encode()
+        return self.inspect_cache[key]
+
+
+class CaenChannel(object):
+    """
+    State of one emulated HV channel, VMON follows VSET at the ramp rates
+    """
+
+    def __init__(self, ramp_rate=50., leakage=1e-3, breakdown_voltage=None):
+        """
+        Constructor for an emulated channel
+        :param ramp_rate: RUP and RDW in V/s
+        :param leakage: Leakage current in uA per V
+        :param breakdown_voltage: |VMON| in V above which the current runs away, None for no breakdown
+        """
+        self.vset = 0.
+        self.vmon = 0.
+        self.iset = 100.
+        self.rup = ramp_rate
+        self.rdw = ramp_rate
+        self.on = False
+        self.tripped = False
+        self.leakage = leakage
+        self.breakdown_voltage = breakdown_voltage
+        self.last_update = time.monotonic()
+
+    def update(self):
+        """
+        Advances VMON to the current time and trips the channel on overcurrent
+        :return: None
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+
+        target = self.vset if self.on else 0.
+        rate = self.rup if abs(target) > abs(self.vmon) else self.rdw
+        step = rate * elapsed
+        if abs(target - self.vmon) <= step:
+            self.vmon = target
+        else:
+            self.vmon += step if target > self.vmon else -step
+
+        if self.on and self.imon >= self.iset:
+            self.on = False
+            self.tripped = True
+
+    @property
+    def imon(self):
+        """
+        Current in uA
+        """
+        current = self.leakage * abs(self.vmon)
+        if self.breakdown_voltage is not None and abs(self.vmon) > self.breakdown_voltage:
+            current *= np.exp((abs(self.vmon) - self.breakdown_voltage) / 2.)
+        return current
+
+    @property
+    def status(self):
+        target = self.vset if self.on else 0.
+        status = 0
+        if self.on:
+            status |= 1 << 0
+        if abs(target) > abs(self.vmon):
+            status |= 1 << 1
+        elif abs(target) < abs(self.vmon):
+            status |= 1 << 2
+        if self.imon >= self.iset:
+            status |= 1 << 3
+        if self.tripped:
+            status |= 1 << 7
+        return status
+
+
+class CaenHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one newline framed CAEN connection
+    """
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        # Replies to a pipelined batch go out line by line, don't let Nagle hold them back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.emulator.handle_command(line.decode().strip())
+            self.wfile.write((reply + "\n").encode())
+
+
+class CaenEmulator(object):
+    """
+    Stand in for the CAEN supply behind server.py, on a local TCP port
+    Channels ramp at RUP/RDW, draw a leakage current and report STAT and BDALARM
+    """
+
+    def __init__(self, host="127.0.0.1", port=CAEN_PORT, ramp_rate=50., leakage=1e-3, breakdown_voltage=None):
+        """
+        Constructor for the CAEN emulator
+        :param host: Address to listen on
+        :param port: TCP port, 0 for any free port
+        :param ramp_rate: Default RUP and RDW in V/s
+        :param leakage: Leakage current in uA per V
+        :param breakdown_voltage: |VMON| in V above which the current runs away, None for no breakdown
+        """
+        self.channels = [CaenChannel(ramp_rate, leakage, breakdown_voltage) for _ in range(4)]
+        self.lock = threading.Lock()
+
+        self.server = socketserver.ThreadingTCPServer((host, port), CaenHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.emulator = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="CaenEmulator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_command(self, command):
+        """
+        Executes one $BD:0,CMD:...,CH:...,PAR:...,VAL:... command
+        :param command: command string
+        :return: reply string without the newline
+        """
+        fields = {}
+        for field in command.lstrip("$").split(","):
+            key, _, value = field.partition(":")
+            fields[key.strip().upper()] = value.strip()
+
+        with self.lock:
+            for channel in self.channels:
+                channel.update()
+            try:
+                if fields.get("CMD") == "MON":
+                    return "#BD:00,CMD:OK,VAL:{}".format(self.monitor(fields))
+                if fields.get("CMD") == "SET":
+                    self.set(fields)
+                    return "#BD:00,CMD:OK"
+            except (KeyError, IndexError, ValueError):
+                pass
+        return "#BD:00,CMD:ERR"
+
+    def monitor(self, fields):
+        parameter = fields["PAR"]
+        if parameter == "BDNAME":
+            return "N1471"
+        if parameter == "BDFREL":
+            return "EMULATOR"
+        if parameter == "BDSNUM":
+            return "0"
+        if parameter == "BDALARM":
+            return sum(1 << idx for idx, channel in enumerate(self.channels) if channel.tripped)
+
+        channel = self.channels[int(fields["CH"])]
+        if parameter == "VMON":
+            return "{:.1f}".format(channel.vmon)
+        if parameter == "IMON":
+            return "{:.4f}".format(channel.imon)
+        if parameter == "STAT":
+            return channel.status
+        return {"VSET": channel.vset, "ISET": channel.iset, "RUP": channel.rup, "RDW": channel.rdw}[parameter]
+
+    def set(self, fields):
+        channel = self.channels[int(fields["CH"])]
+        parameter = fields["PAR"]
+        if parameter == "ON":
+            channel.on = True
+            channel.tripped = False
+        elif parameter == "OFF":
+            channel.on = False
+        elif parameter in ("VSET", "ISET", "RUP", "RDW"):
+            setattr(channel, parameter.lower(), float(fields["VAL"]))
+        else:
+            raise KeyError(parameter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local LeCroy and CAEN emulators for offline DAQ runs")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--scope-port", type=int, default=VICP_PORT, help="VICP port of the scope emulator")
+    parser.add_argument("--scopes", type=int, default=1, help="Scope emulators sharing one trigger, on consecutive ports")
+    parser.add_argument("--caen-port", type=int, default=CAEN_PORT, help="TCP port of the CAEN emulator")
+    parser.add_argument("--record-length", type=int, default=1002, help="Samples per channel record")
+    parser.add_argument("--dt", type=float, default=5e-11, help="Sample interval in s")
+    parser.add_argument("--trigger-rate", type=float, default=0., help="Mean trigger rate in Hz, 0 for no wait")
+    parser.add_argument("--latency", type=float, default=0., help="Extra delay in s before every scope reply")
+    parser.add_argument("--ramp-rate", type=float, default=50., help="HV ramp rate in V/s")
+    parser.add_argument("--breakdown", type=float, help="|V| above which the HV current runs away")
+    args = parser.parse_args()
+
+    clock = TriggerClock(args.trigger_rate) if args.scopes > 1 else None
+    scopes = [ScopeEmulator(args.host, args.scope_port + scope_idx, args.record_length, args.dt, args.trigger_rate,
+                            args.latency, seed=scope_idx, clock=clock) for scope_idx in range(args.scopes)]
+    caen = CaenEmulator(args.host, args.caen_port, args.ramp_rate, breakdown_voltage=args.breakdown)
+    for scope in scopes:
+        scope.start()
+        print("Scope emulator on {}:{}".format(args.host, scope.port))
+    caen.start()
+    print("CAEN emulator on {}:{}".format(args.host, caen.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for scope in scopes:
+        scope.stop()
+    caen.stop()
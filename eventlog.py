@@ -0,0 +1,67 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import time
+
+import numpy as np
+
+# Per event metadata stored next to the waveforms, the trigger time and offset come with the records
+EVENT_DTYPE = np.dtype([("event", np.int64), ("host_time", np.float64), ("point", np.int32)])
+
+
+class EventLog(object):
+    """
+    Per event metadata of the current sweep point in one preallocated array
+    The array is sized for a point and reused by the next, so memory stays
+    flat over a sweep. Host times are monotonic; clock_offset converts them
+    to wall clock time
+    """
+
+    def __init__(self, capacity):
+        """
+        Constructor for the event log
+        :param capacity: events per point
+        """
+        self.rows = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.num_rows = 0
+        self.point = 0
+        self.clock_offset = time.time() - time.monotonic()
+
+    def start_point(self, point):
+        """
+        Starts logging a sweep point, dropping the rows of the last one
+        :param point: index of the sweep point
+        :return: None
+        """
+        self.point = point
+        self.num_rows = 0
+
+    def record(self, num_events=1, host_time=None):
+        """
+        Logs the events of one readout, all read back at the same time
+        :param num_events: events in the readout, the segments of a sequence
+        :param host_time: monotonic readout time in s, now if None
+        :return: index of the first logged event
+        """
+        start = self.num_rows
+        stop = start + num_events
+        if stop > len(self.rows):
+            self.rows = np.concatenate((self.rows, np.zeros(max(stop, 2 * len(self.rows)) - len(self.rows),
+                                                            dtype=EVENT_DTYPE)))
+        rows = self.rows[start:stop]
+        rows["event"] = np.arange(start, stop)
+        rows["host_time"] = time.monotonic() if host_time is None else host_time
+        rows["point"] = self.point
+        self.num_rows = stop
+        return start
+
+    def write_text(self, times_file):
+        """
+        Appends the point's host times to a text file, as EVENT:n,<wall clock time> lines
+        :param times_file: open file
+        :return: None
+        """
+        for event, host_time in zip(self.rows["event"][:self.num_rows].tolist(),
+                                    self.rows["host_time"][:self.num_rows].tolist()):
+            times_file.write("EVENT:{},{}\n".format(event, host_time + self.clock_offset))
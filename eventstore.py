@@ -0,0 +1,175 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+import tempfile
+
+import numpy as np
+
+from waveform import Waveform
+
+# Per record scalars needed to rebuild a Waveform around its stored samples
+RECORD_DTYPE = np.dtype([("length", np.int32), ("start_index", np.int32), ("dt", np.float64), ("gain", np.float64),
+                         ("offset", np.float64), ("horiz_offset", np.float64), ("trigger_time", np.float64),
+                         ("trigger_offset", np.float64), ("timestamp", np.float64)])
+
+
+class EventStore(object):
+    """
+    Holds the events of one sweep point in preallocated arrays, one per channel
+    Binary readouts are kept as int16 ADC codes, text readouts as volts. The
+    arrays are sized on the first event and reused by every following point,
+    so the acquisition loop allocates nothing per event. Above the memory
+    limit the arrays are memory mapped files instead
+    """
+
+    def __init__(self, channels, capacity, memory_limit=1 << 30, spill_dir=None):
+        """
+        Constructor for the event store
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param capacity: events per point
+        :param memory_limit: largest size in bytes of the sample arrays kept in memory
+        :param spill_dir: directory of the memory mapped files, the system temp directory if None
+        """
+        self.channels = channels
+        self.capacity = capacity
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.record_length = 0
+        self.samples = [None] * len(channels)
+        self.records = np.zeros((capacity, len(channels)), dtype=RECORD_DTYPE)
+        self.spill_files = []
+        self.num_events = 0
+
+    def __len__(self):
+        return self.num_events
+
+    def allocate(self, record_length, dtypes):
+        """
+        Sizes the sample arrays, copying the events stored so far
+        :param record_length: samples per record
+        :param dtypes: per channel sample dtype, None for inactive channels
+        :return: None
+        """
+        size = self.capacity * record_length * sum(np.dtype(dtype).itemsize for dtype in dtypes if dtype is not None)
+        spill = size > self.memory_limit
+        if spill:
+            print("Event store of {:.1f} MB over the memory limit, spilling to disk".format(size / 1e6))
+        old_samples = self.samples
+        old_files = self.spill_files
+        self.samples = [None] * len(self.channels)
+        self.spill_files = []
+        for channel_idx, dtype in enumerate(dtypes):
+            if dtype is None:
+                continue
+            shape = (self.capacity, record_length)
+            if spill:
+                spill_fd, spill_filename = tempfile.mkstemp(prefix="thorium_ch{}_".format(channel_idx + 1),
+                                                            suffix=".dat", dir=self.spill_dir)
+                os.close(spill_fd)
+                self.spill_files.append(spill_filename)
+                self.samples[channel_idx] = np.memmap(spill_filename, dtype=dtype, mode="w+", shape=shape)
+            else:
+                self.samples[channel_idx] = np.zeros(shape, dtype=dtype)
+            if old_samples[channel_idx] is not None and self.num_events:
+                self.samples[channel_idx][:self.num_events, :self.record_length] = \
+                    old_samples[channel_idx][:self.num_events]
+        self.record_length = record_length
+        old_samples = None
+        self.remove_spill_files(old_files)
+
+    def add(self, events):
+        """
+        Copies events into the next free rows
+        :param events: list of events, each a list of Waveforms, 4 per scope
+        :return: None
+        """
+        if self.num_events + len(events) > self.capacity:
+            self.capacity = max(self.num_events + len(events), 2 * self.capacity)
+            self.records = np.concatenate((self.records, np.zeros(
+                (self.capacity - len(self.records), len(self.channels)), dtype=RECORD_DTYPE)))
+            self.allocate(self.record_length, [None if samples is None else samples.dtype
+                                               for samples in self.samples])
+
+        longest = max([len(wfm) for event in events for wfm in event if wfm is not None] or [0])
+        if longest > self.record_length or any(
+                active and self.samples[channel_idx] is None and any(event[channel_idx] is not None for event in events)
+                for channel_idx, active in enumerate(self.channels)):
+            dtypes = []
+            for channel_idx, active_channel in enumerate(self.channels):
+                first = next((event[channel_idx] for event in events if event[channel_idx] is not None), None)
+                if self.samples[channel_idx] is not None:
+                    dtypes.append(self.samples[channel_idx].dtype)
+                elif active_channel and first is not None:
+                    dtypes.append(np.int16 if first.codes is not None else np.float64)
+                else:
+                    dtypes.append(None)
+            self.allocate(max(longest, self.record_length), dtypes)
+
+        for event in events:
+            records = self.records[self.num_events]
+            records["length"] = 0
+            for channel_idx, active_channel in enumerate(self.channels):
+                wfm = event[channel_idx] if active_channel else None
+                if wfm is None:
+                    continue
+                samples = self.samples[channel_idx]
+                if samples.dtype == np.int16:
+                    if wfm.codes is None:
+                        raise ValueError("Channel {} mixes code and voltage records".format(channel_idx + 1))
+                    samples[self.num_events, :len(wfm)] = wfm.codes
+                else:
+                    samples[self.num_events, :len(wfm)] = wfm.volts
+                records[channel_idx] = (len(wfm), wfm.start_index, wfm.dt, wfm.gain, wfm.offset, wfm.horiz_offset,
+                                        wfm.trigger_time, wfm.trigger_offset,
+                                        np.nan if wfm.timestamp is None else wfm.timestamp)
+            self.num_events += 1
+
+    def event(self, event_idx):
+        """
+        Rebuilds one stored event, its Waveforms are views onto the arrays
+        :param event_idx: row of the event
+        :return: list of Waveforms, None for missing channels
+        """
+        event = []
+        for channel_idx, record in enumerate(self.records[event_idx].tolist()):
+            length, start_index, dt, gain, offset, horiz_offset, trigger_time, trigger_offset, timestamp = record
+            samples = self.samples[channel_idx]
+            if samples is None or not length:
+                event.append(None)
+                continue
+            if samples.dtype == np.int16:
+                wfm = Waveform(dt=dt, codes=samples[event_idx, :length], gain=gain, offset=offset,
+                               horiz_offset=horiz_offset)
+            else:
+                wfm = Waveform(samples[event_idx, :length], dt, gain=gain, offset=offset, horiz_offset=horiz_offset)
+            wfm.start_index = start_index
+            wfm.trigger_time = trigger_time
+            wfm.trigger_offset = trigger_offset
+            wfm.timestamp = None if timestamp != timestamp else timestamp
+            event.append(wfm)
+        return event
+
+    def __iter__(self):
+        for event_idx in range(self.num_events):
+            yield self.event(event_idx)
+
+    def clear(self):
+        """
+        Empties the store for the next point, keeping its arrays
+        :return: None
+        """
+        self.num_events = 0
+
+    def remove_spill_files(self, spill_files):
+        for spill_filename in spill_files:
+            try:
+                os.remove(spill_filename)
+            except OSError:
+                pass
+
+    def close(self):
+        self.samples = [None] * len(self.channels)
+        self.remove_spill_files(self.spill_files)
+        self.spill_files = []
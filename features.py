@@ -0,0 +1,115 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import numpy as np
+
+# Per channel features, stored as <name><channel number> in the summary tree
+FEATURE_NAMES = ["baseline", "rms", "amplitude", "peak_time", "rise_time", "cfd_time", "charge"]
+
+
+def crossing_times(signal, levels, peak_idx, dt, horiz_offset):
+    """
+    Time at which each record last rises through each level before its peak
+    Linear interpolation between the samples either side of the crossing
+    :param signal: 2D array of baseline subtracted, positive going records
+    :param levels: 2D array, one row of per record levels for each crossing wanted
+    :param peak_idx: per record index of the maximum
+    :param dt: per record sample interval in s
+    :param horiz_offset: per record time of the first sample in s
+    :return: 2D array of times in s, one row per level, nan where a record never crosses
+    """
+    num_records, num_samples = signal.shape
+    before_peak = np.arange(num_samples) < peak_idx[:, None]
+    below = (signal < levels[:, :, None]) & before_peak
+    found = below.any(axis=2)
+    # Last sample below the level, found by searching the reversed rows
+    idx = np.minimum(num_samples - 1 - np.argmax(below[:, :, ::-1], axis=2), num_samples - 2)
+    rows = np.arange(num_records)
+    lower = signal[rows, idx]
+    upper = signal[rows, idx + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.clip((levels - lower) / (upper - lower), 0., 1.)
+    return np.where(found, horiz_offset + (idx + fraction) * dt, np.nan)
+
+
+class FeatureExtractor(object):
+    """
+    Computes pulse features of every channel record while acquiring
+    """
+
+    def __init__(self, cfd_fraction=0.5, baseline_samples=100, polarity="negative", termination=50.):
+        """
+        Constructor for the feature extractor
+        :param cfd_fraction: fraction of the amplitude the CFD time is taken at
+        :param baseline_samples: samples at the start of a record averaged for the baseline
+        :param polarity: negative or positive going pulses
+        :param termination: input impedance in Ohm, for the collected charge
+        """
+        if polarity not in ("negative", "positive"):
+            raise ValueError("Unknown pulse polarity {}".format(polarity))
+        self.cfd_fraction = cfd_fraction
+        self.baseline_samples = baseline_samples
+        self.sign = -1. if polarity == "negative" else 1.
+        self.termination = termination
+
+    def extract_records(self, volts, dt, horiz_offset):
+        """
+        Features of a stack of equal length records
+        :param volts: 2D array, one record per row
+        :param dt: per record sample interval in s
+        :param horiz_offset: per record time of the first sample in s
+        :return: dict of feature name to per record array
+        """
+        baseline_window = volts[:, :max(1, min(self.baseline_samples, volts.shape[1]))]
+        baseline = baseline_window.mean(axis=1)
+        signal = volts - baseline[:, None]
+        if self.sign < 0:
+            np.negative(signal, out=signal)
+        peak_idx = signal.argmax(axis=1)
+        amplitude = signal[np.arange(len(signal)), peak_idx]
+        # All three crossings in one pass over the records
+        time_10, time_90, time_cfd = crossing_times(
+            signal, np.outer([0.1, 0.9, self.cfd_fraction], amplitude), peak_idx, dt, horiz_offset)
+        return {
+            "baseline": baseline,
+            "rms": baseline_window.std(axis=1),
+            "amplitude": amplitude,
+            "peak_time": horiz_offset + peak_idx * dt,
+            "rise_time": time_90 - time_10,
+            "cfd_time": time_cfd,
+            "charge": signal.sum(axis=1) * dt / self.termination,
+        }
+
+    def extract(self, events, channels):
+        """
+        Features of every event of a readout
+        Records of all channels and events are stacked into one array per record length
+        :param events: list of events, each a list of Waveforms, 4 per scope
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :return: list of dicts, one per event, of feature values keyed like amplitude2
+        """
+        channel_keys = [["{}{}".format(name, channel_idx + 1) for name in FEATURE_NAMES]
+                        for channel_idx in range(len(channels))]
+        summaries = [{} for _ in events]
+        by_length = {}
+        for channel_idx, active_channel in enumerate(channels):
+            if not active_channel:
+                continue
+            for event_idx, event in enumerate(events):
+                summaries[event_idx].update(dict.fromkeys(channel_keys[channel_idx], np.nan))
+                wfm = event[channel_idx]
+                if wfm is not None and len(wfm) > 1:
+                    by_length.setdefault(len(wfm), []).append((event_idx, channel_idx, wfm))
+
+        # A readout normally has a single record length
+        for group in by_length.values():
+            features = self.extract_records(
+                np.stack([wfm.volts for _, _, wfm in group]),
+                np.array([wfm.dt for _, _, wfm in group]),
+                np.array([wfm.horiz_offset for _, _, wfm in group]),
+            )
+            rows = np.column_stack([features[name] for name in FEATURE_NAMES]).tolist()
+            for (event_idx, channel_idx, _), values in zip(group, rows):
+                summaries[event_idx].update(zip(channel_keys[channel_idx], values))
+        return summaries
@@ -0,0 +1,74 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from caen import Caen
+from lecroy import Oscilloscope
+
+
+class InstrumentPool(object):
+    """
+    Open scope and CAEN sessions, kept by address across runs
+    A DAQ run takes its instruments from the pool instead of connecting
+    anew, so back to back runs in one process skip the VISA/VICP and CAEN
+    handshakes. Scope sessions are checked with *IDN? before reuse and
+    reopened if the link dropped; the CAEN link reconnects on its own.
+    Cached settings of a reused instrument are dropped, it may have been
+    changed by hand between runs
+    """
+
+    def __init__(self):
+        self.scopes = {}
+        self.caens = {}
+
+    def scope(self, ip_address):
+        """
+        Open scope session for an address, connecting on first use
+        :param ip_address: scope address as in the config, empty for a local emulator
+        :return: Oscilloscope
+        """
+        scope = self.scopes.get(ip_address)
+        if scope is not None:
+            try:
+                scope.inst.query("*IDN?;")
+                scope.settings.forget()
+                return scope
+            except Exception as error:
+                print("Lost connection to scope {} ({}), reconnecting".format(ip_address or "emulator", error))
+                self.close_scope(scope)
+        scope = self.scopes[ip_address] = Oscilloscope(ip_address)
+        return scope
+
+    def caen(self, ip_address, channel):
+        """
+        Open CAEN session for an address, connecting on first use
+        :param ip_address: CAEN server address, optionally host:port
+        :param channel: HV channel stepped by the run
+        :return: Caen
+        """
+        caen = self.caens.get(ip_address)
+        if caen is None:
+            caen = self.caens[ip_address] = Caen(ip_address, channel)
+        else:
+            caen.settings.forget()
+        caen.caen_channel = channel
+        return caen
+
+    def close_scope(self, scope):
+        try:
+            scope.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Closes every session
+        :return: None
+        """
+        for scope in self.scopes.values():
+            self.close_scope(scope)
+        for caen in self.caens.values():
+            if not caen.test_mode:
+                caen.close()
+        self.scopes = {}
+        self.caens = {}
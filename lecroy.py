@@ -2,9 +2,83 @@ __author__ = "Ric Rodriguez"
 __email__ = "therickyross2@gmail.com"
 __project__ = "Thorium DAQ"
 
-from struct import unpack
+import socket
+import time
+from struct import pack, unpack
 
-from visa import ResourceManager
+from settings import SettingsCache
+from waveform import decode_event, decode_wavedesc, parse_block
+
+VICP_PORT = 1861
+VICP_DATA = 0x80
+VICP_REMOTE = 0x40
+VICP_EOI = 0x01
+
+
+class VicpConnection(object):
+    """
+    LeCroy VICP link over a plain TCP socket, with the subset of the pyvisa
+    resource interface the DAQ uses
+    Every message carries an 8 byte header (operation, version, sequence,
+    spare, big endian length), so binary blocks need no terminator handling
+    """
+
+    def __init__(self, host, port=VICP_PORT, timeout=10000):
+        """
+        :param host: Address of the scope or emulator
+        :param port: VICP port
+        :param timeout: timeout in ms, like pyvisa
+        """
+        self.sock = socket.create_connection((host, port), timeout=timeout / 1000.)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sequence = 1
+        # perf_counter time the first frame of the last reply arrived
+        self.reply_time = None
+
+    @property
+    def timeout(self):
+        return self.sock.gettimeout() * 1000.
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.sock.settimeout(timeout / 1000.)
+
+    def write(self, command):
+        payload = command.encode()
+        header = pack(">BBBBI", VICP_DATA | VICP_REMOTE | VICP_EOI, 1, self.sequence, 0, len(payload))
+        self.sequence = self.sequence % 255 + 1
+        self.sock.sendall(header + payload)
+
+    def read_raw(self):
+        chunks = []
+        while True:
+            operation, _, _, _, length = unpack(">BBBBI", self.recv_exactly(8))
+            if not chunks:
+                self.reply_time = time.perf_counter()
+            chunks.append(self.recv_exactly(length))
+            if operation & VICP_EOI:
+                return b"".join(chunks)
+
+    def recv_exactly(self, num_bytes):
+        buffer = bytearray(num_bytes)
+        view = memoryview(buffer)
+        received = 0
+        while received < num_bytes:
+            chunk_size = self.sock.recv_into(view[received:])
+            if not chunk_size:
+                raise ConnectionError("Scope closed the VICP connection")
+            received += chunk_size
+        return bytes(buffer)
+
+    def read(self):
+        return self.read_raw().decode()
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def close(self):
+        self.sock.close()
 
 
 class Oscilloscope(object):
@@ -17,16 +91,31 @@ class Oscilloscope(object):
         """
         Constructor for scope object
         Resets scope
-        :param ip_address: Ethernet address of scope
+        :param ip_address: Ethernet address of scope for VXI-11, host:port for VICP
         """
+        self.emulator = None
+        # Time from arming until the scope started replying, for the last event
+        self.arm_wait_time = 0.
         if not ip_address:
-            print("No ip address specified. Running in test mode.")
-            return
-        self.inst = ResourceManager("@py").open_resource("TCPIP0::" + ip_address + "::inst0::INSTR")
+            from emulator import ScopeEmulator
+
+            print("No ip address specified. Running against a local scope emulator.")
+            self.emulator = ScopeEmulator(port=0)
+            self.emulator.start()
+            ip_address = "127.0.0.1:{}".format(self.emulator.port)
+
+        if ":" in ip_address:
+            host, port = ip_address.rsplit(":", 1)
+            self.inst = VicpConnection(host, int(port))
+        else:
+            from visa import ResourceManager
+
+            self.inst = ResourceManager("@py").open_resource("TCPIP0::" + ip_address + "::inst0::INSTR")
         if "LECROY" in self.inst.query("*IDN?;"):
             print("Connected to LeCroy WavePro")
         self.inst.timeout = 60000
-        # self.inst.write(":WAV:FORM WORD;")
+        # Settings go out joined into one write, by themselves or ahead of the next arm
+        self.settings = SettingsCache(lambda commands: self.inst.write("".join(command + ";" for command in commands)))
 
     def configure_channel(self, channel_number, volts_per_div):
         """
@@ -36,8 +125,12 @@ class Oscilloscope(object):
         :return: None
         """
         self.active_channels.append(channel_number)
-        self.inst.write(":CHAN%s:DISP ON;".format(channel_number))
-        self.inst.write(":CHAN%s:SCAL %s;".format(channel_number, str(float(volts_per_div))))
+        readbacks = ("C{}:DESC".format(channel_number),)
+        self.settings.set("CHAN{}:DISP".format(channel_number), "ON", ":CHAN{}:DISP ON".format(channel_number),
+                          readbacks)
+        self.settings.set("CHAN{}:SCAL".format(channel_number), float(volts_per_div),
+                          ":CHAN{}:SCAL {}".format(channel_number, float(volts_per_div)), readbacks)
+        self.settings.flush()
 
     def arm_trigger(self, channel_number, edge_slope, thresh_level):
         """
@@ -47,55 +140,130 @@ class Oscilloscope(object):
         :param thresh_level: voltage level for trigger
         :return: None
         """
-        self.inst.write("C{}:TRig_LeVel {}V;:TRIG:EDGE:SLOP %s;".format(channel_number, thresh_level))
-        self.inst.write("C{}:TRig_SLope {};".format(channel_number, edge_slope))
+        # Unchanged settings are skipped, the rest go out with the next arm
+        self.settings.set("C{}:TRIG_LEVEL".format(channel_number), float(thresh_level),
+                          "C{}:TRig_LeVel {}V".format(channel_number, thresh_level), invalidates=())
+        self.settings.set("C{}:TRIG_SLOPE".format(channel_number), edge_slope,
+                          "C{}:TRig_SLope {}".format(channel_number, edge_slope), invalidates=())
         # self.inst.write(":TRIG:MODE NORM;")
 
-    def get_waveforms(self):
-        """
-        NOTE: DEPRECATED DO NOT USE
-        Acquires waveforms from devices
-        :param None
-        :return tuple (dt, voltage_values)
-        """
-        channel_waveforms = []
-
-        for channel in self.active_channels:
-            self.inst.write("{}:WF?;".format(channel))
-            # Read formatted data back
-            # Split at regex #9, and chomp off the first 9 bytes
-            raw_data = self.inst.read_raw().split(b'#9')[1][9:]
-            # dt is located at byte offset 176 with a size of 4 bytes
-            dt = unpack('f', raw_data[176:180])[0]
-            # dy is located at byte offset 160 with a size of 4 bytes
-            dy = unpack('f', raw_data[156:160])[0]
-
-            wave_source = {0: "Channel 1",
-                           2: "Channel 2",
-                           4: "Channel 3",
-                           8: "Channel 3"}.get(unpack('i', raw_data[344][0]))
-
-            print("dy={}".format(dy))
-            print("dt={}".format(dt))
-
-            self.inst.write("{}:WF? DAT1;".format(channel))
-            # data is offset 16 bytes from header
-            raw_waveform_data = self.inst.read_raw()[16:]
-            print(len(raw_waveform_data))
-            # for some reason chomp off the last byte? some mismatch
-            values = unpack('{}i'.format(len(raw_waveform_data) // 4), raw_waveform_data[0:len(raw_waveform_data) - 1])
-
-            # write data to csv file for debugging purposes
-            f = open("out.csv", 'w')
-            for idx, x in enumerate(values):
-                f.write("{}, {}\n".format(idx * dt[0], x * dy[0]))
-                pass
-            f.close()
-            channel_waveforms.append((wave_source, dt, values))
-        return channel_waveforms
+    def setup_binary_transfer(self):
+        """
+        Switches the scope to headerless, 16 bit, little endian binary transfers
+        :return: None
+        """
+        self.settings.set("COMM_HEADER", "OFF", "COMM_HEADER OFF")
+        self.settings.set("COMM_FORMAT", "DEF9,WORD,BIN", "COMM_FORMAT DEF9,WORD,BIN")
+        self.settings.set("COMM_ORDER", "LO", "COMM_ORDER LO")
+        self.settings.flush()
+
+    def read_block(self):
+        """
+        Reads back one definite length binary block
+        :return: Raw bytes of the reply
+        """
+        return self.inst.read_raw()
+
+    def get_wavedesc(self, channel_number):
+        """
+        Reads and decodes the WAVEDESC block of a channel
+        :param channel_number: 1-4 channel specifier
+        :return: dict of descriptor fields, cached until a setting changes it
+        """
+        def fetch():
+            self.inst.write("C{}:WF? DESC;".format(channel_number))
+            return decode_wavedesc(parse_block(self.read_block()))
+        return self.settings.read("C{}:DESC".format(channel_number), fetch)
+
+    def get_horiz_interval(self, channel_number):
+        """
+        Reads the sample interval of a channel with INSPECT?, for text transfers
+        :param channel_number: 1-4 channel specifier
+        :return: float sample interval in s, cached until a setting changes it
+        """
+        def fetch():
+            raw_dt = self.inst.query("C{}:INSPECT? HORIZ_INTERVAL".format(channel_number))
+            return float(raw_dt.split(":")[2].split(" ")[1])
+        return self.settings.read("C{}:HORIZ_INTERVAL".format(channel_number), fetch)
+
+    def setup_sequence(self, num_segments):
+        """
+        Puts the scope in sequence mode, capturing several triggers per arm
+        :param num_segments: segments per acquisition, 1 to turn sequence mode off
+        :return: None
+        """
+        if int(num_segments) > 1:
+            self.settings.set("SEQUENCE", int(num_segments), "SEQUENCE ON,{}".format(int(num_segments)))
+        else:
+            self.settings.set("SEQUENCE", 1, "SEQUENCE OFF")
+        self.settings.flush()
+
+    def read_event(self, channel_descs, block="DAT1"):
+        """
+        Arms the scope, waits for a trigger and reads back the raw WF? replies
+        :param channel_descs: list of 4 WAVEDESC dicts, None for inactive channels
+        :param block: WF? block to read, ALL to include descriptor and trigger times
+        :return: list of 4 raw replies, None for inactive channels
+        """
+        raw_blocks = [None] * 4
+        command_prefix = "".join(command + ";" for command in self.settings.pending_commands()) + "ARM;WAIT;"
+
+        time_start = time.perf_counter()
+        for channel_idx, desc in enumerate(channel_descs):
+            if desc is None:
+                continue
+            self.inst.write("{}C{}:WF? {};".format(command_prefix, channel_idx + 1, block))
+            if command_prefix:
+                self.settings.mark_sent()
+            raw_blocks[channel_idx] = self.read_block()
+            if command_prefix:
+                self.arm_wait_time = self.reply_time(time_start)
+            command_prefix = ""
+
+        return raw_blocks
+
+    def inspect_event(self, channels):
+        """
+        Arms the scope, waits for a trigger and reads back the INSPECT? SIMPLE text of every active channel
+        :param channels: list of 4 booleans, True for channels to read
+        :return: INSPECT? reply string
+        """
+        command_payload = ""
+        for channel_idx, active_channel in enumerate(channels):
+            if active_channel:
+                command_payload += "C{}:INSPECT? SIMPLE;".format(channel_idx + 1)
+
+        settings_payload = "".join(command + ";" for command in self.settings.pending_commands())
+        time_start = time.perf_counter()
+        reply = self.inst.query(settings_payload + "ARM; WAIT;" + command_payload)
+        self.settings.mark_sent()
+        self.arm_wait_time = self.reply_time(time_start)
+        return reply
+
+    def reply_time(self, time_start):
+        """
+        Time from sending a command until its reply started to arrive
+        Over VXI-11 only the complete reply is seen, so its transfer is included
+        :param time_start: perf_counter time the command was sent
+        :return: float duration in s
+        """
+        reply_time = getattr(self.inst, "reply_time", None)
+        if reply_time is None or reply_time < time_start:
+            reply_time = time.perf_counter()
+        return reply_time - time_start
+
+    def get_waveforms(self, channel_descs):
+        """
+        Arms the scope, waits for a trigger and decodes the raw ADC words
+        :param channel_descs: list of 4 WAVEDESC dicts, None for inactive channels
+        :return: list of 4 Waveforms, None for inactive channels
+        """
+        return decode_event(self.read_event(channel_descs), channel_descs=channel_descs)
 
     def close(self):
         """
         Close visa instance
         """
         self.inst.close()
+        if self.emulator is not None:
+            self.emulator.stop()
@@ -0,0 +1,112 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from collections import deque
+
+import numpy as np
+
+
+def event_timestamp(event):
+    """
+    Trigger time stamp of a single scope event, taken from its first record
+    :param event: list of 4 Waveforms
+    :return: float time stamp in s
+    """
+    for wfm in event:
+        if wfm is not None and wfm.timestamp is not None:
+            return wfm.timestamp
+    raise ValueError("Event without a trigger time stamp")
+
+
+class EventMerger(object):
+    """
+    Builds combined events out of the event streams of several scopes
+    Every scope keeps its own clock, so stream time stamps are compared
+    after subtracting a per stream offset. Scopes armed at slightly different
+    times do not start on the same trigger, so the offsets are found by
+    lining up the trigger time pattern of the first events, and then follow
+    the clock drift on every match. Events that have no partner within the
+    tolerance in every other stream are dropped
+    """
+
+    def __init__(self, num_streams, tolerance, calibration_events=8):
+        """
+        Constructor for the event merger
+        :param num_streams: number of scopes
+        :param tolerance: largest time stamp difference in s between parts of one event
+        :param calibration_events: events of every stream used to find the clock offsets
+        """
+        self.pending = [deque() for _ in range(num_streams)]
+        self.tolerance = tolerance
+        self.calibration_events = calibration_events
+        self.offsets = None
+        self.first_stamp = None
+        self.num_merged = 0
+        self.num_dropped = [0] * num_streams
+
+    def push(self, stream_idx, events):
+        """
+        Queues decoded events of one scope, in acquisition order
+        :param stream_idx: index of the scope
+        :param events: list of events, each a list of 4 Waveforms
+        :return: None
+        """
+        self.pending[stream_idx].extend(events)
+
+    def calibrate(self):
+        """
+        Finds the clock offset of every stream to the first one
+        Every pairing of the first events is tried as an offset, the one
+        matching the most time stamps wins, the smallest change on ties
+        :return: list of offsets in s
+        """
+        reference = np.array([event_timestamp(event) for event in list(self.pending[0])[:self.calibration_events]])
+        offsets = [0.]
+        for stream in self.pending[1:]:
+            stamps = np.array([event_timestamp(event) for event in list(stream)[:self.calibration_events]])
+            candidates = (stamps[:, None] - reference[None, :]).ravel()
+            aligned = stamps[None, :] - candidates[:, None]
+            num_matches = (np.abs(aligned[:, :, None] - reference[None, None, :]) <= self.tolerance) \
+                .any(axis=2).sum(axis=1)
+            best = np.flatnonzero(num_matches == num_matches.max())
+            naive = stamps[0] - reference[0]
+            offsets.append(float(candidates[best[np.argmin(np.abs(candidates[best] - naive))]]))
+        return offsets
+
+    def pop_merged(self):
+        """
+        Merges every event that has arrived from all scopes
+        The trigger time of a merged event is its time since the first merged event
+        :return: list of events, each a list of 4 Waveforms per scope in scope order
+        """
+        merged = []
+        if self.offsets is None:
+            if min(len(stream) for stream in self.pending) < self.calibration_events:
+                return merged
+            self.offsets = self.calibrate()
+        while all(self.pending):
+            stamps = [event_timestamp(stream[0]) for stream in self.pending]
+            aligned = [stamp - offset for stamp, offset in zip(stamps, self.offsets)]
+            earliest = min(aligned)
+
+            if max(aligned) - earliest > self.tolerance:
+                # Some scope missed the earliest trigger, so drop the parts that were seen
+                for stream_idx, stamp in enumerate(aligned):
+                    if stamp - earliest <= self.tolerance:
+                        self.pending[stream_idx].popleft()
+                        self.num_dropped[stream_idx] += 1
+                continue
+
+            event = []
+            for stream_idx, stream in enumerate(self.pending):
+                event.extend(stream.popleft())
+                self.offsets[stream_idx] += aligned[stream_idx] - aligned[0]
+            if self.first_stamp is None:
+                self.first_stamp = aligned[0]
+            for wfm in event:
+                if wfm is not None:
+                    wfm.trigger_time = aligned[0] - self.first_stamp
+            merged.append(event)
+            self.num_merged += 1
+        return merged
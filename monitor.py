@@ -0,0 +1,143 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import threading
+import time
+
+import numpy as np
+
+
+class CurrentMonitor(threading.Thread):
+    """
+    Background thread sampling IMON and VMON of the stepped HV channel
+    Samples go into a fixed size ring buffer and, during a sweep point, to a
+    csv file next to the point's output file. When dI/dt exceeds the threshold
+    while armed, the DAQ is told to stop and the channel is ramped down
+    """
+
+    def __init__(self, caen, channel, stop_queue, rate=10., buffer_size=4096, di_dt_thresh=None):
+        """
+        Constructor for the monitor thread
+        :param caen: Caen instance, shared with the DAQ
+        :param channel: Channel number [0-3]
+        :param stop_queue: Queue the DAQ polls for STOP requests
+        :param rate: Sampling rate in Hz
+        :param buffer_size: Number of samples kept in memory
+        :param di_dt_thresh: |dI/dt| in A/s that aborts the run, None to only record
+        """
+        threading.Thread.__init__(self, name="CurrentMonitor", daemon=True)
+        self.caen = caen
+        self.channel = channel
+        self.stop_queue = stop_queue
+        self.period = 1. / rate
+        self.di_dt_thresh = di_dt_thresh
+        # Columns: monotonic time, vmon in V, imon in A, dI/dt in A/s
+        self.samples = np.zeros((buffer_size, 4))
+        self.num_samples = 0
+        self.samples_lock = threading.Lock()
+        self.output_file = None
+        self.armed = threading.Event()
+        self.tripped = threading.Event()
+        self.halt = threading.Event()
+
+    def run(self):
+        next_sample = time.monotonic()
+        while not self.halt.is_set():
+            # Any failure is logged and sampling goes on, the thread is the only breakdown protection
+            try:
+                readings = self.caen.monitor(self.channel)
+                self.record(time.monotonic(), readings["vmon"], readings["imon"])
+            except Exception as error:
+                print("HV monitor sample failed: {!r}".format(error))
+            next_sample += self.period
+            self.halt.wait(max(0., next_sample - time.monotonic()))
+
+    def record(self, sample_time, vmon, imon):
+        """
+        Stores one sample and checks dI/dt against the threshold
+        :param sample_time: monotonic time of the sample in s
+        :param vmon: voltage in V
+        :param imon: current in A
+        :return: None
+        """
+        with self.samples_lock:
+            di_dt = 0.
+            if self.num_samples:
+                last_time, _, last_imon, _ = self.samples[(self.num_samples - 1) % len(self.samples)]
+                if sample_time > last_time:
+                    di_dt = (imon - last_imon) / (sample_time - last_time)
+            self.samples[self.num_samples % len(self.samples)] = (sample_time, vmon, imon, di_dt)
+            self.num_samples += 1
+            if self.output_file is not None:
+                self.output_file.write("{},{},{},{}\n".format(sample_time, vmon, imon, di_dt))
+
+        if self.di_dt_thresh and self.armed.is_set() and abs(di_dt) > self.di_dt_thresh:
+            self.trip(di_dt)
+
+    def trip(self, di_dt):
+        """
+        Stops the DAQ and ramps the channel down after a breakdown
+        :param di_dt: offending dI/dt in A/s
+        :return: None
+        """
+        if self.tripped.is_set():
+            return
+        self.tripped.set()
+        self.armed.clear()
+        print("HV MONITOR: dI/dt = {:.3g} A/s above {:.3g} A/s, STOPPING EXPERIMENT".format(
+            di_dt, self.di_dt_thresh))
+        # The DAQ is stopped first, so it stops even if the ramp down fails
+        self.stop_queue.put("STOP")
+        try:
+            self.caen.set_output(self.channel, "0")
+        except Exception as error:
+            print("HV MONITOR: ramp down of channel {} failed: {!r}".format(self.channel, error))
+
+    def latest(self, num_samples=1):
+        """
+        Copies the most recent samples out of the ring buffer, oldest first
+        :param num_samples: number of samples wanted
+        :return: array of (time, vmon, imon, di_dt) rows
+        """
+        with self.samples_lock:
+            num_samples = min(num_samples, self.num_samples, len(self.samples))
+            idx = np.arange(self.num_samples - num_samples, self.num_samples) % len(self.samples)
+            return self.samples[idx].copy()
+
+    def read_current(self):
+        """
+        Latest current without a round trip to the supply
+        :return: float current in A
+        """
+        latest = self.latest()
+        if not len(latest):
+            return self.caen.read_current()
+        return latest[0, 2]
+
+    def start_point(self, filename):
+        """
+        Starts writing samples to a csv file and arms the dI/dt check
+        :param filename: csv file to write
+        :return: None
+        """
+        with self.samples_lock:
+            self.output_file = open(filename, "w")
+            self.output_file.write("time,vmon,imon,di_dt\n")
+        self.armed.set()
+
+    def end_point(self):
+        """
+        Disarms the dI/dt check, e.g. while the supply ramps, and closes the csv file
+        :return: None
+        """
+        self.armed.clear()
+        with self.samples_lock:
+            if self.output_file is not None:
+                self.output_file.close()
+                self.output_file = None
+
+    def stop(self):
+        self.end_point()
+        self.halt.set()
+        self.join()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import argparse
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+PREVIEW_NAME = "thorium_preview"
+# write count, slots, channels, record length, histogram bins
+HEADER_FIELDS = 5
+# Blocks created by PreviewBuffers of this process
+published_names = set()
+
+
+def preview_layout(num_slots, num_channels, record_length, num_bins):
+    """
+    Arrays of the shared preview block, in order
+    :param num_slots: events kept in the ring
+    :param num_channels: channels, 4 per scope
+    :param record_length: samples kept per record
+    :param num_bins: amplitude histogram bins
+    :return: list of (name, dtype, shape)
+    """
+    return [
+        ("header", np.int64, (HEADER_FIELDS,)),
+        # Lower and upper edge of the amplitude histograms in V
+        ("limits", np.float64, (2,)),
+        # Event number held by each slot, -1 while the slot is being written
+        ("sequence", np.int64, (num_slots,)),
+        ("lengths", np.int32, (num_slots, num_channels)),
+        ("dt", np.float64, (num_slots, num_channels)),
+        # Time of the first stored sample, windowed records start late
+        ("t0", np.float64, (num_slots, num_channels)),
+        ("volts", np.float32, (num_slots, num_channels, record_length)),
+        ("histograms", np.int64, (num_channels, num_bins)),
+    ]
+
+
+def map_arrays(buffer, layout):
+    """
+    Numpy views onto a shared memory buffer
+    :param buffer: memoryview of the block
+    :param layout: preview_layout list
+    :return: dict of name to array, and the size in bytes
+    """
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in layout:
+        # Keep every array 8 byte aligned
+        offset = (offset + 7) // 8 * 8
+        arrays[name] = np.ndarray(shape, dtype, buffer, offset) if buffer is not None else None
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return arrays, offset
+
+
+class PreviewBuffer(object):
+    """
+    Publishes the latest events and running amplitude histograms in shared memory
+    A viewer process attaches with PreviewReader and reads the records in
+    place. Each slot carries the number of the event in it, set to -1 while
+    being rewritten, so readers can tell a torn record from a good one. The
+    block is sized by the first event, unless a record length is given
+    """
+
+    def __init__(self, channels, name=PREVIEW_NAME, num_slots=64, record_length=None, num_bins=100,
+                 amplitude_range=(0., 0.5)):
+        """
+        Constructor for the preview publisher
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param name: shared memory block name viewers attach to
+        :param num_slots: events kept
+        :param record_length: samples kept per record, None for the first event's longest record
+        :param num_bins: amplitude histogram bins
+        :param amplitude_range: (low, high) amplitude histogram range in V
+        """
+        self.channels = channels
+        self.name = name
+        self.num_slots = num_slots
+        self.record_length = record_length
+        self.num_bins = num_bins
+        self.amplitude_range = amplitude_range
+        self.shm = None
+        self.arrays = None
+        self.num_published = 0
+
+    def create(self, record_length):
+        """
+        Creates the shared memory block, replacing a stale one left by a crashed run
+        :param record_length: samples kept per record
+        :return: None
+        """
+        layout = preview_layout(self.num_slots, len(self.channels), record_length, self.num_bins)
+        _, size = map_arrays(None, layout)
+        try:
+            self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        published_names.add(self.name)
+        self.arrays, _ = map_arrays(self.shm.buf, layout)
+        self.arrays["sequence"][:] = -1
+        self.arrays["limits"][:] = self.amplitude_range
+        self.arrays["histograms"][:] = 0
+        self.arrays["header"][:] = (0, self.num_slots, len(self.channels), record_length, self.num_bins)
+        self.record_length = record_length
+        print("Publishing live preview to shared memory {}".format(self.name))
+
+    def publish(self, events, features=None):
+        """
+        Copies events into the ring and adds their amplitudes to the histograms
+        :param events: list of events, each a list of Waveforms, 4 per scope
+        :param features: per event feature dicts, their amplitudes are used when given
+        :return: None
+        """
+        if self.shm is None:
+            self.create(self.record_length or max(len(wfm) for event in events for wfm in event if wfm is not None))
+        arrays = self.arrays
+        low, high = self.amplitude_range
+        for event_idx, event in enumerate(events):
+            slot = self.num_published % self.num_slots
+            arrays["sequence"][slot] = -1
+            arrays["lengths"][slot] = 0
+            for channel_idx, active_channel in enumerate(self.channels):
+                wfm = event[channel_idx] if active_channel else None
+                if wfm is None or not len(wfm):
+                    continue
+                volts = wfm.volts[:self.record_length]
+                arrays["volts"][slot, channel_idx, :len(volts)] = volts
+                arrays["lengths"][slot, channel_idx] = len(volts)
+                arrays["dt"][slot, channel_idx] = wfm.dt
+                arrays["t0"][slot, channel_idx] = wfm.horiz_offset + wfm.start_index * wfm.dt
+
+                if features is not None:
+                    amplitude = features[event_idx]["amplitude{}".format(channel_idx + 1)]
+                else:
+                    amplitude = float(volts.max() - volts.min())
+                if amplitude == amplitude:
+                    bin_idx = int((amplitude - low) / (high - low) * self.num_bins)
+                    arrays["histograms"][channel_idx, min(max(bin_idx, 0), self.num_bins - 1)] += 1
+            arrays["sequence"][slot] = self.num_published
+            self.num_published += 1
+            arrays["header"][0] = self.num_published
+
+    def close(self):
+        """
+        Removes the shared memory block, attached viewers keep their mapping
+        :return: None
+        """
+        if self.shm is not None:
+            self.arrays = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+            published_names.discard(self.name)
+
+
+class PreviewReader(object):
+    """
+    Attaches to the preview block of a running DAQ
+    Records are returned as views onto shared memory, so they are rewritten
+    in place once the DAQ wraps around the ring; is_current tells if a record
+    read is still the event it was
+    """
+
+    def __init__(self, name=PREVIEW_NAME):
+        """
+        Constructor for the preview reader
+        :param name: shared memory block name, as given to the PreviewBuffer
+        """
+        self.shm = shared_memory.SharedMemory(name)
+        # The DAQ owns the block, do not let this process' tracker unlink it on exit
+        if name not in published_names:
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        header = np.ndarray((HEADER_FIELDS,), np.int64, self.shm.buf)
+        _, self.num_slots, self.num_channels, self.record_length, self.num_bins = header.tolist()
+        self.arrays, _ = map_arrays(self.shm.buf, preview_layout(
+            self.num_slots, self.num_channels, self.record_length, self.num_bins))
+
+    @property
+    def num_published(self):
+        return int(self.arrays["header"][0])
+
+    def is_current(self, event_number):
+        return int(self.arrays["sequence"][event_number % self.num_slots]) == event_number
+
+    def latest(self, num_events=1):
+        """
+        Latest complete events
+        :param num_events: events wanted, at most the ring size
+        :return: list of (event number, list of (times, volts) per channel or None), oldest first
+        """
+        last = self.num_published
+        events = []
+        for event_number in range(max(last - min(num_events, self.num_slots), 0), last):
+            slot = event_number % self.num_slots
+            if not self.is_current(event_number):
+                continue
+            records = []
+            for channel_idx in range(self.num_channels):
+                length = int(self.arrays["lengths"][slot, channel_idx])
+                if not length:
+                    records.append(None)
+                    continue
+                dt = self.arrays["dt"][slot, channel_idx]
+                times = self.arrays["t0"][slot, channel_idx] + np.arange(length) * dt
+                records.append((times, self.arrays["volts"][slot, channel_idx, :length]))
+            events.append((event_number, records))
+        return events
+
+    def histograms(self):
+        """
+        Running amplitude histograms
+        :return: tuple (bin edges in V, counts array of shape (channels, bins))
+        """
+        low, high = self.arrays["limits"]
+        return np.linspace(low, high, self.num_bins + 1), self.arrays["histograms"]
+
+    def close(self):
+        self.arrays = None
+        self.shm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints a live summary of the DAQ preview")
+    parser.add_argument("--name", default=PREVIEW_NAME, help="Shared memory name of the preview")
+    parser.add_argument("--interval", type=float, default=1., help="Seconds between updates")
+    args = parser.parse_args()
+
+    reader = None
+    last_published = 0
+    try:
+        while True:
+            if reader is None:
+                try:
+                    reader = PreviewReader(args.name)
+                except FileNotFoundError:
+                    time.sleep(args.interval)
+                    continue
+            published = reader.num_published
+            edges, counts = reader.histograms()
+            centers = (edges[1:] + edges[:-1]) / 2.
+            print("{} events, {:.1f} events/s".format(published, (published - last_published) / args.interval))
+            for channel_idx, channel_counts in enumerate(counts):
+                total = channel_counts.sum()
+                if not total:
+                    continue
+                mean = (channel_counts * centers).sum() / total
+                print("  CH{:<2d} n={:<8d} mean amplitude={:7.1f} mV  overflow={}".format(
+                    channel_idx + 1, total, mean * 1e3, channel_counts[-1]))
+            last_published = published
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    if reader is not None:
+        reader.close()
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+# {outfile}_{trigger}_trig_{volt}V, with the extension of the writer backend
+POINT_PATTERN = re.compile(r"^(?P<run>.+)_(?P<trigger>user|\d+(?:\.\d+)?mV)_trig_(?P<volt>[-+]?\d+(?:\.\d+)?)V"
+                           r"(?P<extension>\.root|\.h5)?$")
+BACKEND_EXTENSIONS = {".root": "root", ".h5": "hdf5", None: "npy"}
+CURRENT_LABELS = ["Begin", "Middle", "End"]
+
+
+def read_currents(filename):
+    """
+    Reads the HV currents file of a run
+    :param filename: {outfile}_currents.csv
+    :return: list of (volt, dict of Begin/Middle/End current in A), one per completed point in order
+    """
+    points = []
+    if not os.path.exists(filename):
+        return points
+    with open(filename) as currents_file:
+        for line in currents_file:
+            fields = line.strip().split(",")
+            if len(fields) != 3:
+                continue
+            label, volt, current = fields
+            if label == CURRENT_LABELS[0]:
+                points.append((float(volt), {}))
+            if points:
+                points[-1][1][label] = float(current)
+    return points
+
+
+class RunPoint(object):
+    """
+    One sweep point of a run on disk, with the settings parsed from its file name
+    Waveforms are only read when asked for, in chunks of events
+    """
+
+    def __init__(self, filename, run, volt, trigger, backend):
+        """
+        Constructor for a point
+        :param filename: output file, or directory for the npy backend
+        :param run: outfile name the run was started with
+        :param volt: bias voltage in V
+        :param trigger: trigger threshold magnitude in mV, None when the scope setting was kept
+        :param backend: root, npy or hdf5
+        """
+        self.filename = filename
+        self.run = run
+        self.volt = volt
+        self.trigger = trigger
+        self.backend = backend
+        self.currents = {}
+        self.events = 0
+        self.channels = []
+        self.scan()
+
+    def __repr__(self):
+        return "RunPoint({}, {}V, {}, {} events)".format(
+            self.run, self.volt, "user" if self.trigger is None else "{}mV".format(self.trigger), self.events)
+
+    def scan(self):
+        """
+        Reads the event count and channel numbers, without loading any waveform
+        :return: None
+        """
+        if self.backend == "npy":
+            with open(os.path.join(self.filename, "meta.json")) as meta_file:
+                self.metadata = json.load(meta_file)
+            self.events = self.metadata["events"]
+            self.channels = sorted(int(name[1:]) for name in self.metadata["channels"])
+        elif self.backend == "hdf5":
+            import h5py
+
+            with h5py.File(self.filename, "r") as h5_file:
+                self.events = int(h5_file.attrs["events"])
+                self.channels = sorted(int(name[1:]) for name in h5_file if re.match(r"^w\d+$", name))
+        else:
+            import ROOT
+
+            root_file = ROOT.TFile.Open(self.filename)
+            tree = root_file.Get("wfm")
+            self.events = int(tree.GetEntries())
+            self.channels = sorted(int(branch.GetName()[1:]) for branch in tree.GetListOfBranches()
+                                   if re.match(r"^w\d+$", branch.GetName()))
+            root_file.Close()
+
+    def catalog_entry(self):
+        return {
+            "filename": self.filename,
+            "run": self.run,
+            "volt": self.volt,
+            "trigger": self.trigger,
+            "backend": self.backend,
+            "events": self.events,
+            "channels": self.channels,
+            "currents": self.currents,
+        }
+
+    def iterate(self, channels=None, branches=("w", "t"), chunk_events=256):
+        """
+        Reads the point in chunks of events
+        Records of a chunk are rows of one array, shorter records are padded with nan
+        :param channels: channel numbers to read, None for all
+        :param branches: w for voltages in V, t for sample times in s
+        :param chunk_events: events per chunk
+        :return: generator of dicts like {"w2": array, "t2": array}, one per chunk
+        """
+        channels = self.channels if channels is None else channels
+        missing = set(channels) - set(self.channels)
+        if missing:
+            raise KeyError("Channels {} not in {}".format(sorted(missing), self.filename))
+        if self.backend == "root":
+            return self.iterate_root(channels, branches, chunk_events)
+        return self.iterate_compact(channels, branches, chunk_events)
+
+    def iterate_compact(self, channels, branches, chunk_events):
+        """
+        Reads npy and hdf5 points, stored as int16 codes with per channel scale factors
+        volts = code * gain - offset, time = horiz_offset + dt * (start + index)
+        """
+        h5_file = None
+        if self.backend == "npy":
+            def dataset(name):
+                path = os.path.join(self.filename, name + ".npy")
+                return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+            scales = self.metadata["channels"]
+        else:
+            import h5py
+
+            h5_file = h5py.File(self.filename, "r")
+
+            def dataset(name):
+                return h5_file[name] if name in h5_file else None
+            scales = {"w{}".format(channel): dict(h5_file["w{}".format(channel)].attrs) for channel in channels}
+
+        try:
+            codes = {channel: dataset("w{}".format(channel)) for channel in channels}
+            starts = {channel: dataset("start{}".format(channel)) for channel in channels}
+            for chunk_start in range(0, self.events, chunk_events):
+                chunk_stop = min(chunk_start + chunk_events, self.events)
+                chunk = {}
+                for channel in channels:
+                    scale = scales["w{}".format(channel)]
+                    if "w" in branches:
+                        chunk["w{}".format(channel)] = \
+                            codes[channel][chunk_start:chunk_stop] * scale["gain"] - scale["offset"]
+                    if "t" in branches:
+                        sample_index = np.arange(codes[channel].shape[1], dtype=np.float64)
+                        if starts[channel] is not None:
+                            sample_index = sample_index + np.asarray(starts[channel][chunk_start:chunk_stop])[:, None]
+                        else:
+                            sample_index = np.tile(sample_index, (chunk_stop - chunk_start, 1))
+                        chunk["t{}".format(channel)] = scale["horiz_offset"] + scale["dt"] * sample_index
+                yield chunk
+        finally:
+            if h5_file is not None:
+                h5_file.close()
+
+    def iterate_root(self, channels, branches, chunk_events):
+        """
+        Reads a ROOT point entry by entry into numpy branch buffers
+        Times follow the tree's t aliases, hoff + (start + index) * dt, or the stored t branches of the legacy schema
+        """
+        import ROOT
+
+        root_file = ROOT.TFile.Open(self.filename)
+        tree = root_file.Get("wfm")
+        stored = set(branch.GetName() for branch in tree.GetListOfBranches())
+        tree.SetBranchStatus("*", 0)
+        buffers = {}
+        widths = {}
+        for channel in channels:
+            max_samples = widths[channel] = max(int(tree.GetMaximum("n{}".format(channel))), 1)
+            names = [("n{}".format(channel), np.int32, 1), ("dt{}".format(channel), np.float64, 1)]
+            if "w" in branches:
+                names.append(("w{}".format(channel), np.float64, max_samples))
+            if "t" in branches:
+                if "t{}".format(channel) in stored:
+                    names.append(("t{}".format(channel), np.float64, max_samples))
+                else:
+                    names.append(("hoff{}".format(channel), np.float64, 1))
+                    if "start{}".format(channel) in stored:
+                        names.append(("start{}".format(channel), np.int32, 1))
+            for name, dtype, size in names:
+                buffers[name] = np.zeros(size, dtype=dtype)
+                tree.SetBranchStatus(name, 1)
+                tree.SetBranchAddress(name, buffers[name])
+
+        try:
+            for chunk_start in range(0, self.events, chunk_events):
+                chunk_stop = min(chunk_start + chunk_events, self.events)
+                chunk = {}
+                for channel in channels:
+                    for branch in branches:
+                        chunk["{}{}".format(branch, channel)] = np.full((chunk_stop - chunk_start, widths[channel]),
+                                                                        np.nan)
+                for row, entry in enumerate(range(chunk_start, chunk_stop)):
+                    tree.GetEntry(entry)
+                    for channel in channels:
+                        num_samples = int(buffers["n{}".format(channel)][0])
+                        if "w" in branches:
+                            chunk["w{}".format(channel)][row, :num_samples] = buffers["w{}".format(channel)][:num_samples]
+                        if "t" not in branches:
+                            continue
+                        if "t{}".format(channel) in buffers:
+                            chunk["t{}".format(channel)][row, :num_samples] = buffers["t{}".format(channel)][:num_samples]
+                        else:
+                            start = buffers["start{}".format(channel)][0] if "start{}".format(channel) in buffers else 0
+                            chunk["t{}".format(channel)][row, :num_samples] = buffers["hoff{}".format(channel)][0] + \
+                                (start + np.arange(num_samples)) * buffers["dt{}".format(channel)][0]
+                yield chunk
+        finally:
+            root_file.Close()
+
+
+class RunCatalog(object):
+    """
+    Index of every sweep point in a run directory
+    Voltage and trigger come from the point file names, currents from the
+    run's _currents.csv, which lists the completed points in acquisition order
+    with their voltage only. Points sharing a voltage are told apart by the
+    order their files were written in
+    """
+
+    def __init__(self, directory):
+        """
+        Constructor for the catalog, scans the directory
+        :param directory: directory holding the DAQ output
+        """
+        self.directory = directory
+        self.points = []
+        for name in os.listdir(directory):
+            match = POINT_PATTERN.match(name)
+            path = os.path.join(directory, name)
+            if match is None or (match.group("extension") is None) != os.path.isdir(path):
+                continue
+            trigger = match.group("trigger")
+            self.points.append(RunPoint(path, match.group("run"), float(match.group("volt")),
+                                        None if trigger == "user" else float(trigger[:-2]),
+                                        BACKEND_EXTENSIONS[match.group("extension")]))
+
+        self.points.sort(key=lambda point: os.path.getmtime(point.filename))
+        for run in self.runs():
+            currents = read_currents(os.path.join(directory, "{}_currents.csv".format(run)))
+            for volt in set(volt for volt, _ in currents):
+                volt_currents = [point_currents for current_volt, point_currents in currents if current_volt == volt]
+                for point, point_currents in zip(self.select(run=run, volt=volt), volt_currents):
+                    point.currents = point_currents
+        self.points.sort(key=lambda point: (point.run, abs(point.volt), point.trigger or 0.))
+
+    def runs(self):
+        return sorted(set(point.run for point in self.points))
+
+    def select(self, run=None, volt=None, trigger=None):
+        """
+        Points matching every given setting
+        :param run: outfile name of the run
+        :param volt: bias voltage in V
+        :param trigger: trigger threshold magnitude in mV
+        :return: list of RunPoints
+        """
+        return [point for point in self.points
+                if (run is None or point.run == run) and (volt is None or point.volt == float(volt))
+                and (trigger is None or point.trigger == abs(float(trigger)))]
+
+    def iterate(self, points=None, channels=None, branches=("w", "t"), chunk_events=256):
+        """
+        Reads several points chunk by chunk, only one chunk is held at a time
+        :param points: RunPoints to read, None for all
+        :param channels: channel numbers to read, None for all of each point
+        :param branches: w for voltages, t for times
+        :param chunk_events: events per chunk
+        :return: generator of (RunPoint, chunk dict)
+        """
+        for point in self.points if points is None else points:
+            for chunk in point.iterate(channels, branches, chunk_events):
+                yield point, chunk
+
+    def write(self, filename):
+        """
+        Saves the catalog as JSON
+        :param filename: output file
+        :return: None
+        """
+        with open(filename, "w") as catalog_file:
+            json.dump([point.catalog_entry() for point in self.points], catalog_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the sweep points of Thorium DAQ output")
+    parser.add_argument("directory", nargs="?", default=".", help="Run directory")
+    parser.add_argument("--output", help="Also save the catalog as JSON")
+    args = parser.parse_args()
+
+    catalog = RunCatalog(args.directory)
+    print("{:<20} {:>8} {:>8} {:>7} {:<10} {:>12}".format("run", "volt", "trigger", "events", "channels", "I begin"))
+    for point in catalog.points:
+        print("{:<20} {:>8.1f} {:>8} {:>7d} {:<10} {:>12}".format(
+            point.run, point.volt, "user" if point.trigger is None else "{:.1f}".format(point.trigger), point.events,
+            ",".join(str(channel) for channel in point.channels),
+            "{:.3e}".format(point.currents["Begin"]) if "Begin" in point.currents else "-"))
+    if args.output:
+        catalog.write(args.output)
@@ -0,0 +1,119 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import numpy as np
+
+
+class RoiWindow(object):
+    """
+    Cuts every channel record down to a fixed window around its pulse
+    The window is anchored on the pulse peak or on the first crossing of a
+    threshold and is shifted to stay inside the record, so every stored row
+    has the same length. The start index of the window is kept with the record
+    """
+
+    def __init__(self, before=5e-9, after=10e-9, anchor="peak", threshold=None, polarity="negative",
+                 baseline_samples=100, reference_channel=None):
+        """
+        Constructor for the region of interest window
+        :param before: time kept before the anchor in s
+        :param after: time kept after the anchor in s
+        :param anchor: peak, or threshold for the first crossing of the threshold
+        :param threshold: baseline subtracted level in V of the threshold anchor, signed like the pulse
+        :param polarity: negative or positive going pulses
+        :param baseline_samples: samples at the start of a record averaged for the baseline
+        :param reference_channel: channel number to cut every channel around this channel's pulse, None for each its own
+        """
+        if anchor not in ("peak", "threshold"):
+            raise ValueError("Unknown window anchor {}".format(anchor))
+        if anchor == "threshold" and threshold is None:
+            raise ValueError("The threshold anchor needs a threshold")
+        if polarity not in ("negative", "positive"):
+            raise ValueError("Unknown pulse polarity {}".format(polarity))
+        self.before = before
+        self.after = after
+        self.anchor = anchor
+        self.sign = -1. if polarity == "negative" else 1.
+        self.threshold = None if threshold is None else abs(threshold)
+        self.baseline_samples = baseline_samples
+        self.reference_channel = reference_channel
+
+    def anchor_indices(self, volts):
+        """
+        Finds the anchor sample of a stack of equal length records
+        Records that never cross the threshold are anchored on their peak
+        :param volts: 2D array, one record per row
+        :return: per record anchor index
+        """
+        # The peak does not depend on the baseline, so it costs a single pass
+        peak_idx = volts.argmin(axis=1) if self.sign < 0 else volts.argmax(axis=1)
+        if self.anchor == "peak":
+            return peak_idx
+        baseline = volts[:, :max(1, min(self.baseline_samples, volts.shape[1]))].mean(axis=1)
+        level = baseline + self.sign * self.threshold
+        above = volts <= level[:, None] if self.sign < 0 else volts >= level[:, None]
+        return np.where(above.any(axis=1), above.argmax(axis=1), peak_idx)
+
+    def window_bounds(self, anchor_idx, num_samples, dt):
+        """
+        Converts anchors to window start and stop indices
+        :param anchor_idx: per record anchor index
+        :param num_samples: record length
+        :param dt: sample interval in s
+        :return: tuple (start, stop) arrays
+        """
+        num_before = int(round(self.before / dt))
+        width = min(num_before + int(round(self.after / dt)) + 1, num_samples)
+        start = np.clip(anchor_idx - num_before, 0, num_samples - width)
+        return start, start + width
+
+    def apply(self, events, channels):
+        """
+        Windows every record of a readout
+        Records are stacked into one array per record length, so anchors are
+        found for a whole readout at once. With a reference channel, events
+        missing the reference record are cut around each channel's own pulse
+        :param events: list of events, each a list of Waveforms, 4 per scope
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :return: list of events with windowed Waveforms
+        """
+        windowed = [list(event) for event in events]
+        pending = [(event_idx, channel_idx) for event_idx, event in enumerate(events)
+                   for channel_idx, active_channel in enumerate(channels)
+                   if active_channel and event[channel_idx] is not None and len(event[channel_idx]) > 1]
+
+        if self.reference_channel is not None:
+            reference_idx = self.reference_channel - 1
+            references = [record for record in pending if record[1] == reference_idx]
+            valid = set(pending)
+            for (event_idx, _), start, stop in self.find_windows(events, references):
+                for channel_idx, wfm in enumerate(events[event_idx]):
+                    if (event_idx, channel_idx) in valid and len(wfm) >= stop:
+                        windowed[event_idx][channel_idx] = wfm.window(start, stop)
+            pending = [(event_idx, channel_idx) for event_idx, channel_idx in pending
+                       if windowed[event_idx][channel_idx] is events[event_idx][channel_idx]]
+
+        for (event_idx, channel_idx), start, stop in self.find_windows(events, pending):
+            windowed[event_idx][channel_idx] = events[event_idx][channel_idx].window(start, stop)
+        return windowed
+
+    def find_windows(self, events, records):
+        """
+        Window of each record, anchored on its own pulse
+        :param events: list of events, each a list of Waveforms, 4 per scope
+        :param records: list of (event index, channel index) pairs
+        :return: list of ((event index, channel index), start, stop)
+        """
+        by_shape = {}
+        for event_idx, channel_idx in records:
+            wfm = events[event_idx][channel_idx]
+            by_shape.setdefault((len(wfm), wfm.dt), []).append((event_idx, channel_idx))
+
+        windows = []
+        for (num_samples, dt), group in by_shape.items():
+            anchor_idx = self.anchor_indices(np.stack([events[event_idx][channel_idx].volts
+                                                       for event_idx, channel_idx in group]))
+            starts, stops = self.window_bounds(anchor_idx, num_samples, dt)
+            windows.extend(zip(group, starts.tolist(), stops.tolist()))
+        return windows
@@ -4,8 +4,9 @@ __email__ = "therickyross2@gmail.com"
 __project__ = "Thorium-DAQ"
 
 
-import socket
+import asyncio
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pyvisa import ResourceManager
 import logging
 import logging.handlers
@@ -57,6 +58,114 @@ class Caen_control(object):
         return self.inst.query(command)
 
 
+def command_fields(command):
+    """
+    Splits a CAEN command like $BD:0,CMD:SET,CH:1,PAR:VSET,VAL:100 into its fields
+    :param command: CAEN command string
+    :return: dict of field name to value
+    """
+    fields = {}
+    for field in command.lstrip("$").split(","):
+        name, _, value = field.partition(":")
+        fields[name.strip().upper()] = value.strip()
+    return fields
+
+
+class CaenBridge(object):
+    """
+    Asyncio TCP server sharing one CAEN psu between many clients
+    Commands are framed by newlines and run one at a time on the serial handle;
+    identical monitor reads arriving within coalesce_window share one query,
+    and a SET drops the cached reads of its channel
+    """
+
+    def __init__(self, caen, coalesce_window=0.05):
+        """
+        :param caen: Caen_control instance owning the serial handle
+        :param coalesce_window: time in s a CMD:MON reply is reused for identical reads
+        """
+        self.caen = caen
+        self.coalesce_window = coalesce_window
+        # Single worker thread so blocking VISA calls never overlap
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.monitor_replies = {}
+
+    async def query(self, command):
+        """
+        Runs a command on the psu, coalescing identical monitor reads
+        :param command: CAEN command string without line terminator
+        :return: response string
+        """
+        loop = asyncio.get_running_loop()
+        if "CMD:MON" not in command:
+            if "CMD:SET" in command:
+                self.forget_monitor_replies(command)
+            return await loop.run_in_executor(self.executor, self.caen.send_command, command)
+
+        cached = self.monitor_replies.get(command)
+        if cached is not None and (cached[1] is None or loop.time() - cached[1] < self.coalesce_window):
+            return await asyncio.shield(cached[0])
+
+        reply = loop.run_in_executor(self.executor, self.caen.send_command, command)
+        self.monitor_replies[command] = (reply, None)
+        try:
+            response = await asyncio.shield(reply)
+        except Exception:
+            if self.monitor_replies.get(command, (None,))[0] is reply:
+                self.monitor_replies.pop(command)
+            raise
+        # Not cached again if a SET dropped it while the read was queued
+        if self.monitor_replies.get(command, (None,))[0] is reply:
+            self.monitor_replies[command] = (reply, loop.time())
+        return response
+
+    def forget_monitor_replies(self, set_command):
+        """
+        Drops the cached monitor reads a SET command makes stale
+        Reads of the SET's channel go, or every read of the board for a SET without a channel
+        :param set_command: CAEN CMD:SET command string
+        :return: None
+        """
+        set_fields = command_fields(set_command)
+        for command in list(self.monitor_replies):
+            fields = command_fields(command)
+            if fields.get("BD") != set_fields.get("BD"):
+                continue
+            if "CH" not in set_fields or fields.get("CH") == set_fields["CH"]:
+                del self.monitor_replies[command]
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        logging.info("connection from {}".format(client_address))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                if not command:
+                    continue
+                logging.debug("recieved {!r} from {}".format(command, client_address))
+                try:
+                    response = await self.query(command)
+                except Exception as error:
+                    logging.error("command {!r} failed: {}".format(command, error))
+                    response = "ERROR:{}".format(error)
+                writer.write(response.strip().encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            logging.info("{} disconnected".format(client_address))
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print("starting up on {} port {}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
 if __name__ == "__main__":
 
     # Set up loggers for DAQ
@@ -67,29 +176,5 @@ if __name__ == "__main__":
     root.setLevel(os.environ.get("LOGLEVEL", "INFO"))
     root.addHandler(handler)
 
-    # Set up socket server
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = (HOST_IP_ADDRESS, PORT)
-    print("starting up on {} port {}".format(*server_address))
-    sock.bind(server_address)
-    sock.listen(1)
-
-    caen = Caen_control()
-
-    while True:
-        print('waiting for connection')
-        connection, client_address = sock.accept()
-        try:
-            print("connection from {}".format(client_address))
-            while True:
-                data = connection.recv(2048)
-                print('recieved {!r}'.format(data))
-                if data:
-                    print('sending')
-                    response = caen.send_command(data.decode())
-                    connection.sendall(response.encode())
-                else:
-                    print("nodata")
-                    break
-        finally:
-            connection.close()
+    bridge = CaenBridge(Caen_control())
+    asyncio.run(bridge.serve(HOST_IP_ADDRESS, PORT))
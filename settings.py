@@ -0,0 +1,103 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+
+class SettingsCache(object):
+    """
+    Last known settings and read-back parameters of one instrument
+    A setting is only written when its value changes, and pending writes go
+    out together as one transaction. Read-backs such as the timebase are kept
+    until a setting that may change them is written; a setting drops every
+    read-back unless it names the ones it affects. Not thread safe, callers
+    sharing an instrument serialize access to it
+    """
+
+    def __init__(self, send):
+        """
+        Constructor for the cache
+        :param send: callable writing a list of commands as one transaction
+        """
+        self.send = send
+        self.state = {}
+        # key: (value, command), in the order the settings were made
+        self.pending = {}
+        self.readbacks = {}
+
+    def set(self, key, value, command, invalidates=None, force=False):
+        """
+        Queues a setting unless the instrument already has it
+        :param key: name of the setting, e.g. C1:TRIG_LEVEL
+        :param value: value compared against the last one written
+        :param command: command applying the setting
+        :param invalidates: read-back keys the setting changes, None for all
+        :param force: write even if unchanged, for settings that must always reach the instrument
+        :return: True if the setting was queued
+        """
+        if not force and key not in self.pending and key in self.state and self.state[key] == value:
+            return False
+        self.pending.pop(key, None)
+        self.pending[key] = (value, command)
+        if invalidates is None:
+            self.readbacks.clear()
+        else:
+            for readback_key in invalidates:
+                self.readbacks.pop(readback_key, None)
+        return True
+
+    def pending_commands(self):
+        """
+        Pending commands, for a caller sending them itself, e.g. ahead of an arm
+        :return: list of commands, empty if nothing is pending
+        """
+        return [command for _, command in self.pending.values()]
+
+    def mark_sent(self):
+        """
+        Records the pending settings as applied, once their write went through
+        :return: None
+        """
+        for key, (value, _) in self.pending.items():
+            self.state[key] = value
+        self.pending = {}
+
+    def flush(self):
+        """
+        Writes the pending settings in one transaction
+        :return: number of commands written
+        """
+        if not self.pending:
+            return 0
+        commands = self.pending_commands()
+        # A failed write leaves the settings pending, to be sent again
+        self.send(commands)
+        self.mark_sent()
+        return len(commands)
+
+    def read(self, key, fetch):
+        """
+        Cached read-back, fetched after writing any pending setting
+        :param key: name of the read-back, e.g. C2:HORIZ_INTERVAL
+        :param fetch: callable querying the instrument
+        :return: value of the read-back
+        """
+        if key not in self.readbacks:
+            self.flush()
+            self.readbacks[key] = fetch()
+        return self.readbacks[key]
+
+    def forget_readbacks(self):
+        """
+        Drops the read-backs only, so they are fetched again while the settings stay known
+        :return: None
+        """
+        self.readbacks.clear()
+
+    def forget(self):
+        """
+        Drops everything known about the instrument, for when it may have been changed by hand
+        Pending settings are kept
+        :return: None
+        """
+        self.state.clear()
+        self.readbacks.clear()
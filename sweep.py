@@ -0,0 +1,81 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+
+class SweepPoint(object):
+    """
+    One (bias voltage, trigger threshold) point of a sweep
+    """
+
+    def __init__(self, index, volt, trigger=None):
+        """
+        Constructor for a sweep point
+        :param index: position of the point in the sweep
+        :param volt: bias voltage in V, as written in the config
+        :param trigger: trigger threshold in mV, None to keep the scope setting
+        """
+        self.index = index
+        self.volt = volt
+        self.trigger = trigger
+
+    @property
+    def trigger_label(self):
+        """
+        Trigger part of the output file name
+        """
+        if self.trigger is None:
+            return "user"
+        return str(abs(float(self.trigger))) + "mV"
+
+    def __repr__(self):
+        return "SweepPoint({}, {}V, {})".format(self.index, self.volt, self.trigger_label)
+
+
+def plan_sweep(volt_list, trigger_list=None, keep_order=False):
+    """
+    Builds the full list of sweep points up front
+    Every distinct voltage is visited once, in order of increasing magnitude,
+    with all trigger values scanned at it, so the supply ramps once per voltage
+    and the total ramp distance from 0 V and back is as short as possible.
+    Repeated values are dropped, a second point would overwrite the file of the first
+    :param volt_list: bias voltages in V
+    :param trigger_list: trigger thresholds in mV, None to use the scope setting
+    :param keep_order: visit the voltages in the order given instead
+    :return: list of SweepPoints
+    """
+    volts = unique_values(volt_list, "voltages")
+    if not keep_order:
+        volts.sort(key=lambda volt: abs(float(volt)))
+
+    triggers = [None]
+    if trigger_list is not None:
+        triggers = unique_values(trigger_list, "trigger values")
+
+    plan = []
+    for volt in volts:
+        for trigger in triggers:
+            plan.append(SweepPoint(len(plan), volt, trigger))
+    print("Sweeping {} V{}".format(", ".join(volts), "" if trigger_list is None else
+                                   " with triggers {} mV at each".format(", ".join(triggers))))
+    return plan
+
+
+def unique_values(values, name):
+    """
+    Strips config list values and drops repeats, saying which were dropped
+    :param values: list of strings
+    :param name: what the values are, for the message
+    :return: list of distinct values in their first order
+    """
+    distinct = []
+    repeated = []
+    for value in values:
+        value = value.strip()
+        if value not in distinct:
+            distinct.append(value)
+        elif value not in repeated:
+            repeated.append(value)
+    if repeated:
+        print("Dropping repeated {} {}".format(name, ", ".join(repeated)))
+    return distinct
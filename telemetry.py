@@ -0,0 +1,226 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Per event stages, in the order an event passes through them
+EVENT_STAGES = ["arm_wait", "transfer", "parse", "features", "write"]
+STAGES = EVENT_STAGES + ["ramp"]
+
+
+class Histogram(object):
+    """
+    Log bucketed histogram of durations, BUCKETS_PER_DECADE buckets from
+    MIN_SECONDS up, so recording a value is a log and an increment
+    """
+    MIN_SECONDS = 1e-6
+    BUCKETS_PER_DECADE = 10
+    NUM_BUCKETS = 80
+
+    def __init__(self):
+        self.counts = np.zeros(self.NUM_BUCKETS + 1, dtype=np.int64)
+        self.total = 0.
+        self.minimum = float("inf")
+        self.maximum = 0.
+
+    @classmethod
+    def upper_edges(cls):
+        """
+        Upper edge in s of every bucket, the last one is open ended
+        """
+        edges = cls.MIN_SECONDS * 10 ** (np.arange(cls.NUM_BUCKETS) / float(cls.BUCKETS_PER_DECADE))
+        return np.append(edges, float("inf"))
+
+    def record(self, seconds):
+        if seconds > self.MIN_SECONDS:
+            idx = min(int(math.log10(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_DECADE) + 1, self.NUM_BUCKETS)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, fraction):
+        """
+        Upper bucket edge below which the given fraction of the values lie
+        :param fraction: 0-1
+        :return: float duration in s, clipped to the largest value seen
+        """
+        if not self.count:
+            return 0.
+        idx = int(np.searchsorted(np.cumsum(self.counts), fraction * self.count))
+        return min(float(self.upper_edges()[idx]), self.maximum)
+
+    def summary(self):
+        count = self.count
+        return {
+            "count": count,
+            "total": self.total,
+            "mean": self.total / count if count else 0.,
+            "min": self.minimum if count else 0.,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.maximum,
+        }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the run histograms in Prometheus text format on /metrics
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.telemetry.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Telemetry(object):
+    """
+    Timing of every acquisition stage, per sweep point and for the whole run
+    Event stages are arm/wait (until the scope starts replying), transfer,
+    parse, feature extraction with ROI windowing, and write; the HV ramp is timed once per point. The stage with the
+    most time tells whether a run is bound by the trigger, network, CPU or disk
+    """
+
+    def __init__(self, metrics_filename=None, port=0):
+        """
+        Constructor for the telemetry collector
+        :param metrics_filename: JSON file rewritten after every point, None to skip
+        :param port: localhost port for the Prometheus endpoint, 0 to disable
+        """
+        self.metrics_filename = metrics_filename
+        self.point_histograms = {stage: Histogram() for stage in STAGES}
+        self.run_histograms = {stage: Histogram() for stage in STAGES}
+        self.points = []
+        self.point_label = None
+        self.num_events = 0
+        self.server = None
+        self.lock = threading.Lock()
+        if port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.telemetry = self
+            threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+            print("Serving metrics on http://127.0.0.1:{}/metrics".format(port))
+
+    def record(self, stage, seconds):
+        """
+        Adds one duration, safe to call from any acquisition thread
+        :param stage: one of STAGES
+        :param seconds: duration in s
+        :return: None
+        """
+        with self.lock:
+            self.point_histograms[stage].record(seconds)
+
+    def start_point(self, label):
+        """
+        Starts collecting a sweep point, before its HV ramp
+        :param label: point name stored with the summary
+        :return: None
+        """
+        self.point_label = label
+
+    def end_point(self, num_events, elapsed):
+        """
+        Prints and stores the summary of the point, then folds it into the run totals
+        :param num_events: events acquired at the point
+        :param elapsed: acquisition time of the point in s, without the ramp
+        :return: dict summary of the point
+        """
+        stages = {stage: self.point_histograms[stage].summary() for stage in STAGES}
+        busiest = max(EVENT_STAGES, key=lambda stage: stages[stage]["total"])
+        point = {
+            "point": self.point_label,
+            "events": num_events,
+            "seconds": elapsed,
+            "events_per_s": num_events / elapsed if elapsed else 0.,
+            "bound_by": busiest,
+            "stages": stages,
+        }
+        self.points.append(point)
+        self.num_events += num_events
+
+        print("{:.1f} events/s, bound by {}".format(point["events_per_s"], busiest))
+        for stage in STAGES:
+            summary = stages[stage]
+            if summary["count"]:
+                print("  {:<9} n={:<7d} mean={:9.3f} ms p50={:9.3f} ms p99={:9.3f} ms total={:8.2f} s".format(
+                    stage, summary["count"], summary["mean"] * 1e3, summary["p50"] * 1e3, summary["p99"] * 1e3,
+                    summary["total"]))
+
+        with self.lock:
+            for stage in STAGES:
+                self.run_histograms[stage].merge(self.point_histograms[stage])
+                self.point_histograms[stage] = Histogram()
+        if self.metrics_filename:
+            self.write()
+        return point
+
+    def write(self):
+        """
+        Writes per point summaries and the run histograms to the metrics file
+        :return: None
+        """
+        with open(self.metrics_filename, "w") as metrics_file:
+            json.dump({
+                "points": self.points,
+                "run": {stage: self.run_histograms[stage].summary() for stage in STAGES},
+                # The last count of every histogram is the overflow bucket above the last edge
+                "bucket_upper_edges": Histogram.upper_edges()[:-1].tolist(),
+                "histograms": {stage: self.run_histograms[stage].counts.tolist() for stage in STAGES},
+            }, metrics_file, indent=2)
+
+    def prometheus(self):
+        """
+        Formats the run histograms, including the point in progress, for Prometheus
+        :return: exposition text
+        """
+        lines = ["# TYPE thorium_stage_seconds histogram"]
+        edges = Histogram.upper_edges()
+        for stage in STAGES:
+            histogram = Histogram()
+            histogram.merge(self.run_histograms[stage])
+            histogram.merge(self.point_histograms[stage])
+            for edge, count in zip(edges, np.cumsum(histogram.counts)):
+                lines.append('thorium_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, "+Inf" if math.isinf(edge) else "{:.3g}".format(edge), count))
+            lines.append('thorium_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.total))
+            lines.append('thorium_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+        lines.append("# TYPE thorium_points_completed counter")
+        lines.append("thorium_points_completed {}".format(len(self.points)))
+        lines.append("# TYPE thorium_events_completed counter")
+        lines.append("thorium_events_completed {}".format(self.num_events))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
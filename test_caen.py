@@ -17,6 +17,10 @@ class TestCaen(TestCase):
     def test_check_return_status(self):
         self.assertTrue(self.caen_test_runner.check_return_status("brd:cmd:ok"))
 
+    def test_decode_status(self):
+        self.assertEqual(self.caen_test_runner.decode_status(3), ["ON", "RAMP UP"])
+        self.assertEqual(self.caen_test_runner.decode_status(0), [])
+
     def test_setup_channel(self):
         self.assertIn("19", self.caen_test_runner.setup_channel(1, 19))
         self.assertIn("1", self.caen_test_runner.setup_channel("1", "19"))
@@ -0,0 +1,61 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from converter import convert_file
+from reader import RunCatalog
+
+
+def write_dump(filename, lines):
+    with open(filename, "w") as dump_file:
+        dump_file.write("".join(line + "\n" for line in lines))
+
+
+class TestConverter(TestCase):
+    """
+    Class for testing the text dump converter
+    """
+
+    def test_npy_round_trip(self):
+        lines = []
+        for event_idx in range(3):
+            for channel in (1, 3):
+                lines += ["CHANNEL:{}".format(channel), "DT:1e-10"]
+                lines += ["{},{}".format(-2e-10 + idx * 1e-10, 1e-3 * (event_idx + channel + idx)) for idx in range(6)]
+            lines.append("")
+        with tempfile.TemporaryDirectory() as directory:
+            write_dump(os.path.join(directory, "dump.txt"), lines)
+            output_filename, num_events = convert_file(os.path.join(directory, "dump.txt"),
+                                                       os.path.join(directory, "out"), backend="npy")
+            self.assertEqual(num_events, 3)
+
+            os.rename(output_filename, os.path.join(directory, "out", "run_user_trig_30V"))
+            point = RunCatalog(os.path.join(directory, "out")).points[0]
+            self.assertEqual((point.events, point.channels), (3, [1, 3]))
+            chunk = next(point.iterate(chunk_events=3))
+            np.testing.assert_allclose(chunk["w3"], 1e-3 * (np.arange(3)[:, None] + 3 + np.arange(6)), atol=1e-6)
+            np.testing.assert_allclose(chunk["t1"][1], -2e-10 + np.arange(6) * 1e-10)
+
+    def test_samples_before_header(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_dump(os.path.join(directory, "dump.txt"), ["0,0.1", "CHANNEL:1", "0,0.1", "1e-10,0.2", ""])
+            with self.assertRaisesRegex(ValueError, r"dump.txt:1: samples before any CHANNEL: header"):
+                convert_file(os.path.join(directory, "dump.txt"), backend="npy")
+
+    def test_channel_first_seen_later(self):
+        lines = ["CHANNEL:1", "0,0.001", "1e-10,0.002", ""]
+        lines += ["CHANNEL:1", "0,0.003", "1e-10,0.004", "CHANNEL:4", "0,-0.001", "1e-10,-0.002", ""]
+        with tempfile.TemporaryDirectory() as directory:
+            write_dump(os.path.join(directory, "dump.txt"), lines)
+            output_filename, num_events = convert_file(os.path.join(directory, "dump.txt"), backend="npy")
+            os.rename(output_filename, os.path.join(directory, "run_user_trig_30V"))
+            point = RunCatalog(directory).points[0]
+            self.assertEqual((num_events, point.channels), (2, [1, 4]))
+            chunk = next(point.iterate(branches=("w",)))
+            np.testing.assert_allclose(chunk["w4"], [[0., 0.], [-1e-3, -2e-3]], atol=1e-9)
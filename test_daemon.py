@@ -0,0 +1,119 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+import socket
+import tempfile
+import threading
+from queue import Queue
+from unittest import TestCase
+
+from daemon import DaqDaemon, send_request, submit_job
+from monitor import CurrentMonitor
+from settings import SettingsCache
+from thorium import DaqRunner
+
+# Empty scope ip runs against a local scope emulator
+JOB_CONFIG = """
+[daq]
+events = 20
+backend = npy
+
+[lecroy]
+ip =
+read_ch1 = no
+read_ch2 = yes
+read_ch3 = no
+read_ch4 = no
+scan_trigger = no
+transfer = binary
+
+[caen]
+use = no
+ip =
+step_channel = 2
+volts = {}
+"""
+
+
+class BrokenScope(object):
+    """
+    Scope whose link drops during setup
+    """
+
+    def __init__(self):
+        self.settings = SettingsCache(lambda commands: None)
+
+    def setup_binary_transfer(self):
+        raise ConnectionError("Scope closed the VICP connection")
+
+
+class IdleCaen(object):
+    def status_check(self, channel):
+        return "ON"
+
+    def monitor(self, channel=None):
+        return {"vmon": 0., "imon": 0.}
+
+
+class BrokenInstruments(object):
+    """
+    InstrumentPool stand-in handing out an IdleCaen and a BrokenScope
+    """
+
+    def caen(self, ip_address, channel):
+        return IdleCaen()
+
+    def scope(self, ip_address):
+        return BrokenScope()
+
+
+class TestDaemon(TestCase):
+    """
+    Class for testing queued sweeps on a DAQ daemon
+    """
+
+    def test_jobs_share_instruments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, "daq.sock")
+            daq_daemon = DaqDaemon(socket_path, Queue())
+            daemon_thread = threading.Thread(target=daq_daemon.run)
+            daemon_thread.start()
+            try:
+                for job_idx, volts in enumerate(("30", "40,50")):
+                    config_filename = os.path.join(directory, "job{}.ini".format(job_idx))
+                    with open(config_filename, "w") as config_file:
+                        config_file.write(JOB_CONFIG.format(volts))
+                    reply = submit_job(config_filename, os.path.join(directory, "run{}".format(job_idx)), socket_path)
+                    self.assertEqual(reply["job"], job_idx + 1)
+                self.assertIn("error", send_request({"command": "submit", "config": "[daq]", "outfile": "x"},
+                                                    socket_path))
+                self.assertTrue(send_request({"command": "shutdown"}, socket_path)["shutdown"])
+                daemon_thread.join(60)
+            finally:
+                if daemon_thread.is_alive():
+                    daq_daemon.job_queue.put(None)
+                    daemon_thread.join()
+
+            self.assertEqual([job["state"] for job in daq_daemon.jobs], ["done", "done"])
+            for name in ("run0_user_trig_30V", "run1_user_trig_40V", "run1_user_trig_50V"):
+                self.assertTrue(os.path.exists(os.path.join(directory, name, "w2.npy")))
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_failed_setup_releases_run(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        metrics_port = probe.getsockname()[1]
+        probe.close()
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(ConnectionError):
+                DaqRunner("", 10, [False, True, False, False], os.path.join(directory, "run"), Queue(), "", ["30"],
+                          "2", True, None, transfer="binary", monitor_rate=100., metrics_port=metrics_port,
+                          instruments=BrokenInstruments())
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if isinstance(thread, CurrentMonitor) and thread.is_alive()])
+        # The metrics port is free for the next job
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", metrics_port))
+        probe.close()
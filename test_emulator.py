@@ -0,0 +1,104 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from unittest import TestCase
+
+from caen import Caen
+from emulator import CaenEmulator, ScopeEmulator
+from lecroy import Oscilloscope
+from settings import SettingsCache
+
+
+class TestEmulator(TestCase):
+    """
+    Class for testing the DAQ drivers against the local emulators
+    """
+
+    def test_scope_binary_and_text(self):
+        emulator = ScopeEmulator(port=0, record_length=500)
+        emulator.start()
+        scope = Oscilloscope("127.0.0.1:{}".format(emulator.port))
+        try:
+            scope.setup_binary_transfer()
+            descs = [None, scope.get_wavedesc(2), None, None]
+            self.assertAlmostEqual(descs[1]["horiz_interval"], 5e-11)
+            event = scope.get_waveforms(descs)
+            self.assertEqual(len(event[1]), 500)
+            self.assertIsNone(event[0])
+            self.assertIn("HORIZ_INTERVAL", scope.inst.query("C2:INSPECT? HORIZ_INTERVAL"))
+            self.assertTrue(scope.inst.query("ARM; WAIT;C2:INSPECT? SIMPLE;").startswith('C2:INSP "'))
+        finally:
+            scope.close()
+            emulator.stop()
+
+    def test_scope_settings_cache(self):
+        emulator = ScopeEmulator(port=0, record_length=500)
+        emulator.start()
+        scope = Oscilloscope("127.0.0.1:{}".format(emulator.port))
+        try:
+            scope.setup_binary_transfer()
+            desc = scope.get_wavedesc(2)
+            self.assertAlmostEqual(scope.get_horiz_interval(2), 5e-11)
+            num_messages = emulator.num_messages
+            # Cached read-backs, an unchanged setup and trigger settings waiting for the arm cost no transaction
+            self.assertIs(scope.get_wavedesc(2), desc)
+            scope.get_horiz_interval(2)
+            scope.setup_binary_transfer()
+            scope.arm_trigger("1", "NEG", "-0.05")
+            self.assertEqual(emulator.num_messages, num_messages)
+            scope.read_event([None, desc, None, None])
+            self.assertEqual(emulator.num_messages, num_messages + 1)
+            scope.arm_trigger("1", "NEG", "-0.05")
+            self.assertEqual(scope.settings.pending, {})
+            self.assertIs(scope.get_wavedesc(2), desc)
+            # A channel scale change drops the descriptor of its channel only
+            scope.configure_channel(2, 0.05)
+            scope.get_horiz_interval(2)
+            self.assertIsNot(scope.get_wavedesc(2), desc)
+            desc = scope.get_wavedesc(2)
+            # Sequence mode changes every descriptor
+            scope.setup_sequence(4)
+            self.assertIsNot(scope.get_wavedesc(2), desc)
+            # Front panel changes are picked up once the read-backs are dropped
+            num_messages = emulator.num_messages
+            scope.settings.forget_readbacks()
+            scope.get_wavedesc(2)
+            scope.get_horiz_interval(2)
+            self.assertEqual(emulator.num_messages, num_messages + 2)
+        finally:
+            scope.close()
+            emulator.stop()
+
+    def test_failed_write_stays_pending(self):
+        sent = []
+
+        def send(commands):
+            sent.append(commands)
+            if len(sent) == 1:
+                raise ConnectionError("link down")
+
+        settings = SettingsCache(send)
+        settings.set("C1:TRIG_LEVEL", -0.05, "C1:TRig_LeVel -0.05V")
+        with self.assertRaises(ConnectionError):
+            settings.flush()
+        self.assertNotIn("C1:TRIG_LEVEL", settings.state)
+        settings.set("C1:TRIG_LEVEL", -0.05, "C1:TRig_LeVel -0.05V")
+        self.assertEqual(settings.flush(), 1)
+        self.assertEqual(settings.state["C1:TRIG_LEVEL"], -0.05)
+        self.assertFalse(settings.set("C1:TRIG_LEVEL", -0.05, "C1:TRig_LeVel -0.05V"))
+
+    def test_caen_ramp(self):
+        emulator = CaenEmulator(port=0, ramp_rate=100.)
+        emulator.start()
+        caen = Caen("127.0.0.1:{}".format(emulator.port), "1")
+        try:
+            caen.enable_output("1")
+            caen.set_output("1", "20")
+            self.assertIn("RAMP UP", caen.monitor("1")["status"])
+            self.assertTrue(caen.wait_for_ramp("1", "0", "20", poll_interval=0.05))
+            self.assertAlmostEqual(caen.read_voltage("1"), 20.)
+            self.assertFalse(caen.overcurrent())
+        finally:
+            caen.close()
+            emulator.stop()
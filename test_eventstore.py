@@ -0,0 +1,49 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from eventstore import EventStore
+from waveform import Waveform
+
+
+def make_event(value, num_samples=16):
+    wfm = Waveform(dt=1e-10, codes=np.full(num_samples, value, dtype=np.int16), gain=1e-3, horiz_offset=-1e-9)
+    wfm.trigger_time = value * 1e-3
+    return [None, wfm, None, None]
+
+
+class TestEventStore(TestCase):
+    """
+    Class for testing the preallocated event store
+    """
+
+    def test_reuse_and_grow(self):
+        store = EventStore([False, True, False, False], 4)
+        store.add([make_event(1), make_event(2)])
+        samples = store.samples[1]
+        store.clear()
+        store.add([make_event(3)])
+        # The next point fills the same arrays
+        self.assertIs(store.samples[1], samples)
+        # A longer record grows the arrays and keeps the stored events
+        store.add([make_event(4, 32)])
+        events = list(store)
+        self.assertEqual([len(event[1]) for event in events], [16, 32])
+        self.assertEqual(events[0][1].codes[0], 3)
+        self.assertAlmostEqual(events[1][1].trigger_time, 4e-3)
+        self.assertIsNone(events[0][0])
+        store.close()
+
+    def test_spill_to_disk(self):
+        store = EventStore([False, True, False, False], 4, memory_limit=64)
+        store.add([make_event(5)])
+        spill_filename = store.spill_files[0]
+        self.assertIsInstance(store.samples[1], np.memmap)
+        np.testing.assert_allclose(store.event(0)[1].volts, 5e-3)
+        store.close()
+        self.assertFalse(os.path.exists(spill_filename))
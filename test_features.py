@@ -0,0 +1,46 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from unittest import TestCase
+
+import numpy as np
+
+from features import FeatureExtractor
+from waveform import Waveform
+
+
+def make_pulse(amplitude=0.2, peak=500, sigma=10., baseline=0.01, dt=5e-11, num_samples=1000):
+    """
+    Negative gaussian pulse on a flat baseline
+    """
+    samples = np.arange(num_samples)
+    return Waveform(baseline - amplitude * np.exp(-0.5 * ((samples - peak) / sigma) ** 2), dt=dt)
+
+
+class TestFeatures(TestCase):
+    """
+    Class for testing online feature extraction
+    """
+
+    def test_gaussian_pulse(self):
+        extractor = FeatureExtractor(cfd_fraction=0.5, baseline_samples=100)
+        features = extractor.extract([[None, make_pulse(), None, None]], [False, True, False, False])[0]
+        self.assertAlmostEqual(features["baseline2"], 0.01)
+        self.assertAlmostEqual(features["amplitude2"], 0.2)
+        self.assertAlmostEqual(features["peak_time2"], 500 * 5e-11)
+        # Half maximum of a gaussian sits sqrt(2 ln 2) sigma before the peak
+        self.assertAlmostEqual(features["cfd_time2"], (500 - np.sqrt(2 * np.log(2)) * 10.) * 5e-11, delta=5e-12)
+        # 10-90% rise of a gaussian edge is (sqrt(2 ln 10) - sqrt(2 ln 10/9)) sigma
+        self.assertAlmostEqual(features["rise_time2"],
+                               (np.sqrt(2 * np.log(10)) - np.sqrt(2 * np.log(10 / 9.))) * 10. * 5e-11, delta=5e-12)
+        self.assertAlmostEqual(features["charge2"], 0.2 * np.sqrt(2 * np.pi) * 10. * 5e-11 / 50., delta=1e-15)
+
+    def test_missing_records(self):
+        extractor = FeatureExtractor()
+        events = [[None, make_pulse(), None, None], [None, None, make_pulse(0.1), None]]
+        summaries = extractor.extract(events, [False, True, True, False])
+        self.assertEqual(list(summaries[0]), list(summaries[1]))
+        self.assertTrue(np.isnan(summaries[0]["amplitude3"]))
+        self.assertTrue(np.isnan(summaries[1]["amplitude2"]))
+        self.assertAlmostEqual(summaries[1]["amplitude3"], 0.1)
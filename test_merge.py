@@ -0,0 +1,109 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+import tempfile
+import time
+from queue import Queue
+from unittest import TestCase, mock
+
+import numpy as np
+
+from eventlog import EventLog
+from merge import EventMerger
+from telemetry import Telemetry
+from thorium import DaqRunner
+from waveform import Waveform
+
+
+def make_event(timestamp):
+    wfm = Waveform(codes=np.zeros(10, dtype=np.int16), gain=1e-3, dt=1e-10)
+    wfm.timestamp = timestamp
+    return [wfm, None, None, None]
+
+
+def merging_runner(output_filename, read_event):
+    """
+    DaqRunner for two binary scopes without instruments, reading events from read_event(scope_idx)
+    """
+    runner = DaqRunner.__new__(DaqRunner)
+    runner.scopes = [None, None]
+    runner.channels = [True, False, False, False] * 2
+    runner.num_events = 50
+    runner.segments = 1
+    runner.transfer = "binary"
+    runner.pipeline_workers = 1
+    runner.queue_depth = 4
+    runner.merge_tolerance = 1e-5
+    runner.scope_dts = [1e-10, 1e-10]
+    runner.scope_descs = [[None] * 4, [None] * 4]
+    runner.stop_queue = Queue()
+    runner.use_caen = False
+    runner.backend = "npy"
+    runner.writer_options = {}
+    runner.output_filename = output_filename
+    runner.extractor = None
+    runner.roi = None
+    runner.preview = None
+    runner.telemetry = Telemetry()
+    runner.event_log = EventLog(50)
+    runner.point_events = 0
+    runner.read_event = read_event
+    return runner
+
+
+class TestMerge(TestCase):
+    """
+    Class for testing event merging across scopes
+    """
+
+    def test_offset_and_missed_triggers(self):
+        triggers = np.cumsum(np.random.default_rng(0).exponential(1e-3, 20))
+        # The second scope's clock runs 3 s ahead, it armed late and missed trigger 0 and 7
+        merger = EventMerger(2, 1e-5, calibration_events=4)
+        merger.push(0, [make_event(stamp) for stamp in triggers])
+        merger.push(1, [make_event(stamp + 3.) for idx, stamp in enumerate(triggers) if idx not in (0, 7)])
+        merged = merger.pop_merged()
+        self.assertEqual(len(merged), 18)
+        self.assertEqual(merger.num_dropped, [2, 0])
+        self.assertEqual(len(merged[0]), 8)
+        self.assertAlmostEqual(merged[0][4].timestamp - merged[0][0].timestamp, 3.)
+        self.assertAlmostEqual(merged[1][0].trigger_time, triggers[2] - triggers[1])
+
+    def test_waits_for_every_stream(self):
+        merger = EventMerger(2, 1e-5, calibration_events=1)
+        merger.push(0, [make_event(1.), make_event(2.)])
+        self.assertEqual(merger.pop_merged(), [])
+        merger.push(1, [make_event(1.)])
+        self.assertEqual(len(merger.pop_merged()), 1)
+        self.assertEqual(len(merger.pending[0]), 1)
+
+    def test_failed_scope_stops_merge(self):
+        reads = [0, 0]
+
+        def read_event(scope_idx):
+            reads[scope_idx] += 1
+            if scope_idx == 1 and reads[1] > 3:
+                raise ConnectionError("scope 2 timed out")
+            return [make_event(reads[scope_idx] * 1e-3)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            runner = merging_runner(os.path.join(directory, "run"), read_event)
+            # Readouts are already events here, skip the decoding
+            with mock.patch("thorium.decode_timed", lambda raw_event, *args: (raw_event, None, 0., 0.)):
+                with self.assertRaises(ConnectionError):
+                    runner.get_events_merged("user", "0")
+            self.assertLess(runner.point_events, 50)
+
+    def test_stopped_scope_ends_merge(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def read_event(scope_idx):
+                if scope_idx == 1 and runner.event_log.num_rows >= 3:
+                    runner.stop_queue.put("STOP")
+                return [make_event(time.monotonic())]
+
+            runner = merging_runner(os.path.join(directory, "run"), read_event)
+            with mock.patch("thorium.decode_timed", lambda raw_event, *args: (raw_event, None, 0., 0.)):
+                runner.get_events_merged("user", "0")
+            self.assertLess(runner.point_events, 50)
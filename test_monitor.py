@@ -0,0 +1,87 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import time
+from queue import Queue
+from unittest import TestCase
+
+from monitor import CurrentMonitor
+
+
+class FakeCaen(object):
+    """
+    Records set_output calls, optionally failing them
+    """
+
+    def __init__(self, fail_set=False):
+        self.fail_set = fail_set
+        self.outputs = []
+        self.num_reads = 0
+
+    def monitor(self, channel=None):
+        self.num_reads += 1
+        if self.num_reads == 1:
+            raise RuntimeError("garbled reply")
+        return {"vmon": 100., "imon": 1e-9}
+
+    def set_output(self, channel, voltage):
+        self.outputs.append((channel, voltage))
+        if self.fail_set:
+            raise SystemError("Invalid command")
+        return True
+
+
+class TestMonitor(TestCase):
+    """
+    Class for testing the HV current monitor
+    """
+
+    def test_trip_stops_and_ramps_down(self):
+        caen = FakeCaen()
+        stop_queue = Queue()
+        monitor = CurrentMonitor(caen, "2", stop_queue, buffer_size=8, di_dt_thresh=1e-6)
+        monitor.armed.set()
+        monitor.record(0., 100., 1e-9)
+        monitor.record(0.1, 100., 1.05e-9)
+        self.assertTrue(stop_queue.empty())
+        # 1 uA in 0.1 s is 1e-5 A/s
+        monitor.record(0.2, 100., 1e-6)
+        self.assertEqual(stop_queue.get_nowait(), "STOP")
+        self.assertEqual(caen.outputs, [("2", "0")])
+        self.assertFalse(monitor.armed.is_set())
+
+    def test_failed_ramp_down_still_stops(self):
+        stop_queue = Queue()
+        monitor = CurrentMonitor(FakeCaen(fail_set=True), "2", stop_queue, di_dt_thresh=1e-6)
+        monitor.armed.set()
+        monitor.record(0., 100., 0.)
+        monitor.record(0.1, 100., 1e-6)
+        self.assertEqual(stop_queue.get_nowait(), "STOP")
+        self.assertTrue(monitor.tripped.is_set())
+
+    def test_disarmed_ramp_does_not_trip(self):
+        caen = FakeCaen()
+        stop_queue = Queue()
+        monitor = CurrentMonitor(caen, "2", stop_queue, di_dt_thresh=1e-6)
+        monitor.record(0., 0., 0.)
+        monitor.record(0.1, 50., 1e-6)
+        self.assertTrue(stop_queue.empty())
+        self.assertEqual(caen.outputs, [])
+
+    def test_ring_buffer_wraps_in_order(self):
+        monitor = CurrentMonitor(FakeCaen(), "2", Queue(), buffer_size=4)
+        for sample_idx in range(10):
+            monitor.record(float(sample_idx), 100., sample_idx * 1e-9)
+        latest = monitor.latest(6)
+        self.assertEqual(latest[:, 0].tolist(), [6., 7., 8., 9.])
+        self.assertAlmostEqual(monitor.read_current(), 9e-9)
+
+    def test_sampling_survives_errors(self):
+        monitor = CurrentMonitor(FakeCaen(), "2", Queue(), rate=200.)
+        monitor.start()
+        deadline = time.monotonic() + 5.
+        while not len(monitor.latest()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        monitor.stop()
+        self.assertEqual(len(monitor.latest()), 1)
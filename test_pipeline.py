@@ -0,0 +1,107 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from queue import Queue
+from unittest import TestCase, mock
+
+import numpy as np
+
+from eventlog import EventLog
+from telemetry import Telemetry
+from thorium import DaqRunner
+from waveform import Waveform
+
+
+class FailingWriter(object):
+    def __init__(self, *args, **kwargs):
+        self.num_filled = 0
+        self.closed = False
+
+    def fill(self, event, event_info=None):
+        self.num_filled += 1
+        if self.num_filled > 2:
+            raise OSError("disk full")
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingWriter(object):
+    def __init__(self, *args, **kwargs):
+        self.event_numbers = []
+
+    def fill(self, event, event_info=None):
+        self.event_numbers.append(int(event_info["event"]))
+
+    def close(self):
+        pass
+
+
+def pipeline_runner():
+    """
+    DaqRunner set up for a pipelined point without instruments, reading 100 single channel events
+    """
+    runner = DaqRunner.__new__(DaqRunner)
+    runner.channels = [True, False, False, False]
+    runner.num_events = 100
+    runner.segments = 1
+    runner.transfer = "binary"
+    runner.pipeline_workers = 1
+    runner.queue_depth = 2
+    runner.dt = 1e-10
+    runner.channel_descs = [None] * 4
+    runner.stop_queue = Queue()
+    runner.use_caen = False
+    runner.backend = "npy"
+    runner.writer_options = {}
+    runner.output_filename = "unused"
+    runner.extractor = None
+    runner.roi = None
+    runner.preview = None
+    runner.telemetry = Telemetry()
+    runner.event_log = EventLog(100)
+    runner.point_events = 0
+    runner.read_event = lambda: [[Waveform(codes=np.zeros(10, dtype=np.int16), gain=1e-3), None, None, None]]
+    return runner
+
+
+class TestPipeline(TestCase):
+    """
+    Class for testing pipelined acquisition
+    """
+
+    def test_writer_failure_stops_acquisition(self):
+        runner = pipeline_runner()
+        writers = []
+
+        def open_failing_writer(*args, **kwargs):
+            writers.append(FailingWriter())
+            return writers[-1]
+
+        # Readouts are already events here, skip the decoding
+        with mock.patch("thorium.decode_timed", lambda raw_event, *args: (raw_event, None, 0., 0.)), \
+                mock.patch("thorium.open_writer", open_failing_writer):
+            with self.assertRaises(OSError):
+                runner.get_events_pipelined("user", "0")
+        self.assertLess(runner.point_events, 100)
+        self.assertTrue(writers[0].closed)
+
+    def test_last_sequence_readout_trimmed(self):
+        runner = pipeline_runner()
+        runner.num_events = 10
+        runner.segments = 3
+        runner.event_log = EventLog(10)
+        wfm = Waveform(codes=np.zeros(10, dtype=np.int16), gain=1e-3)
+        runner.read_event = lambda: [[wfm, None, None, None]] * 3
+        writers = []
+
+        def open_recording_writer(*args, **kwargs):
+            writers.append(RecordingWriter())
+            return writers[-1]
+
+        with mock.patch("thorium.decode_timed", lambda raw_event, *args: (raw_event[:args[-1]], None, 0., 0.)), \
+                mock.patch("thorium.open_writer", open_recording_writer):
+            runner.get_events_pipelined("user", "0")
+        self.assertEqual(runner.point_events, 10)
+        self.assertEqual(writers[0].event_numbers, list(range(10)))
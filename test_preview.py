@@ -0,0 +1,42 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from preview import PreviewBuffer, PreviewReader
+from waveform import Waveform
+
+
+class TestPreview(TestCase):
+    """
+    Class for testing the shared memory live preview
+    """
+
+    def test_ring_and_histograms(self):
+        name = "thorium_test_{}".format(os.getpid())
+        preview = PreviewBuffer([False, True, False, False], name=name, num_slots=4, num_bins=10,
+                                amplitude_range=(0., 1.))
+        events = []
+        for event_idx in range(6):
+            codes = np.zeros(20, dtype=np.int16)
+            codes[5] = -(event_idx + 1) * 100
+            events.append([None, Waveform(codes=codes, gain=1e-3, dt=1e-10), None, None])
+        preview.publish(events)
+        try:
+            reader = PreviewReader(name)
+            latest = reader.latest(10)
+            # Only the ring size is kept
+            self.assertEqual([event_number for event_number, _ in latest], [2, 3, 4, 5])
+            times, volts = latest[-1][1][1]
+            self.assertIsNone(latest[-1][1][0])
+            self.assertAlmostEqual(volts[5], -0.6, places=6)
+            self.assertAlmostEqual(times[1] - times[0], 1e-10)
+            edges, counts = reader.histograms()
+            np.testing.assert_array_equal(counts[1], [0, 1, 1, 1, 1, 1, 1, 0, 0, 0])
+            reader.close()
+        finally:
+            preview.close()
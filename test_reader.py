@@ -0,0 +1,149 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import importlib.util
+import os
+import tempfile
+from unittest import TestCase, mock, skipUnless
+
+import numpy as np
+
+from reader import RunCatalog
+from waveform import Waveform
+from writer import Hdf5Writer, NpyWriter, open_writer
+
+
+def write_windowed_point(directory, backend, schema):
+    """
+    Writes a point of three windowed records starting at different samples, with a pretrigger offset
+    :return: RunPoint of the file
+    """
+    writer = open_writer(backend, os.path.join(directory, "{}_{}_user_trig_30V".format(backend, schema)),
+                         [False, True, False, False], 8, schema=schema, windowed=True)
+    for event_idx in range(3):
+        wfm = Waveform(codes=np.arange(40, dtype=np.int16), gain=1e-3, dt=1e-10, horiz_offset=-5e-9)
+        writer.fill([None, wfm.window(10 * event_idx, 10 * event_idx + 8), None, None])
+    writer.close()
+    return [point for point in RunCatalog(directory).points if point.run == "{}_{}".format(backend, schema)][0]
+
+
+class TestReader(TestCase):
+    """
+    Class for testing the run catalog and chunked reads
+    """
+
+    def test_catalog_and_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for volt in ("30", "40"):
+                writer = NpyWriter(os.path.join(directory, "run_50.0mV_trig_{}V".format(volt)),
+                                   [False, True, False, False])
+                for event_idx in range(5):
+                    writer.fill([None, Waveform(codes=np.full(8, event_idx, dtype=np.int16), gain=1e-3, dt=1e-10,
+                                                horiz_offset=-4e-10), None, None])
+                writer.close()
+            with open(os.path.join(directory, "run_currents.csv"), "w") as currents_file:
+                for volt in ("30", "40"):
+                    for label in ("Begin", "Middle", "End"):
+                        currents_file.write("{},{},{}e-9\n".format(label, volt, volt))
+
+            catalog = RunCatalog(directory)
+            self.assertEqual([point.volt for point in catalog.points], [30., 40.])
+            point = catalog.select(volt="40", trigger="-50")[0]
+            self.assertEqual((point.events, point.channels, point.trigger), (5, [2], 50.))
+            self.assertAlmostEqual(point.currents["End"], 40e-9)
+
+            chunks = list(point.iterate(chunk_events=2))
+            self.assertEqual([len(chunk["w2"]) for chunk in chunks], [2, 2, 1])
+            np.testing.assert_allclose(chunks[1]["w2"][:, 0], [2e-3, 3e-3])
+            np.testing.assert_allclose(chunks[0]["t2"][0, :2], [-4e-10, -3e-10])
+            event_info = np.load(os.path.join(point.filename, "event_info.npy"))
+            np.testing.assert_array_equal(event_info["event"], np.arange(5))
+            with self.assertRaises(KeyError):
+                next(point.iterate(channels=[3]))
+
+    def test_compressed_hdf5(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "run_user_trig_30V.h5")
+            writer = Hdf5Writer(filename, [True, True, False, False], chunk_events=4, compression="zlib",
+                                compression_level=6)
+            for event_idx in range(10):
+                codes = Waveform(codes=np.full(8, event_idx, dtype=np.int16), gain=1e-3)
+                # Channel 1 only triggers from the third event on
+                writer.fill([codes if event_idx >= 2 else None, codes, None, None])
+            writer.close()
+
+            point = RunCatalog(directory).points[0]
+            self.assertEqual((point.backend, point.events, point.channels), ("hdf5", 10, [1, 2]))
+            chunk = next(point.iterate(chunk_events=10))
+            np.testing.assert_allclose(chunk["w1"][:, 0], np.r_[0., 0., np.arange(2, 10)] * 1e-3)
+            np.testing.assert_allclose(chunk["w2"][:, 0], np.arange(10) * 1e-3)
+            with self.assertRaises(ValueError):
+                NpyWriter(os.path.join(directory, "npy"), [True, False, False, False], compression="lz4")
+
+    def test_hdf5_flushes_whole_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Without hdf5plugin lz4 falls back to gzip
+            with mock.patch.dict("sys.modules", {"hdf5plugin": None}):
+                writer = Hdf5Writer(os.path.join(directory, "run_user_trig_30V.h5"), [True, False, False, False],
+                                    chunk_events=4, compression="lz4", auto_flush=6)
+            self.assertEqual(writer.dataset_options["compression"], "gzip")
+            self.assertEqual(writer.auto_flush, 8)
+            for event_idx in range(8):
+                writer.fill([Waveform(codes=np.full(8, event_idx, dtype=np.int16), gain=1e-3), None, None, None])
+                self.assertEqual(writer.buffered_rows["w1"], (event_idx + 1) % 4)
+            writer.close()
+            chunk = next(RunCatalog(directory).points[0].iterate(chunk_events=8))
+            np.testing.assert_allclose(chunk["w1"][:, 0], np.arange(8) * 1e-3)
+
+    def test_flat_first_record(self):
+        steps = np.array([[7., 7., 7., 7.], [3., 5., 4., 6.], [-2., 0., 1., 2.]])
+        with tempfile.TemporaryDirectory() as directory:
+            writer = NpyWriter(os.path.join(directory, "run_user_trig_30V"), [True, True, False, False])
+            for event_idx, event_steps in enumerate(steps):
+                # Channel 1 misses the second trigger, channel 2 stays flat
+                writer.fill([None if event_idx == 1 else Waveform(event_steps * 2e-5 - 0.013, dt=1e-10),
+                             Waveform(np.full(4, 0.0125), dt=1e-10), None, None])
+            writer.close()
+            point = RunCatalog(directory).points[0]
+            self.assertAlmostEqual(point.metadata["channels"]["w1"]["gain"], 2e-5)
+            chunk = next(point.iterate(branches=("w",)))
+        np.testing.assert_allclose(chunk["w1"][[0, 2]], steps[[0, 2]] * 2e-5 - 0.013, atol=1e-12)
+        np.testing.assert_allclose(chunk["w2"], 0.0125, atol=1e-12)
+
+    def test_windowed_times(self):
+        expected = -5e-9 + 1e-10 * (np.arange(0, 30, 10)[:, None] + np.arange(8))
+        with tempfile.TemporaryDirectory() as directory:
+            chunk = next(write_windowed_point(directory, "npy", "compact").iterate(chunk_events=3))
+            np.testing.assert_allclose(chunk["t2"], expected)
+
+    @skipUnless(importlib.util.find_spec("ROOT"), "ROOT not installed")
+    def test_root_longer_later_channel(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = open_writer("root", os.path.join(directory, "run_user_trig_30V"), [False, True, True, False], 16)
+            short_volts = np.arange(8) * 1e-3
+            # Channel 3 outgrows the buffers after channel 2 was copied
+            writer.fill([None, Waveform(short_volts, dt=1e-10), Waveform(np.full(40, 0.5), dt=1e-10), None])
+            writer.close()
+            chunk = next(RunCatalog(directory).points[0].iterate(branches=("w",)))
+        np.testing.assert_allclose(chunk["w2"][0, :8], short_volts)
+        np.testing.assert_allclose(chunk["w3"][0], 0.5)
+
+    @skipUnless(importlib.util.find_spec("ROOT"), "ROOT not installed")
+    def test_root_times_match_compact(self):
+        import ROOT
+
+        with tempfile.TemporaryDirectory() as directory:
+            compact_point = write_windowed_point(directory, "root", "compact")
+            legacy_point = write_windowed_point(directory, "root", "legacy")
+            compact_times = next(compact_point.iterate(chunk_events=3))["t2"]
+            np.testing.assert_allclose(compact_times, next(legacy_point.iterate(chunk_events=3))["t2"])
+            np.testing.assert_allclose(compact_times,
+                                       next(write_windowed_point(directory, "npy", "compact").iterate())["t2"])
+            # The alias has no array leaf of its own, drawn next to w2 it runs over the samples like the reader
+            root_file = ROOT.TFile.Open(compact_point.filename)
+            tree = root_file.Get("wfm")
+            num_drawn = tree.Draw("w2:t2", "", "goff")
+            drawn = np.array([tree.GetV2()[idx] for idx in range(num_drawn)])
+            root_file.Close()
+            np.testing.assert_allclose(drawn, compact_times[~np.isnan(compact_times)])
@@ -0,0 +1,45 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from unittest import TestCase
+
+import numpy as np
+
+from roi import RoiWindow
+from waveform import Waveform
+
+
+def make_pulse(peak, num_samples=1000, dt=1e-10):
+    samples = np.arange(num_samples)
+    return Waveform(codes=np.rint(-100 * np.exp(-0.5 * ((samples - peak) / 3.) ** 2)).astype(np.int16),
+                    gain=1e-3, dt=dt)
+
+
+class TestRoi(TestCase):
+    """
+    Class for testing region of interest windowing
+    """
+
+    def test_peak_window(self):
+        roi = RoiWindow(before=2e-9, after=3e-9)
+        events = [[None, make_pulse(400), make_pulse(990), None]]
+        windowed = roi.apply(events, [False, True, True, False])[0]
+        self.assertEqual(len(windowed[1]), 51)
+        self.assertEqual(windowed[1].start_index, 380)
+        np.testing.assert_array_equal(windowed[1].codes, events[0][1].codes[380:431])
+        self.assertAlmostEqual(windowed[1].times()[20], 400 * 1e-10)
+        # Windows near the end of the record are shifted to keep their length
+        self.assertEqual(len(windowed[2]), 51)
+        self.assertEqual(windowed[2].start_index, 949)
+
+    def test_reference_and_threshold(self):
+        roi = RoiWindow(before=1e-9, after=1e-9, anchor="threshold", threshold=-0.05, reference_channel=2)
+        events = [[make_pulse(100), make_pulse(300), None, None], [make_pulse(600), None, None, None]]
+        windowed = roi.apply(events, [True, True, False, False])
+        # The -50 mV crossing comes a few samples before the peak of the reference channel
+        self.assertEqual(windowed[0][1].start_index, windowed[0][0].start_index)
+        self.assertLess(windowed[0][1].start_index, 290)
+        # Without a reference record a channel is cut around its own pulse
+        self.assertLess(abs(windowed[1][0].start_index - 590), 5)
+        self.assertIsNone(windowed[1][1])
@@ -0,0 +1,116 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import asyncio
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from server import CaenBridge, command_fields
+
+
+class FakeCaen(object):
+    """
+    Stands in for Caen_control, answering VSET and VMON of every channel
+    """
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.commands = []
+        self.voltages = {}
+        self.lock = threading.Lock()
+
+    def send_command(self, command):
+        time.sleep(self.delay)
+        fields = command_fields(command)
+        with self.lock:
+            self.commands.append(command)
+            if fields["CMD"] == "SET":
+                self.voltages[fields["CH"]] = float(fields["VAL"])
+                return "#BD:00,CMD:OK\r\n"
+            return "#BD:00,CMD:OK,VAL:{:.1f}\r\n".format(self.voltages.get(fields.get("CH"), 0.))
+
+    def count(self, command):
+        with self.lock:
+            return self.commands.count(command)
+
+
+VMON = "$BD:0,CMD:MON,CH:1,PAR:VMON"
+
+
+class TestCaenBridge(IsolatedAsyncioTestCase):
+    """
+    Class for testing the shared CAEN bridge
+    """
+
+    async def asyncSetUp(self):
+        self.caen = FakeCaen(delay=0.05)
+        # Long window, every reuse in these tests comes from coalescing or the cache
+        self.bridge = CaenBridge(self.caen, coalesce_window=10.)
+        self.server = await asyncio.start_server(self.bridge.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.bridge.executor.shutdown()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.addAsyncCleanup(self.disconnect, writer)
+        return reader, writer
+
+    async def disconnect(self, writer):
+        writer.close()
+        await writer.wait_closed()
+
+    async def request(self, command):
+        reader, writer = await self.connect()
+        writer.write(command.encode() + b"\n")
+        return (await reader.readline()).decode().strip()
+
+    async def test_framing(self):
+        reader, writer = await self.connect()
+        # One command split over two writes
+        writer.write(VMON[:12].encode())
+        await writer.drain()
+        await asyncio.sleep(0.02)
+        writer.write(VMON[12:].encode() + b"\n")
+        self.assertEqual((await reader.readline()).strip(), b"#BD:00,CMD:OK,VAL:0.0")
+        # Two commands in one write, answered in order
+        writer.write(b"$BD:0,CMD:SET,CH:2,PAR:VSET,VAL:50\n$BD:0,CMD:MON,CH:2,PAR:VMON\n")
+        self.assertEqual((await reader.readline()).strip(), b"#BD:00,CMD:OK")
+        self.assertEqual((await reader.readline()).strip(), b"#BD:00,CMD:OK,VAL:50.0")
+
+    async def test_coalesced_reads(self):
+        replies = await asyncio.gather(*[self.request(VMON) for _ in range(5)])
+        self.assertEqual(replies, ["#BD:00,CMD:OK,VAL:0.0"] * 5)
+        self.assertEqual(self.caen.count(VMON), 1)
+        # Other channels and parameters are not shared
+        await self.request("$BD:0,CMD:MON,CH:2,PAR:VMON")
+        self.assertEqual(self.caen.count(VMON), 1)
+
+    async def test_set_drops_cached_reads(self):
+        self.assertEqual(await self.request(VMON), "#BD:00,CMD:OK,VAL:0.0")
+        await self.request("$BD:0,CMD:MON,CH:2,PAR:VMON")
+        await self.request("$BD:0,CMD:SET,CH:1,PAR:VSET,VAL:100")
+        self.assertEqual(await self.request(VMON), "#BD:00,CMD:OK,VAL:100.0")
+        self.assertEqual(self.caen.count(VMON), 2)
+        # A SET of channel 1 keeps the cached read of channel 2
+        await self.request("$BD:0,CMD:MON,CH:2,PAR:VMON")
+        self.assertEqual(self.caen.count("$BD:0,CMD:MON,CH:2,PAR:VMON"), 1)
+
+    async def test_set_during_read(self):
+        # The first read is on the serial line when the SET arrives, reads after the SET wait for a new query
+        first_read = asyncio.ensure_future(self.request(VMON))
+        await asyncio.sleep(0.02)
+        set_reply = asyncio.ensure_future(self.request("$BD:0,CMD:SET,CH:1,PAR:VSET,VAL:100"))
+        await asyncio.sleep(0.02)
+        second_read = asyncio.ensure_future(self.request(VMON))
+        self.assertEqual(await first_read, "#BD:00,CMD:OK,VAL:0.0")
+        # Finishing after the SET, the first read is not cached again
+        self.assertEqual(await self.request(VMON), "#BD:00,CMD:OK,VAL:100.0")
+        self.assertEqual(await second_read, "#BD:00,CMD:OK,VAL:100.0")
+        await set_reply
+        self.assertEqual(self.caen.count(VMON), 2)
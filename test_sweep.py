@@ -0,0 +1,100 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from queue import Queue
+from unittest import TestCase
+
+from instruments import InstrumentPool
+from sweep import plan_sweep
+from thorium import DaqRunner
+
+
+class StuckCaen(object):
+    """
+    Supply left at 150 V by an earlier run, which cannot reach 40 V
+    """
+
+    def __init__(self):
+        self.outputs = []
+        self.ramps = []
+
+    def status_check(self, channel):
+        return "ON"
+
+    def overcurrent(self):
+        return False
+
+    def read_voltage(self, channel):
+        return 150.
+
+    def read_current(self):
+        return 1e-9
+
+    def set_output(self, channel, voltage):
+        self.outputs.append(voltage)
+        return True
+
+    def wait_for_ramp(self, channel, start_voltage, target_voltage):
+        self.ramps.append((start_voltage, target_voltage))
+        return target_voltage != "40"
+
+
+class StuckCaenPool(InstrumentPool):
+    """
+    Scope emulator sessions with a StuckCaen
+    """
+
+    def __init__(self):
+        InstrumentPool.__init__(self)
+        self.stuck_caen = StuckCaen()
+
+    def caen(self, ip_address, channel):
+        return self.stuck_caen
+
+
+class TestSweep(TestCase):
+    """
+    Class for testing sweep planning
+    """
+
+    def test_one_ramp_per_voltage(self):
+        plan = plan_sweep(["50", " 30", "40", "30"], ["-50", "-55"])
+        self.assertEqual([point.volt for point in plan], ["30", "30", "40", "40", "50", "50"])
+        self.assertEqual([point.trigger for point in plan[:2]], ["-50", "-55"])
+        self.assertEqual([point.index for point in plan], list(range(6)))
+
+    def test_trigger_label(self):
+        plan = plan_sweep(["-200", "-100"])
+        self.assertEqual([point.volt for point in plan], ["-100", "-200"])
+        self.assertEqual(plan[0].trigger_label, "user")
+        self.assertEqual(plan_sweep(["10"], ["-50"])[0].trigger_label, "50.0mV")
+
+    def test_keep_order(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            plan = plan_sweep(["50", "-10", "30", "50 ", "-10"], keep_order=True)
+        self.assertEqual([point.volt for point in plan], ["50", "-10", "30"])
+        self.assertIn("Dropping repeated voltages 50, -10", output.getvalue())
+        self.assertIn("Sweeping 50, -10, 30 V", output.getvalue())
+
+    def test_first_point_sets_bias(self):
+        instruments = StuckCaenPool()
+        with tempfile.TemporaryDirectory() as directory:
+            outfile = os.path.join(directory, "run")
+            # Empty scope ip runs against a local scope emulator
+            try:
+                DaqRunner("", 5, [False, True, False, False], outfile, Queue(), "", ["0", "40", "50"], "2", True,
+                          None, transfer="binary", backend="npy", instruments=instruments)
+            finally:
+                instruments.close()
+            # 0 V is sent although it is the nominal start, the sweep stops at the 40 V timeout and ramps down
+            self.assertEqual(instruments.stuck_caen.outputs, ["0", "40", "0"])
+            self.assertEqual(instruments.stuck_caen.ramps[0], ("150.0", "0"))
+            self.assertEqual(sorted(name for name in os.listdir(directory) if "_trig_" in name),
+                             ["run_user_trig_0V"])
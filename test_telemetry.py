@@ -0,0 +1,37 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from unittest import TestCase
+
+from telemetry import Histogram, Telemetry
+
+
+class TestTelemetry(TestCase):
+    """
+    Class for testing stage timing histograms
+    """
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(1e-3)
+        histogram.record(0.5)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertAlmostEqual(summary["mean"], (99e-3 + 0.5) / 100)
+        # Percentiles are bucket edges, good to a tenth of a decade
+        self.assertAlmostEqual(summary["p50"], 1e-3, delta=3e-4)
+        self.assertEqual(summary["max"], 0.5)
+
+    def test_point_summary(self):
+        telemetry = Telemetry()
+        telemetry.start_point("test")
+        for _ in range(10):
+            telemetry.record("arm_wait", 1e-2)
+            telemetry.record("parse", 1e-4)
+        point = telemetry.end_point(10, 0.2)
+        self.assertEqual(point["bound_by"], "arm_wait")
+        self.assertEqual(point["events_per_s"], 50.)
+        self.assertEqual(telemetry.point_histograms["arm_wait"].count, 0)
+        self.assertIn('thorium_stage_seconds_count{stage="arm_wait"} 10', telemetry.prometheus())
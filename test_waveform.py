@@ -0,0 +1,138 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+from re import sub
+from struct import pack_into
+from unittest import TestCase
+
+import numpy as np
+
+from waveform import (Waveform, decode_events, decode_wavedesc, estimate_scale, parse_block, parse_inspect,
+                      quantize)
+
+
+def make_wavedesc(gain=1e-4, offset=0.02, dt=5e-11, comm_order=1, trigtime_array=0, wave_array_1=0):
+    """
+    Builds a minimal LECROY_2_3 descriptor for testing
+    """
+    endian = "<" if comm_order else ">"
+    desc = bytearray(346)
+    desc[0:8] = b"WAVEDESC"
+    pack_into(endian + "h", desc, 32, 1)
+    pack_into(endian + "h", desc, 34, comm_order)
+    pack_into(endian + "i", desc, 36, 346)
+    pack_into(endian + "i", desc, 48, trigtime_array)
+    pack_into(endian + "i", desc, 60, wave_array_1)
+    pack_into(endian + "f", desc, 156, gain)
+    pack_into(endian + "f", desc, 160, offset)
+    pack_into(endian + "f", desc, 176, dt)
+    pack_into(endian + "d", desc, 180, -1e-8)
+    return bytes(desc)
+
+
+def make_inspect(channel_volts):
+    """
+    Formats an INSPECT? SIMPLE reply the way the WavePro sends it
+    """
+    reply = ""
+    for channel, volts in channel_volts:
+        reply += 'C{}:INSP "\r\n'.format(channel)
+        for idx in range(0, len(volts), 8):
+            reply += "  " + "  ".join("{:.4e}".format(volt) for volt in volts[idx:idx + 8]) + " \r\n"
+        reply += '"\n'
+    return reply
+
+
+def legacy_convert_to_vector(values, dt):
+    """
+    Per-token parser the vectorized one replaces, kept as the reference output
+    """
+    list_channel_wfms = [None] * 4
+    cur_channel = -1
+    time_idx = 0
+    waveform = []
+    for line in values.split("\n"):
+        for entry in line.split(" "):
+            if ":" in entry:
+                if cur_channel >= 0:
+                    list_channel_wfms[cur_channel] = waveform
+                    waveform = []
+                    time_idx = 0
+                cur_channel = int(sub('[^0-9]', '', entry)) - 1
+            else:
+                try:
+                    volt = float(entry.strip())
+                    waveform.append((dt * time_idx, volt))
+                    time_idx += 1
+                except:
+                    pass
+    list_channel_wfms[cur_channel] = waveform
+    return list_channel_wfms
+
+
+def make_block(payload):
+    return "#9{:09d}".format(len(payload)).encode() + payload + b"\n"
+
+
+class TestWaveform(TestCase):
+    """
+    Class for testing binary waveform decoding
+    """
+
+    def test_parse_block(self):
+        self.assertEqual(bytes(parse_block(b"DAT1," + make_block(b"\x01\x02\x03"))), b"\x01\x02\x03")
+        with self.assertRaises(ValueError):
+            parse_block(b"no block")
+
+    def test_decode_wavedesc(self):
+        for comm_order in (0, 1):
+            desc = decode_wavedesc(parse_block(make_block(make_wavedesc(comm_order=comm_order))))
+            self.assertAlmostEqual(desc["horiz_interval"], 5e-11)
+            self.assertAlmostEqual(desc["vertical_gain"], 1e-4)
+            self.assertEqual(desc["dtype"].itemsize, 2)
+
+    def test_from_block(self):
+        desc = decode_wavedesc(make_wavedesc())
+        codes = np.array([-100, 0, 250], dtype="<i2")
+        wfm = Waveform.from_block(parse_block(make_block(codes.tobytes())), desc)
+        self.assertEqual(len(wfm), 3)
+        np.testing.assert_allclose(wfm.volts, codes * desc["vertical_gain"] - desc["vertical_offset"])
+        self.assertAlmostEqual(wfm.times()[2], 2 * desc["horiz_interval"])
+
+    def test_parse_inspect_matches_legacy(self):
+        rng = np.random.default_rng(1)
+        dt = 5e-11
+        reply = make_inspect([(2, rng.normal(0, 0.05, 1002)), (3, rng.normal(0, 0.05, 37))])
+        legacy = legacy_convert_to_vector(reply, dt)
+        parsed = parse_inspect(reply)
+        for channel in range(4):
+            if legacy[channel] is None:
+                self.assertIsNone(parsed[channel])
+                continue
+            wfm = Waveform(parsed[channel], dt)
+            self.assertEqual(list(zip(wfm.times().tolist(), wfm.volts.tolist())), legacy[channel])
+
+    def test_parse_inspect_stray_tokens(self):
+        parsed = parse_inspect('C4:INSP "\n 1.0 junk 2.5e-3\n"')
+        self.assertEqual(parsed[3].tolist(), [1.0, 2.5e-3])
+
+    def test_decode_sequence(self):
+        num_segments, record_length = 3, 5
+        trigger_times = np.array([[0., -1e-9], [1e-3, -2e-9], [2.5e-3, -3e-9]])
+        codes = np.arange(num_segments * record_length, dtype="<i2")
+        block = make_block(make_wavedesc(trigtime_array=trigger_times.nbytes, wave_array_1=codes.nbytes)
+                           + trigger_times.tobytes() + codes.tobytes())
+        events = decode_events([None, block, None, block], channel_descs=[None] * 4, sequence=True)
+        self.assertEqual(len(events), num_segments)
+        self.assertIsNone(events[0][0])
+        self.assertEqual(events[2][1].codes.tolist(), codes[10:15].tolist())
+        self.assertEqual(events[1][3].trigger_time, 1e-3)
+        self.assertEqual(events[2][3].trigger_offset, -3e-9)
+
+    def test_quantize_round_trip(self):
+        codes = np.array([-256, 0, 512, 768, -32768])
+        volts = codes * 2e-5 - 0.013
+        gain, offset = estimate_scale(volts)
+        np.testing.assert_allclose(quantize(volts, gain, offset) * gain - offset, volts, atol=1e-12)
+        self.assertEqual(quantize(np.array([1.]), 1e-6, 0.).tolist(), [32767])
@@ -5,17 +5,25 @@ __project__ = "Thorium DAQ"
 
 import argparse
 import configparser
-import gc
 import signal
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from queue import Queue
-from re import sub
 
-import ROOT
-
-from caen import Caen
-from lecroy import Oscilloscope
+from eventlog import EventLog
+from eventstore import EventStore
+from features import FeatureExtractor
+from instruments import InstrumentPool
+from merge import EventMerger
+from monitor import CurrentMonitor
+from preview import PreviewBuffer
+from roi import RoiWindow
+from sweep import plan_sweep
+from telemetry import Telemetry
+from waveform import decode_event, decode_events
+from writer import open_writer
 
 queue_stop = Queue()
 
@@ -28,98 +36,260 @@ def signal_handler(signal, frame):
         pass
 
 
+def decode_timed(raw, dt, channel_descs, sequence, channels=None, extractor=None, roi=None, max_events=None):
+    """
+    Decodes a raw readout, possibly in a pipeline worker, extracts its features
+    from the full records and then cuts them down to their ROI windows
+    :param channels: list of 4 booleans, True for active channels
+    :param extractor: FeatureExtractor, None to skip feature extraction
+    :param roi: RoiWindow, None to keep full records
+    :param max_events: events kept from the readout, None for all its segments
+    :return: tuple (list of events, list of feature dicts or None, decode time in s,
+             feature extraction and windowing time in s)
+    """
+    time_start = time.perf_counter()
+    events = decode_events(raw, dt, channel_descs, sequence)[:max_events]
+    time_decoded = time.perf_counter()
+    features = None
+    if extractor is not None:
+        features = extractor.extract(events, channels)
+    if roi is not None:
+        events = roi.apply(events, channels)
+    return events, features, time_decoded - time_start, time.perf_counter() - time_decoded
+
+
 class DaqRunner(object):
     """
     Data Acqusition state machine
     """
-    list_events = []
-    list_currents = []
-    list_times = []
 
     def __init__(self, scope_ip, num_events, active_channels, output_filename, stop_queue,
                  caen_ip, volt_list, caen_channel, using_caen,
-                 trigger_list
-                 ):
+                 trigger_list, transfer="text", pipeline_workers=0, queue_depth=64, segments=1,
+                 backend="root", schema="compact", monitor_rate=0., monitor_buffer=4096, di_dt_thresh=None,
+                 metrics_port=0, feature_options=None, roi_options=None, extra_scopes=None, merge_tolerance=1e-5,
+                 preview_options=None, memory_limit=1 << 30, spill_dir=None, output_options=None, instruments=None,
+                 keep_volt_order=False, reread_timebase=False):
         """
         Initializer function for the DAQ state machine
         :param ip_address: IP address of scope
         :param num_events: number of event that we would like
         :param channel_mask: Which channels we want in hex
         :param output_filename: file to dump data to
+        :param transfer: "text" for INSPECT? replies, "binary" for WF? DAT1 words
+        :param pipeline_workers: decode workers for pipelined acquisition, 0 to run serially
+        :param queue_depth: maximum number of events in flight between pipeline stages
+        :param segments: triggers captured per scope readout in sequence mode, binary transfers only
+        :param backend: output format, root, npy or hdf5
+        :param schema: ROOT tree layout, compact or legacy with t1..t4 time vectors
+        :param monitor_rate: HV monitor sampling rate in Hz, 0 to read currents in the event loop
+        :param monitor_buffer: number of HV monitor samples kept in memory
+        :param di_dt_thresh: |dI/dt| in A/s that stops the run, None to only record
+        :param metrics_port: localhost port serving Prometheus metrics, 0 to disable
+        :param feature_options: FeatureExtractor keyword arguments, None to skip the summary tree
+        :param roi_options: RoiWindow keyword arguments, None to store full records
+        :param extra_scopes: list of (ip address, list of 4 active channel flags) of further scopes,
+                             read in parallel and merged by trigger time; their channels are numbered 5, 6, ...
+        :param merge_tolerance: largest trigger time difference in s between the scopes' parts of one event
+        :param preview_options: PreviewBuffer keyword arguments, None to publish no live preview
+        :param memory_limit: bytes of events held in memory by serial acquisition before spilling to disk
+        :param spill_dir: directory for spilled events, the system temp directory if None
+        :param output_options: writer compression, basket_size and auto_flush keyword arguments
+        :param instruments: InstrumentPool to take open sessions from and leave them in, None to
+                            connect for this run and disconnect at its end
+        :param keep_volt_order: sweep the voltages in the order given rather than by increasing magnitude
+        :param reread_timebase: read the timebase and descriptors at every point, for scopes adjusted by hand
+                                during a sweep, instead of only after a setting changes them
         """
 
-        self.use_caen = using_caen
-        if self.use_caen:
-            self.caen = Caen(caen_ip)
-            self.caen_channel = caen_channel
-            if "ON" not in self.caen.status_check(self.caen_channel):
-                self.caen.enable_output(self.caen_channel, True)
-
-        self.volt_list = volt_list
-        self.trigger_list = trigger_list
-        self.output_filename = output_filename
-        self.num_events = num_events
-        self.scope = Oscilloscope(scope_ip)
-        self.channels = active_channels
-        self.dt = 0
-        self.stop_queue = stop_queue
-        # print(self.scope.inst.query("C2:INSPECT? HORIZ_OFFSET;"))
-
-        for volt in self.volt_list:
-            if self.trigger_list is not None:
-                for trigger in self.trigger_list:
-                    if not self.stop_queue.empty():
-                        break
-
-                    print("Trig {}".format(trigger))
-                    self.scope.arm_trigger("1", "NEG", str(float(volt) / 1000.))
-
-                    if self.use_caen:
-                        if self.caen.overcurrent():
-                            break
-                        self.caen.set_output(self.caen_channel, volt)
-                        time.sleep(5)
-                        while "RAMP UP" in self.caen.status_check(self.caen_channel):
-                            pass
-
-                    self.get_timebase()
-                    self.get_events()
-                    self.dump_data(str(abs(float(trigger))) + "mV", volt.strip())
-
-            else:
+        self.owns_instruments = instruments is None
+        self.instruments = InstrumentPool() if instruments is None else instruments
+        # Opened by the setup below, released even if it fails part way
+        self.monitor = None
+        self.event_store = None
+        self.preview = None
+        self.telemetry = None
+        try:
+            self.use_caen = using_caen
+            if self.use_caen:
+                self.caen = self.instruments.caen(caen_ip, caen_channel)
+                self.caen_channel = caen_channel
+                if "ON" not in self.caen.status_check(self.caen_channel):
+                    self.caen.enable_output(self.caen_channel, True)
+
+            if self.use_caen and monitor_rate:
+                self.monitor = CurrentMonitor(self.caen, caen_channel, stop_queue, monitor_rate, monitor_buffer,
+                                              di_dt_thresh)
+                self.monitor.start()
+
+            self.volt_list = volt_list
+            self.trigger_list = trigger_list
+            self.output_filename = output_filename
+            self.num_events = num_events
+            extra_scopes = extra_scopes or []
+            self.scopes = [self.instruments.scope(ip_address)
+                           for ip_address in [scope_ip] + [ip_address for ip_address, _ in extra_scopes]]
+            self.scope = self.scopes[0]
+            self.scope_channels = [active_channels] + [channels for _, channels in extra_scopes]
+            # Channels of all scopes, 4 per scope, in scope order
+            self.channels = [active for channels in self.scope_channels for active in channels]
+            self.merge_tolerance = merge_tolerance
+            self.transfer = transfer
+            self.pipeline_workers = pipeline_workers
+            self.queue_depth = queue_depth
+            self.segments = int(segments)
+            if int(num_events) % self.segments:
+                print("{} events is not a multiple of {} segments, the last readout of a point keeps {} of its "
+                      "segments".format(num_events, self.segments, int(num_events) % self.segments))
+            self.backend = backend
+            self.roi = None
+            if roi_options is not None:
+                self.roi = RoiWindow(**roi_options)
+            self.writer_options = dict(output_options or {}, schema=schema, windowed=self.roi is not None)
+            self.scope_descs = [[None] * 4 for _ in self.scopes]
+            self.channel_descs = self.scope_descs[0]
+            self.scope_dts = [0] * len(self.scopes)
+            self.dt = 0
+            self.stop_queue = stop_queue
+            self.point_events = 0
+            self.extractor = None
+            if feature_options is not None:
+                self.extractor = FeatureExtractor(**feature_options)
+            self.list_features = []
+            # Sized for one point and reused
+            self.event_log = EventLog(int(num_events))
+            self.event_store = EventStore(self.channels, len(self.event_log.rows), memory_limit, spill_dir)
+            self.list_currents = []
+            if preview_options is not None:
+                self.preview = PreviewBuffer(self.channels, **preview_options)
+            self.telemetry = Telemetry("{}_metrics.json".format(output_filename), metrics_port)
+            # print(self.scope.inst.query("C2:INSPECT? HORIZ_OFFSET;"))
+            # The scopes may have been changed by hand since the last run
+            for scope in self.scopes:
+                scope.settings.forget()
+            self.reread_timebase = reread_timebase
+            if self.transfer == "binary":
+                for scope in self.scopes:
+                    scope.setup_binary_transfer()
+                    scope.setup_sequence(self.segments)
+            self.sweep_plan = plan_sweep(self.volt_list, self.trigger_list, keep_volt_order)
+            times_file = open("{}_times.txt".format(self.output_filename), "w")
+        except Exception:
+            # A failed job under the daemon must not leave its monitor thread, metrics port or preview behind
+            self.release()
+            raise
+
+        current_volt = "0"
+        bias_set = False
+        completed_points = []
+
+        # Torn down even if the sweep fails, a daemon runs the next job in this process
+        try:
+            if self.use_caen:
+                # The supply may have been left at any voltage, so the first point always sets and waits for its bias
+                current_volt = str(self.caen.read_voltage(self.caen_channel))
+                print("HV channel {} at {} V before the sweep".format(self.caen_channel, current_volt))
+            for point in self.sweep_plan:
+                if not self.stop_queue.empty():
+                    break
+
+                self.telemetry.start_point(self.point_filename(point.trigger_label, point.volt))
                 if self.use_caen:
                     if self.caen.overcurrent():
                         break
-                    self.caen.set_output(self.caen_channel, volt)
-                    time.sleep(5)
-                    while "RAMP UP" in self.caen.status_check(self.caen_channel):
-                        pass
+                    if not bias_set or float(point.volt) != float(current_volt):
+                        time_start = time.perf_counter()
+                        self.caen.set_output(self.caen_channel, point.volt)
+                        ramped = self.caen.wait_for_ramp(self.caen_channel, current_volt, point.volt)
+                        self.telemetry.record("ramp", time.perf_counter() - time_start)
+                        current_volt = point.volt
+                        bias_set = True
+                        if not ramped:
+                            # Data at the wrong bias is no use, and a supply that cannot hold it may be tripping
+                            print("Stopping the sweep, HV did not reach {} V".format(point.volt))
+                            break
 
-                self.get_timebase()
-                time_start = time.time()
-                self.get_events()
-                print("{} s/wfm".format((time.time() - time_start) / 100.0))
-                self.dump_data("user", volt.strip())
+                if point.trigger is not None:
+                    print("Trig {}".format(point.trigger))
+                    self.scope.arm_trigger("1", "NEG", str(float(point.trigger) / 1000.))
 
-        if self.use_caen:
-            self.caen.set_output(self.caen_channel, "0")
-            time.sleep(5)
-            while "RAMP DOWN" in self.caen.status_check(self.caen_channel):
-                pass
-            self.caen.close()
-        with open("{}_currents.csv".format(self.output_filename), "w") as currents_file:
-            for idx, volt in enumerate(self.volt_list):
-                currents_file.write("Begin,{},{}\n".format(volt, self.list_currents[idx][0]))
-                currents_file.write("Middle,{},{}\n".format(volt, self.list_currents[idx][1]))
-                currents_file.write("End,{},{}\n".format(volt, self.list_currents[idx][2]))
-
-        with open("{}_times.txt".format(self.output_filename), "w") as times_file:
-            for item in self.list_times:
-                times_file.write("{}\n".format(item))
+                if self.reread_timebase:
+                    for scope in self.scopes:
+                        scope.settings.forget_readbacks()
+                self.get_timebase()
+                self.event_log.start_point(point.index)
+                self.acquire_point(point.trigger_label, point.volt)
+                self.event_log.write_text(times_file)
+                completed_points.append(point)
+        finally:
+            times_file.close()
+
+            if self.use_caen:
+                self.caen.set_output(self.caen_channel, "0")
+                self.caen.wait_for_ramp(self.caen_channel, current_volt, "0")
+            with open("{}_currents.csv".format(self.output_filename), "w") as currents_file:
+                for point, currents in zip(completed_points, self.list_currents):
+                    currents_file.write("Begin,{},{}\n".format(point.volt, currents[0]))
+                    currents_file.write("Middle,{},{}\n".format(point.volt, currents[1]))
+                    currents_file.write("End,{},{}\n".format(point.volt, currents[2]))
+
+            print("Acqusition complete")
+            self.release()
+
+    def release(self):
+        """
+        Stops the HV monitor and closes the metrics server, event store, preview and owned instruments
+        Parts not opened yet are skipped
+        :return: None
+        """
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        if self.event_store is not None:
+            self.event_store.close()
+        if self.preview is not None:
+            self.preview.close()
+        if self.owns_instruments:
+            self.instruments.close()
+
+    def read_current(self):
+        """
+        Reads the HV current, from the monitor thread when it is running
+        :return: float current in A
+        """
+        if self.monitor is not None:
+            return self.monitor.read_current()
+        return self.caen.read_current()
 
+    def point_filename(self, current_trigger, current_voltage):
+        # The writer backend adds the file extension
+        return "{}_{}_trig_{}V".format(self.output_filename, current_trigger, current_voltage)
 
-        print("Acqusition complete")
-        self.scope.close()
+    def acquire_point(self, current_trigger, current_voltage):
+        """
+        Acquires and writes out the events of one sweep point
+        :param current_trigger: trigger label used in the file name
+        :param current_voltage: bias voltage used in the file name
+        :return: None
+        """
+        if self.monitor is not None:
+            self.monitor.start_point(self.point_filename(current_trigger, current_voltage) + "_hv.csv")
+
+        self.point_events = 0
+        time_start = time.perf_counter()
+        try:
+            if len(self.scopes) > 1:
+                self.get_events_merged(current_trigger, current_voltage)
+            elif self.pipeline_workers:
+                self.get_events_pipelined(current_trigger, current_voltage)
+            else:
+                self.get_events()
+                self.dump_data(current_trigger, current_voltage)
+        finally:
+            if self.monitor is not None:
+                self.monitor.end_point()
+        self.telemetry.end_point(self.point_events, time.perf_counter() - time_start)
 
     def dump_data(self, current_trigger, current_voltage):
         """
@@ -128,71 +298,18 @@ class DaqRunner(object):
         :return: None
         """
 
-        tree_file = ROOT.TFile(
-            "{}_{}_trig_{}V.root".format(
-                self.output_filename,
-                current_trigger,
-                current_voltage),
-            "recreate"
-        )
+        writer = open_writer(self.backend, self.point_filename(current_trigger, current_voltage), self.channels,
+                             **self.writer_options)
+        for event_idx, event in enumerate(self.event_store):
+            time_start = time.perf_counter()
+            writer.fill(event, self.event_log.rows[event_idx])
+            if self.list_features:
+                writer.fill_summary(self.list_features[event_idx])
+            self.telemetry.record("write", time.perf_counter() - time_start)
+        writer.close()
 
-        tree = ROOT.TTree("wfm", "tree with events/wfms")
-
-        vector_voltage_1 = ROOT.vector("double")()
-        vector_time_1 = ROOT.vector("double")()
-        vector_voltage_2 = ROOT.vector("double")()
-        vector_time_2 = ROOT.vector("double")()
-        vector_voltage_3 = ROOT.vector("double")()
-        vector_time_3 = ROOT.vector("double")()
-        vector_voltage_4 = ROOT.vector("double")()
-        vector_time_4 = ROOT.vector("double")()
-
-        if self.channels[0]:
-            tree.Branch("w1", vector_voltage_1)
-            tree.Branch("t1", vector_time_1)
-        if self.channels[1]:
-            tree.Branch("w2", vector_voltage_2)
-            tree.Branch("t2", vector_time_2)
-        if self.channels[2]:
-            tree.Branch("w3", vector_voltage_3)
-            tree.Branch("t3", vector_time_3)
-        if self.channels[3]:
-            tree.Branch("w4", vector_voltage_4)
-            tree.Branch("t4", vector_time_4)
-
-        for event in self.list_events:
-            if event[0]:
-                for data in event[0]:
-                    vector_time_1.push_back(data[0])
-                    vector_voltage_1.push_back(data[1])
-            if event[1]:
-                for data in event[1]:
-                    vector_time_2.push_back(data[0])
-                    vector_voltage_2.push_back(data[1])
-            if event[2]:
-                for data in event[2]:
-                    vector_time_3.push_back(data[0])
-                    vector_voltage_3.push_back(data[1])
-            if event[3]:
-                for data in event[3]:
-                    vector_time_4.push_back(data[0])
-                    vector_voltage_4.push_back(data[1])
-
-            tree.Fill()
-            vector_time_1.clear()
-            vector_time_2.clear()
-            vector_time_3.clear()
-            vector_time_4.clear()
-            vector_voltage_1.clear()
-            vector_voltage_2.clear()
-            vector_voltage_3.clear()
-            vector_voltage_4.clear()
-
-        tree_file.Write()
-        tree_file.Close()
-
-        self.list_events.clear()
-        gc.collect()
+        self.event_store.clear()
+        self.list_features.clear()
 
     def get_events(self):
         """
@@ -204,80 +321,422 @@ class DaqRunner(object):
         wfm_counter = 0
         sublist_currents = []
         if self.use_caen:
-            sublist_currents.append(self.caen.read_current())
+            sublist_currents.append(self.read_current())
 
-        for event in range(int(self.num_events)):
+        for event in range(0, int(self.num_events), self.segments):
 
-            if event % 100 == 0:
+            if event % 100 < self.segments:
                 print("On event {}".format(event))
-            if event == int(self.num_events) // 2 and self.use_caen:
-                sublist_currents.append(self.caen.read_current())
+            if event <= int(self.num_events) // 2 < event + self.segments and self.use_caen:
+                sublist_currents.append(self.read_current())
 
             if not self.stop_queue.empty():
                 print("STOPPING DAQ")
                 return
-            # event_wfm = self.scope.get_waveforms()
-            command_payload = ""
-            for channel_number, active_channel in enumerate(self.channels):
-                if active_channel:
-                    command_payload += "C{}:INSPECT? SIMPLE;".format(str(channel_number + 1))
+            raw_event = self.read_event()
+            # The last readout of a sequence run only keeps the segments still needed
+            num_kept = min(self.segments, int(self.num_events) - event)
+            self.event_log.record(num_kept)
+            events, features, parse_time, feature_time = decode_timed(
+                raw_event, self.dt, self.channel_descs, self.segments > 1, self.channels, self.extractor, self.roi,
+                num_kept)
+            self.telemetry.record("parse", parse_time)
+            self.event_store.add(events)
+            if features is not None:
+                self.telemetry.record("features", feature_time)
+                self.list_features.extend(features)
+            if self.preview is not None:
+                self.preview.publish(events, features)
+            self.point_events += len(events)
+
+        if self.use_caen:
+            sublist_currents.append(self.read_current())
+            self.list_currents.append(sublist_currents)
+
+    def get_events_pipelined(self, current_trigger, current_voltage):
+        """
+        Gets events with scope readout, decoding and file writing overlapped
+        This thread only arms and reads the scope, a worker pool decodes the
+        replies and a writer thread streams them to file in acquisition order
+        :param current_trigger: trigger label used in the file name
+        :param current_voltage: bias voltage used in the file name
+        :return: None
+        """
+        sublist_currents = []
+        if self.use_caen:
+            sublist_currents.append(self.read_current())
+
+        decoded_queue = Queue(maxsize=self.queue_depth)
+        writer_errors = []
+        writer_thread = threading.Thread(
+            target=self.write_events,
+            args=(decoded_queue, self.point_filename(current_trigger, current_voltage), writer_errors)
+        )
+        writer_thread.start()
+
+        # Parsing text replies is CPU bound, decoding binary blocks is not worth a process hop
+        executor_class = ProcessPoolExecutor if self.transfer == "text" else ThreadPoolExecutor
+        with executor_class(max_workers=self.pipeline_workers) as decode_pool:
+            try:
+                for event in range(0, int(self.num_events), self.segments):
 
-            self.list_events.append(
-                self.convert_to_vector(
-                    self.scope.inst.query("ARM; WAIT;" + command_payload)
-                )
-            )
+                    if event % 100 < self.segments:
+                        print("On event {}".format(event))
+                    if event <= int(self.num_events) // 2 < event + self.segments and self.use_caen:
+                        sublist_currents.append(self.read_current())
+
+                    if not self.stop_queue.empty():
+                        print("STOPPING DAQ")
+                        return
+                    if writer_errors:
+                        break
 
-            self.list_times.append("EVENT:{},".format(event) + str(time.time()))
+                    raw_event = self.read_event()
+                    # The last readout of a sequence run only keeps the segments still needed
+                    num_kept = min(self.segments, int(self.num_events) - event)
+                    self.event_log.record(num_kept)
+                    self.point_events += num_kept
+                    decoded_queue.put(decode_pool.submit(decode_timed, raw_event, self.dt, self.channel_descs,
+                                                         self.segments > 1, self.channels, self.extractor, self.roi,
+                                                         num_kept))
+            finally:
+                decoded_queue.put(None)
+                writer_thread.join()
+        if writer_errors:
+            raise writer_errors[0]
 
         if self.use_caen:
-            sublist_currents.append(self.caen.read_current())
+            sublist_currents.append(self.read_current())
             self.list_currents.append(sublist_currents)
 
+    def write_events(self, decoded_queue, filename, writer_errors):
+        """
+        Writer stage of the pipeline, fills the tree as decoded events arrive
+        :param decoded_queue: Queue of futures resolving to lists of events, None to finish
+        :param filename: output file name without extension
+        :param writer_errors: list the exception stopping this stage is added to, for the acquisition thread
+        :return: None
+        """
+        try:
+            self.fill_decoded(decoded_queue, filename)
+        except Exception as error:
+            writer_errors.append(error)
+            # Keep taking readouts until the acquisition thread sees the error, so it never blocks on a full queue
+            while decoded_queue.get() is not None:
+                pass
+
+    def fill_decoded(self, decoded_queue, filename):
+        """
+        Fills the output file with the decoded readouts of a queue
+        :param decoded_queue: Queue of futures resolving to lists of events, None to finish
+        :param filename: output file name without extension
+        :return: None
+        """
+        writer = open_writer(self.backend, filename, self.channels, **self.writer_options)
+        try:
+            num_filled = 0
+            while True:
+                future_events = decoded_queue.get()
+                if future_events is None:
+                    break
+                events, features, parse_time, feature_time = future_events.result()
+                # Parse times come back with the events, so only this thread records them
+                self.telemetry.record("parse", parse_time)
+                if features is not None:
+                    self.telemetry.record("features", feature_time)
+                if self.preview is not None:
+                    self.preview.publish(events, features)
+                for event_idx, event in enumerate(events):
+                    time_start = time.perf_counter()
+                    # Rows were logged by the acquisition thread before the readout was queued
+                    writer.fill(event, self.event_log.rows[num_filled])
+                    num_filled += 1
+                    if features is not None:
+                        writer.fill_summary(features[event_idx])
+                    self.telemetry.record("write", time.perf_counter() - time_start)
+        finally:
+            writer.close()
+
+    def get_events_merged(self, current_trigger, current_voltage):
+        """
+        Gets events from several scopes at once
+        Every scope is armed and read by its own thread, decoding runs in a
+        worker pool and this thread merges the streams by trigger time, then
+        extracts features, cuts ROI windows and writes the combined events
+        :param current_trigger: trigger label used in the file name
+        :param current_voltage: bias voltage used in the file name
+        :return: None
+        """
+        sublist_currents = []
+        if self.use_caen:
+            sublist_currents.append(self.read_current())
+
+        merger = EventMerger(len(self.scopes), self.merge_tolerance)
+        stream_queues = [Queue(maxsize=self.queue_depth) for _ in self.scopes]
+        done = threading.Event()
+        writer = open_writer(self.backend, self.point_filename(current_trigger, current_voltage), self.channels,
+                             **self.writer_options)
+
+        executor_class = ProcessPoolExecutor if self.transfer == "text" else ThreadPoolExecutor
+        with executor_class(max_workers=max(self.pipeline_workers, 1)) as decode_pool:
+            workers = [threading.Thread(target=self.scope_worker, args=(scope_idx, decode_pool, stream_queue, done))
+                       for scope_idx, stream_queue in enumerate(stream_queues)]
+            for worker in workers:
+                worker.start()
+
+            ended = [False] * len(self.scopes)
+            try:
+                while merger.num_merged < int(self.num_events):
+                    # The merge waits on the scope that is furthest behind
+                    scope_idx = min(range(len(self.scopes)), key=lambda idx: len(merger.pending[idx]))
+                    item = stream_queues[scope_idx].get()
+                    if item is None or isinstance(item, Exception):
+                        ended[scope_idx] = True
+                        if item is not None:
+                            raise item
+                        # No further event can be complete without this scope
+                        print("Scope {} stopped after {} merged events".format(scope_idx + 1, merger.num_merged))
+                        break
+                    future_events, host_time = item
+                    events, _, parse_time, _ = future_events.result()
+                    self.telemetry.record("parse", parse_time)
+                    for event in events:
+                        for wfm in event:
+                            if wfm is not None and wfm.timestamp is None:
+                                wfm.timestamp = host_time
+                    merger.push(scope_idx, events)
+
+                    merged = merger.pop_merged()[:int(self.num_events) - self.point_events]
+                    if not merged:
+                        continue
+                    if self.point_events // 100 < (self.point_events + len(merged)) // 100 or not self.point_events:
+                        print("On event {}".format(self.point_events))
+                    if merger.num_merged - len(merged) < int(self.num_events) // 2 <= merger.num_merged \
+                            and self.use_caen:
+                        sublist_currents.append(self.read_current())
+                    self.write_merged(writer, merged, host_time)
+            finally:
+                done.set()
+                # Unblock workers waiting on a full queue, each ends its stream with None or its exception
+                for scope_idx, (stream_queue, stream_ended) in enumerate(zip(stream_queues, ended)):
+                    while not stream_ended:
+                        item = stream_queue.get()
+                        stream_ended = item is None or isinstance(item, Exception)
+                        if isinstance(item, Exception):
+                            print("Scope {} failed: {!r}".format(scope_idx + 1, item))
+                for worker in workers:
+                    worker.join()
+                writer.close()
+
+        print("Merged {} events, dropped {} unmatched scope events".format(
+            merger.num_merged, ", ".join("{} from scope {}".format(num_dropped, scope_idx + 1)
+                                         for scope_idx, num_dropped in enumerate(merger.num_dropped))))
+        if self.use_caen:
+            sublist_currents.append(self.read_current())
+            self.list_currents.append(sublist_currents)
+
+    def write_merged(self, writer, events, host_time):
+        """
+        Extracts features of merged events, cuts their ROI windows and writes them
+        :param writer: open writer
+        :param events: list of merged events
+        :param host_time: monotonic time of the readout that completed the events
+        :return: None
+        """
+        time_start = time.perf_counter()
+        features = None
+        if self.extractor is not None:
+            features = self.extractor.extract(events, self.channels)
+        if self.roi is not None:
+            events = self.roi.apply(events, self.channels)
+        if features is not None or self.roi is not None:
+            self.telemetry.record("features", time.perf_counter() - time_start)
+        if self.preview is not None:
+            self.preview.publish(events, features)
+
+        first_row = self.event_log.record(len(events), host_time)
+        for event_idx, event in enumerate(events):
+            time_start = time.perf_counter()
+            writer.fill(event, self.event_log.rows[first_row + event_idx])
+            if features is not None:
+                writer.fill_summary(features[event_idx])
+            self.telemetry.record("write", time.perf_counter() - time_start)
+            self.point_events += 1
+
+    def scope_worker(self, scope_idx, decode_pool, stream_queue, done):
+        """
+        Acquisition thread of one scope in multi-scope mode
+        :param scope_idx: index of the scope
+        :param decode_pool: executor decoding the raw readouts
+        :param stream_queue: Queue of (future events, monotonic host time) tuples, ended by None,
+                             or by the exception that stopped the worker
+        :param done: Event set once enough events have been merged
+        :return: None
+        """
+        # Binary readouts carry the descriptor, and with it the scope's trigger time stamp
+        sequence = self.transfer == "binary"
+        end_of_stream = None
+        try:
+            # Unmatched triggers get dropped, so keep reading until enough events are merged
+            while not done.is_set():
+                if not self.stop_queue.empty():
+                    print("STOPPING DAQ")
+                    return
+                raw_event = self.read_event(scope_idx)
+                host_time = time.monotonic()
+                stream_queue.put((decode_pool.submit(decode_timed, raw_event, self.scope_dts[scope_idx],
+                                                     self.scope_descs[scope_idx], sequence), host_time))
+        except Exception as error:
+            # Re-raised by the merging thread
+            end_of_stream = error
+        finally:
+            stream_queue.put(end_of_stream)
+
+    def read_event(self, scope_idx=0):
+        """
+        Arms a scope and reads back one raw event without decoding it
+        Records the arm/wait and transfer time of the readout
+        :param scope_idx: index of the scope
+        :return: INSPECT? reply string, or list of 4 WF? DAT1 replies
+        """
+        scope = self.scopes[scope_idx]
+        time_start = time.perf_counter()
+        if self.transfer == "binary":
+            block = "ALL" if self.segments > 1 or len(self.scopes) > 1 else "DAT1"
+            raw_event = scope.read_event(self.scope_descs[scope_idx], block)
+        else:
+            raw_event = scope.inspect_event(self.scope_channels[scope_idx])
+        elapsed = time.perf_counter() - time_start
+        self.telemetry.record("arm_wait", scope.arm_wait_time)
+        self.telemetry.record("transfer", max(elapsed - scope.arm_wait_time, 0.))
+        return raw_event
+
     def get_timebase(self):
         """
         Retrieves the active horizontal timebase of the scope
+        In binary mode, also decodes the WAVEDESC of every active channel.
+        Both are cached by the scope until one of its settings changes them
         :return: float representation of the timebase
         """
 
-        raw_dt = self.scope.inst.query("C2:INSPECT? HORIZ_INTERVAL")
-        dt = float(raw_dt.split(":")[2].split(" ")[1])
-        self.dt = dt
+        for scope_idx, scope in enumerate(self.scopes):
+            if self.transfer == "binary":
+                for channel_number, active_channel in enumerate(self.scope_channels[scope_idx]):
+                    if active_channel:
+                        self.scope_descs[scope_idx][channel_number] = scope.get_wavedesc(channel_number + 1)
+                        self.scope_dts[scope_idx] = self.scope_descs[scope_idx][channel_number]["horiz_interval"]
+                continue
+
+            # C2 on the first scope, as always, else the first channel read
+            query_channel = 2 if scope_idx == 0 else self.scope_channels[scope_idx].index(True) + 1
+            self.scope_dts[scope_idx] = scope.get_horiz_interval(query_channel)
+        self.dt = self.scope_dts[0]
 
     def convert_to_vector(self, values):
         """
         Helper function for converting the values from the oscilloscope
         to a vectorized quantity suitable for translation to a root TTree
         :param values: Raw oscilloscope voltage values
-        :param channels: which channels are active
-        :return: Vectorized representation of oscilloscope values
+        :return: list of 4 Waveforms, None for inactive channels
         """
-        list_channel_wfms = [None] * 4
-        cur_channel = -1
-        time_idx = 0
-
-        if values is not None:
-            waveform = []
-
-            for line in values.split("\n"):
-                # print("Parsing line=>"+line)
-                for entry in line.split(" "):
-                    if ":" in entry:
-                        if cur_channel >= 0:
-                            list_channel_wfms[cur_channel] = waveform
-                            waveform = []
-                            time_idx = 0
-                        cur_channel = int(sub('[^0-9]', '', entry)) - 1
-                    else:
-                        try:
-                            volt = float(entry.strip())
-                            waveform.append((self.dt * time_idx, volt))
-                            time_idx += 1
-                        except:
-                            pass
-            list_channel_wfms[cur_channel] = waveform
-
-        return list_channel_wfms
+        return decode_event(values, self.dt)
+
+
+def load_config(config):
+    """
+    Reads the DAQ settings of a config file
+    :param config: RawConfigParser holding the config
+    :return: dict of DaqRunner keyword arguments, all but output_filename and stop_queue
+    """
+    active_channels = []
+    for num_channel in range(1, 5):
+        active_channels.append(config.getboolean("lecroy", "read_ch{}".format(num_channel)))
+    lecroy_ip = config.get("lecroy", "ip")
+    scanning_trigger = config.getboolean("lecroy", "scan_trigger")
+    trigger_values = None
+    if scanning_trigger:
+        trigger_values = config.get("lecroy", "trigger_values").split(",")
+    caen_ip = config.get("caen", "ip")
+    volt_list = config.get("caen", "volts").split(",")
+    keep_volt_order = config.getboolean("caen", "keep_order", fallback=False)
+    caen_channel = config.get("caen", "step_channel")
+    using_caen = config.getboolean("caen", "use")
+    num_events = config.get("daq", "events")
+    monitor_rate = config.getfloat("caen", "monitor_rate", fallback=0.)
+    monitor_buffer = config.getint("caen", "monitor_buffer", fallback=4096)
+    di_dt_thresh = config.getfloat("caen", "di_dt_thresh", fallback=None)
+    transfer = config.get("lecroy", "transfer", fallback="text")
+    reread_timebase = config.getboolean("lecroy", "reread_every_point", fallback=False)
+    pipeline_workers = config.getint("daq", "pipeline_workers", fallback=0)
+    queue_depth = config.getint("daq", "queue_depth", fallback=64)
+    segments = config.getint("daq", "segments", fallback=1)
+    backend = config.get("daq", "backend", fallback="root")
+    schema = config.get("daq", "schema", fallback="compact")
+    metrics_port = config.getint("daq", "metrics_port", fallback=0)
+    output_options = {
+        "compression": config.get("daq", "compression", fallback="") or None,
+        "compression_level": int(config.get("daq", "compression_level", fallback="") or 0) or None,
+        "basket_size": int(float(config.get("daq", "basket_size_kb", fallback="") or 0) * 1024) or None,
+        "auto_flush": int(config.get("daq", "auto_flush_events", fallback="") or 0) or None,
+    }
+    if backend == "npy" and output_options["compression"] not in (None, "none"):
+        print("npy output is uncompressed, ignoring compression {}".format(output_options["compression"]))
+        output_options["compression"] = None
+    feature_options = None
+    if config.getboolean("features", "enabled", fallback=False):
+        feature_options = {
+            "cfd_fraction": config.getfloat("features", "cfd_fraction", fallback=0.5),
+            "baseline_samples": config.getint("features", "baseline_samples", fallback=100),
+            "polarity": config.get("features", "polarity", fallback="negative"),
+            "termination": config.getfloat("features", "termination", fallback=50.),
+        }
+    roi_options = None
+    if config.getboolean("roi", "enabled", fallback=False):
+        roi_options = {
+            "before": config.getfloat("roi", "before_ns", fallback=5.) * 1e-9,
+            "after": config.getfloat("roi", "after_ns", fallback=10.) * 1e-9,
+            "anchor": config.get("roi", "anchor", fallback="peak"),
+            "threshold": None,
+            "polarity": config.get("roi", "polarity", fallback="negative"),
+            "baseline_samples": config.getint("roi", "baseline_samples", fallback=100),
+            "reference_channel": config.getint("roi", "reference_channel", fallback=0) or None,
+        }
+        if config.get("roi", "threshold_mv", fallback=""):
+            roi_options["threshold"] = config.getfloat("roi", "threshold_mv") / 1000.
+    memory_limit = int(config.getfloat("daq", "memory_limit_mb", fallback=1024.) * 1e6)
+    spill_dir = config.get("daq", "spill_dir", fallback="") or None
+    preview_options = None
+    if config.getboolean("preview", "enabled", fallback=False):
+        preview_options = {
+            "name": config.get("preview", "name", fallback="thorium_preview"),
+            "num_slots": config.getint("preview", "events", fallback=64),
+            "num_bins": config.getint("preview", "bins", fallback=100),
+            "amplitude_range": (0., config.getfloat("preview", "max_amplitude_mv", fallback=500.) / 1000.),
+        }
+    if segments > 1 and transfer != "binary":
+        print("Sequence mode needs binary transfers. Switching to binary")
+        transfer = "binary"
+
+    # Further scopes are read in parallel, from [lecroy2], [lecroy3], ... sections
+    extra_scopes = []
+    while config.has_section("lecroy{}".format(len(extra_scopes) + 2)):
+        section = "lecroy{}".format(len(extra_scopes) + 2)
+        extra_scopes.append((config.get(section, "ip"),
+                             [config.getboolean(section, "read_ch{}".format(num_channel)) for num_channel in range(1, 5)]))
+    merge_tolerance = config.getfloat("daq", "merge_tolerance_us", fallback=10. if transfer == "binary" else 5000.)
+    if extra_scopes and transfer != "binary":
+        print("Merging text mode scopes by host time, only reliable at low trigger rates")
+    return {
+        "scope_ip": lecroy_ip, "num_events": num_events, "active_channels": active_channels,
+        "caen_ip": caen_ip, "volt_list": volt_list, "caen_channel": caen_channel, "using_caen": using_caen,
+        "trigger_list": trigger_values, "transfer": transfer, "pipeline_workers": pipeline_workers,
+        "queue_depth": queue_depth, "segments": segments, "backend": backend, "schema": schema,
+        "monitor_rate": monitor_rate, "monitor_buffer": monitor_buffer, "di_dt_thresh": di_dt_thresh,
+        "metrics_port": metrics_port, "feature_options": feature_options, "roi_options": roi_options,
+        "extra_scopes": extra_scopes, "merge_tolerance": merge_tolerance * 1e-6, "preview_options": preview_options,
+        "memory_limit": memory_limit, "spill_dir": spill_dir, "output_options": output_options,
+        "keep_volt_order": keep_volt_order, "reread_timebase": reread_timebase,
+    }
 
 
 if __name__ == "__main__":
@@ -316,25 +775,7 @@ $$$$$$$$/ $$ |____    ______    ______  $$/  __    __  _____  ____
     # Config file loading
     config = configparser.RawConfigParser(allow_no_value=True)
     config.read_file(open(args.config))
-    active_channels = []
-    for num_channel in range(1, 5):
-        active_channels.append(config.getboolean("lecroy", "read_ch{}".format(num_channel)))
-    lecroy_ip = config.get("lecroy", "ip")
-    scanning_trigger = config.getboolean("lecroy", "scan_trigger")
-    trigger_values = None
-    if scanning_trigger:
-        trigger_values = config.get("lecroy", "trigger_values").split(",")
-    caen_ip = config.get("caen", "ip")
-    volt_list = config.get("caen", "volts").split(",")
-    caen_channel = config.get("caen", "step_channel")
-    using_caen = config.getboolean("caen", "use")
-    num_events = config.get("daq", "events")
 
     # DAQ Logic Control
     signal.signal(signal.SIGINT, signal_handler)
-
-    daq = DaqRunner(lecroy_ip, num_events, active_channels,
-                    args.outfile, queue_stop,
-                    caen_ip, volt_list, caen_channel, using_caen,
-                    trigger_values
-                    )
\ No newline at end of file
+    daq = DaqRunner(output_filename=args.outfile, stop_queue=queue_stop, **load_config(config))
@@ -0,0 +1,344 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import re
+from struct import pack_into, unpack_from
+
+import numpy as np
+
+# Byte offsets of the WAVEDESC fields we use, relative to the start of the
+# "WAVEDESC" descriptor name (LECROY_2_3 template)
+WAVEDESC_FIELDS = {
+    "comm_type": (32, "h"),
+    "comm_order": (34, "h"),
+    "wave_descriptor": (36, "i"),
+    "user_text": (40, "i"),
+    "res_desc1": (44, "i"),
+    "trigtime_array": (48, "i"),
+    "ris_time_array": (52, "i"),
+    "res_array1": (56, "i"),
+    "wave_array_1": (60, "i"),
+    "wave_array_count": (116, "i"),
+    "first_valid_pnt": (124, "i"),
+    "last_valid_pnt": (128, "i"),
+    "subarray_count": (144, "i"),
+    "vertical_gain": (156, "f"),
+    "vertical_offset": (160, "f"),
+    "nominal_bits": (172, "h"),
+    "horiz_interval": (176, "f"),
+    "horiz_offset": (180, "d"),
+    "trigger_seconds": (296, "d"),
+    "trigger_minutes": (304, "b"),
+    "trigger_hours": (305, "b"),
+    "trigger_days": (306, "b"),
+    "wave_source": (344, "h"),
+}
+
+INSPECT_JUNK = str.maketrans('"', " ")
+
+
+def parse_samples(text):
+    """
+    Converts a whitespace separated run of ASCII floats in one C call
+    :param text: Section of an INSPECT? reply
+    :return: float array
+    """
+    text = text.translate(INSPECT_JUNK)
+    try:
+        return np.fromstring(text, sep=" ")
+    except ValueError:
+        # Stray non-numeric tokens; drop them like the old per-token parser did
+        samples = []
+        for entry in text.split():
+            try:
+                samples.append(float(entry))
+            except ValueError:
+                pass
+        return np.array(samples)
+
+
+def find_headers(values):
+    """
+    Finds the channel headers of an INSPECT? reply
+    Any space/newline separated token with a colon starts a channel section,
+    e.g. 'C2:INSP'; str.find keeps the scan in C instead of a regex per sample
+    :param values: Raw oscilloscope reply
+    :return: list of (start, end) offsets of the header tokens
+    """
+    headers = []
+    colon = values.find(":")
+    while colon >= 0:
+        start = max(values.rfind(" ", 0, colon), values.rfind("\n", 0, colon)) + 1
+        end = len(values)
+        for separator in (" ", "\n"):
+            separator_idx = values.find(separator, colon)
+            if 0 <= separator_idx < end:
+                end = separator_idx
+        headers.append((start, end))
+        colon = values.find(":", end)
+    return headers
+
+
+def parse_inspect(values):
+    """
+    Splits an INSPECT? SIMPLE reply into per channel sample arrays in one pass
+    :param values: Raw oscilloscope reply for one or more channels
+    :return: list of 4 float arrays, None for channels not in the reply
+    """
+    list_channel_wfms = [None] * 4
+    if values is None:
+        return list_channel_wfms
+
+    headers = find_headers(values)
+    if not headers:
+        list_channel_wfms[-1] = parse_samples(values)
+        return list_channel_wfms
+
+    for idx, (header_start, header_end) in enumerate(headers):
+        end = headers[idx + 1][0] if idx + 1 < len(headers) else len(values)
+        section = values[header_end:end]
+        if not idx and header_start:
+            # Anything before the first header belongs to the first channel
+            section = values[:header_start] + " " + section
+        cur_channel = int(re.sub("[^0-9]", "", values[header_start:header_end])) - 1
+        list_channel_wfms[cur_channel] = parse_samples(section)
+
+    return list_channel_wfms
+
+
+def decode_event(raw, dt=0., channel_descs=None):
+    """
+    Decodes one raw event read back from the scope; safe to run in a worker pool
+    :param raw: INSPECT? reply string, or list of 4 WF? DAT1 replies (None for inactive channels)
+    :param dt: horizontal interval for INSPECT? replies
+    :param channel_descs: list of 4 WAVEDESC dicts for WF? DAT1 replies
+    :return: list of 4 Waveforms, None for missing channels
+    """
+    if isinstance(raw, str):
+        return [Waveform(volts, dt) if volts is not None else None for volts in parse_inspect(raw)]
+    return [Waveform.from_block(parse_block(block), desc) if block is not None else None
+            for block, desc in zip(raw, channel_descs)]
+
+
+def decode_events(raw, dt=0., channel_descs=None, sequence=False):
+    """
+    Decodes one raw readout into events; safe to run in a worker pool
+    :param raw: raw readout, see decode_event; WF? ALL replies in sequence mode
+    :param dt: horizontal interval for INSPECT? replies
+    :param channel_descs: list of 4 WAVEDESC dicts for WF? DAT1 replies
+    :param sequence: True if the readout holds one segment per trigger
+    :return: list of events, each a list of 4 Waveforms
+    """
+    if not sequence:
+        return [decode_event(raw, dt, channel_descs)]
+
+    channel_segments = [decode_sequence(parse_block(block)) if block is not None else None for block in raw]
+    num_segments = max(len(segments) for segments in channel_segments if segments is not None)
+    return [[segments[idx] if segments is not None else None for segments in channel_segments]
+            for idx in range(num_segments)]
+
+
+def decode_sequence(block):
+    """
+    Splits a WF? ALL block of a sequence acquisition into per segment records
+    :param block: Bytes of the WF? ALL data block
+    :return: list of Waveforms carrying their segment trigger time and offset
+    """
+    desc = decode_wavedesc(block)
+    trigtime_start = desc["base"] + desc["wave_descriptor"] + desc["user_text"] + desc["res_desc1"]
+    data_start = trigtime_start + desc["trigtime_array"] + desc["ris_time_array"] + desc["res_array1"]
+
+    # TRIGTIME holds a (trigger time, trigger offset) pair of doubles per segment
+    trigger_times = np.frombuffer(block, dtype=desc["endian"] + "f8",
+                                  count=desc["trigtime_array"] // 8, offset=trigtime_start).reshape(-1, 2)
+    num_segments = max(len(trigger_times), 1)
+    codes = np.frombuffer(block, dtype=desc["dtype"], count=desc["wave_array_1"] // desc["dtype"].itemsize,
+                          offset=data_start).reshape(num_segments, -1)
+
+    segments = []
+    for idx in range(num_segments):
+        wfm = Waveform(codes=codes[idx], dt=desc["horiz_interval"], gain=desc["vertical_gain"],
+                       offset=desc["vertical_offset"], horiz_offset=desc["horiz_offset"])
+        wfm.timestamp = desc["timestamp"]
+        if len(trigger_times):
+            wfm.trigger_time, wfm.trigger_offset = trigger_times[idx]
+            wfm.timestamp += wfm.trigger_time
+        segments.append(wfm)
+    return segments
+
+
+def encode_wavedesc(**fields):
+    """
+    Builds a little endian LECROY_2_3 WAVEDESC block, the inverse of decode_wavedesc
+    :param fields: WAVEDESC_FIELDS values to set, unset fields are zero apart from the 16 bit word format
+    :return: bytes of the descriptor
+    """
+    desc = bytearray(346)
+    desc[0:8] = b"WAVEDESC"
+    desc[16:26] = b"LECROY_2_3"
+    values = {"comm_type": 1, "comm_order": 1, "wave_descriptor": len(desc)}
+    values.update(fields)
+    for name, value in values.items():
+        offset, fmt = WAVEDESC_FIELDS[name]
+        pack_into("<" + fmt, desc, offset, value)
+    return bytes(desc)
+
+
+def parse_block(raw):
+    """
+    Strips the IEEE 488.2 definite length header (#9nnnnnnnnn) from a reply
+    :param raw: Raw bytes read back from the scope
+    :return: memoryview of the data block
+    """
+    start = raw.find(b"#")
+    if start < 0:
+        raise ValueError("No data block in scope reply")
+    num_digits = int(raw[start + 1:start + 2])
+    length = int(raw[start + 2:start + 2 + num_digits])
+    data_start = start + 2 + num_digits
+    return memoryview(raw)[data_start:data_start + length]
+
+
+def decode_wavedesc(block):
+    """
+    Decodes the WAVEDESC block returned by WF? DESC
+    :param block: Bytes containing the descriptor, at the start of a WF? block
+    :return: dict of descriptor fields
+    """
+    base = bytes(block[:64]).find(b"WAVEDESC")
+    if base < 0:
+        raise ValueError("No WAVEDESC in scope reply")
+
+    # COMM_ORDER is 0 for big endian (HIFIRST) and 1 for little endian (LOFIRST)
+    endian = "<" if unpack_from("<h", block, base + 34)[0] == 1 else ">"
+
+    desc = {}
+    for name, (offset, fmt) in WAVEDESC_FIELDS.items():
+        desc[name] = unpack_from(endian + fmt, block, base + offset)[0]
+    # Trigger time stamp of the acquisition, in s since the start of the month
+    desc["timestamp"] = ((desc["trigger_days"] * 24 + desc["trigger_hours"]) * 60 + desc["trigger_minutes"]) * 60 \
+        + desc["trigger_seconds"]
+    desc["base"] = base
+    desc["endian"] = endian
+    desc["dtype"] = np.dtype(endian + ("i2" if desc["comm_type"] else "i1"))
+    return desc
+
+
+def time_axis(num_samples, dt, horiz_offset=0.):
+    """
+    Regenerates the time axis of a record stored without time vectors
+    :param num_samples: record length
+    :param dt: horizontal interval in s
+    :param horiz_offset: time of the first sample
+    :return: float array
+    """
+    return horiz_offset + dt * np.arange(num_samples)
+
+
+def estimate_scale(volts):
+    """
+    Recovers the ADC step and offset from samples that were sent as volts
+    Scope samples are code * gain - offset, so the smallest step between
+    distinct values is the effective gain. A flat record gives no step, it
+    gets a unit gain with its value at code 0
+    :param volts: float array of samples
+    :return: tuple (gain, offset)
+    """
+    steps = np.diff(np.unique(volts))
+    if not len(steps) or steps[0] <= 0:
+        return 1., -float(volts[0]) if len(volts) else 0.
+    gain = float(steps.min())
+    offset = float(np.rint(volts[0] / gain) * gain - volts[0])
+    return gain, offset
+
+
+def quantize(volts, gain, offset):
+    """
+    Converts volts to int16 ADC codes, clipping at the int16 range
+    :param volts: float array of samples
+    :param gain: vertical gain in V/code
+    :param offset: vertical offset in V
+    :return: int16 array
+    """
+    codes = np.rint((volts + offset) / gain)
+    return np.clip(codes, -32768, 32767).astype(np.int16)
+
+
+class Waveform(object):
+    """
+    Single channel record, kept as raw ADC codes when the scope sent them
+    """
+
+    def __init__(self, volts=None, dt=0., codes=None, gain=1., offset=0., horiz_offset=0., times=None):
+        """
+        Constructor for a channel record
+        :param volts: float array of voltage samples
+        :param dt: horizontal interval in s
+        :param codes: integer ADC codes, used when volts is not given
+        :param gain: vertical gain in V/code
+        :param offset: vertical offset in V
+        :param horiz_offset: time of the first sample relative to the trigger
+        :param times: explicit time axis, for records that came with one
+        """
+        self.trigger_time = 0.
+        self.trigger_offset = 0.
+        # Scope trigger time stamp in s, None when the readout carried no descriptor
+        self.timestamp = None
+        # Index of the first sample in the full scope record, non zero for windowed records
+        self.start_index = 0
+        self._volts = volts
+        self.dt = dt
+        self.codes = codes
+        self.gain = gain
+        self.offset = offset
+        self.horiz_offset = horiz_offset
+        self.explicit_times = times
+
+    @classmethod
+    def from_block(cls, block, desc):
+        """
+        Builds a waveform from a WF? DAT1 data block without copying it
+        :param block: Bytes of the data array
+        :param desc: Decoded WAVEDESC of the channel
+        :return: Waveform
+        """
+        codes = np.frombuffer(block, dtype=desc["dtype"])
+        return cls(codes=codes, dt=desc["horiz_interval"], gain=desc["vertical_gain"],
+                   offset=desc["vertical_offset"], horiz_offset=desc["horiz_offset"])
+
+    @property
+    def volts(self):
+        if self._volts is None:
+            self._volts = self.codes * self.gain - self.offset
+        return self._volts
+
+    def times(self):
+        """
+        Time axis of the record, counted from the first sample of the full scope record
+        :return: float array
+        """
+        if self.explicit_times is not None:
+            return self.explicit_times
+        return time_axis(len(self), self.dt, self.start_index * self.dt)
+
+    def window(self, start, stop):
+        """
+        Slice of the record, sharing its sample buffers
+        :param start: first sample index, relative to this record
+        :param stop: index after the last sample
+        :return: Waveform with start_index set
+        """
+        wfm = Waveform(None if self._volts is None else self._volts[start:stop], self.dt,
+                       None if self.codes is None else self.codes[start:stop], self.gain, self.offset,
+                       self.horiz_offset, None if self.explicit_times is None else self.explicit_times[start:stop])
+        wfm.trigger_time = self.trigger_time
+        wfm.trigger_offset = self.trigger_offset
+        wfm.timestamp = self.timestamp
+        wfm.start_index = self.start_index + start
+        return wfm
+
+    def __len__(self):
+        if self._volts is None:
+            return len(self.codes)
+        return len(self._volts)
@@ -0,0 +1,628 @@
+__author__ = "Ric Rodriguez"
+__email__ = "therickyross2@gmail.com"
+__project__ = "Thorium DAQ"
+
+import json
+import os
+from struct import pack
+
+import numpy as np
+
+from eventlog import EVENT_DTYPE
+from waveform import estimate_scale, quantize
+
+# ROOT compression algorithm codes, the file setting is 100 * algorithm + level
+COMPRESSION_ALGORITHMS = {"none": 0, "zlib": 1, "lzma": 2, "lz4": 4, "zstd": 5}
+# Flat records a compact writer holds back per channel before fixing its scale from them alone
+MAX_HELD_RECORDS = 256
+
+
+def check_compression(compression, compression_level):
+    """
+    Validates compression settings shared by the backends
+    :param compression: none, zlib, lzma, lz4, zstd, or None for the backend default
+    :param compression_level: 1-9, None for the algorithm default
+    :return: None
+    """
+    if compression is not None and compression not in COMPRESSION_ALGORITHMS:
+        raise ValueError("Unknown compression {}".format(compression))
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        raise ValueError("Compression level {} outside 0-9".format(compression_level))
+
+
+class RootWriter(object):
+    """
+    Streams events into the wfm tree straight from numpy buffers
+    """
+
+    def __init__(self, filename, channels, record_length=1024, schema="compact", windowed=False, compression=None,
+                 compression_level=None, basket_size=None, auto_flush=None):
+        """
+        Opens the output file and books the w1..w4 branches, w5.. for further scopes
+        :param filename: ROOT file to create
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param record_length: initial buffer size in samples, grown as needed
+        :param schema: "compact" stores dt and horizontal offset per channel as
+                       scalars, "legacy" also stores the full t1..t4 time vectors
+        :param windowed: also store start1..start4, the index of the first sample of ROI windowed records
+        :param compression: none, zlib, lzma, lz4 or zstd, None for the ROOT default
+        :param compression_level: 1-9, None for 4, or 1 with zlib
+        :param basket_size: branch buffer size in bytes, None for the ROOT default
+        :param auto_flush: events between basket flushes and tree header saves, so a crash
+                           loses at most this many events, None for the ROOT default
+        """
+        # Imported here so the npy and hdf5 backends start without ROOT
+        import ROOT
+
+        if schema not in ("compact", "legacy"):
+            raise ValueError("Unknown tree schema {}".format(schema))
+        check_compression(compression, compression_level)
+        if compression is None:
+            self.tree_file = ROOT.TFile(filename, "recreate")
+        else:
+            if compression_level is None:
+                compression_level = 1 if compression == "zlib" else 4
+            settings = 0 if compression == "none" else 100 * COMPRESSION_ALGORITHMS[compression] + compression_level
+            self.tree_file = ROOT.TFile(filename, "recreate", "", settings)
+        self.basket_size = basket_size
+        self.auto_flush = auto_flush
+        self.tree = ROOT.TTree("wfm", "tree with events/wfms")
+        self.channels = channels
+        self.legacy = schema == "legacy"
+        self.windowed = windowed
+        self.capacity = record_length
+        self.sample_index = np.arange(record_length, dtype=np.float64)
+        self.counts = [None] * len(channels)
+        self.voltages = [None] * len(channels)
+        self.times = [None] * len(channels)
+        self.intervals = [None] * len(channels)
+        self.horiz_offsets = [None] * len(channels)
+        self.start_indices = [None] * len(channels)
+        self.trigger_time = np.zeros(1, dtype=np.float64)
+        self.trigger_offset = np.zeros(1, dtype=np.float64)
+        self.event_values = {name: np.zeros(1, dtype=EVENT_DTYPE[name]) for name in EVENT_DTYPE.names}
+        self.num_events = 0
+        self.summary_tree = None
+        self.summary_values = {}
+        self.tree.Branch("trig_time", self.trigger_time, "trig_time/D")
+        self.tree.Branch("trig_offset", self.trigger_offset, "trig_offset/D")
+        # event/L, host_time/D and point/I
+        leaf_types = {"i8": "L", "f8": "D", "i4": "I"}
+        for name in EVENT_DTYPE.names:
+            self.tree.Branch(name, self.event_values[name], "{}/{}".format(name, leaf_types[EVENT_DTYPE[name].str[1:]]))
+
+        for channel_idx, active_channel in enumerate(self.channels):
+            if not active_channel:
+                continue
+            channel_number = channel_idx + 1
+            self.counts[channel_idx] = np.zeros(1, dtype=np.int32)
+            self.voltages[channel_idx] = np.zeros(record_length, dtype=np.float64)
+            self.intervals[channel_idx] = np.zeros(1, dtype=np.float64)
+            self.horiz_offsets[channel_idx] = np.zeros(1, dtype=np.float64)
+            self.tree.Branch("n{}".format(channel_number), self.counts[channel_idx],
+                             "n{}/I".format(channel_number))
+            self.tree.Branch("w{}".format(channel_number), self.voltages[channel_idx],
+                             "w{0}[n{0}]/D".format(channel_number))
+            self.tree.Branch("dt{}".format(channel_number), self.intervals[channel_idx],
+                             "dt{}/D".format(channel_number))
+            self.tree.Branch("hoff{}".format(channel_number), self.horiz_offsets[channel_idx],
+                             "hoff{}/D".format(channel_number))
+            if self.windowed:
+                self.start_indices[channel_idx] = np.zeros(1, dtype=np.int32)
+                self.tree.Branch("start{}".format(channel_number), self.start_indices[channel_idx],
+                                 "start{}/I".format(channel_number))
+            if self.legacy:
+                self.times[channel_idx] = np.zeros(record_length, dtype=np.float64)
+                self.tree.Branch("t{}".format(channel_number), self.times[channel_idx],
+                                 "t{0}[n{0}]/D".format(channel_number))
+            elif self.windowed:
+                self.tree.SetAlias("t{}".format(channel_number), "hoff{0}+(start{0}+Iteration$)*dt{0}".format(channel_number))
+            else:
+                # Keeps TTree::Draw("w2:t2") style macros working without stored times, the alias has no array
+                # leaf of its own and only runs over the samples next to w2
+                self.tree.SetAlias("t{}".format(channel_number), "hoff{0}+Iteration$*dt{0}".format(channel_number))
+        self.apply_flush_policy(self.tree)
+
+    def apply_flush_policy(self, tree):
+        """
+        Sets the configured basket size and flush interval of a tree
+        :param tree: TTree with its branches booked
+        :return: None
+        """
+        if self.basket_size:
+            tree.SetBasketSize("*", self.basket_size)
+        if self.auto_flush:
+            tree.SetAutoFlush(self.auto_flush)
+            # A positive auto save counts entries, the header written with it makes the data recoverable
+            tree.SetAutoSave(self.auto_flush)
+
+    def grow(self, record_length):
+        """
+        Reallocates the branch buffers for longer records
+        :param record_length: new buffer size in samples
+        :return: None
+        """
+        self.capacity = record_length
+        self.sample_index = np.arange(record_length, dtype=np.float64)
+        for channel_idx, active_channel in enumerate(self.channels):
+            if not active_channel:
+                continue
+            channel_number = channel_idx + 1
+            self.voltages[channel_idx] = np.zeros(record_length, dtype=np.float64)
+            self.tree.SetBranchAddress("w{}".format(channel_number), self.voltages[channel_idx])
+            if self.legacy:
+                self.times[channel_idx] = np.zeros(record_length, dtype=np.float64)
+                self.tree.SetBranchAddress("t{}".format(channel_number), self.times[channel_idx])
+
+    def fill(self, event, event_info=None):
+        """
+        Copies one event into the branch buffers and fills the tree
+        :param event: list of Waveforms, 4 per scope, None for missing channels
+        :param event_info: EVENT_DTYPE row of the event, None to number events as they come
+        :return: None
+        """
+        if event_info is None:
+            event_info = (self.num_events, 0., 0)
+        for name, value in zip(EVENT_DTYPE.names, event_info):
+            self.event_values[name][0] = value
+        self.num_events += 1
+        self.trigger_time[0] = 0.
+        self.trigger_offset[0] = 0.
+        # Grown before any copy, growing replaces the buffers of every channel
+        record_length = max([len(wfm) for wfm, active_channel in zip(event, self.channels)
+                             if active_channel and wfm is not None] + [0])
+        if record_length > self.capacity:
+            self.grow(record_length)
+        for channel_idx, active_channel in enumerate(self.channels):
+            if not active_channel:
+                continue
+            wfm = event[channel_idx]
+            num_samples = len(wfm) if wfm is not None else 0
+            self.counts[channel_idx][0] = num_samples
+            if not num_samples:
+                continue
+            # Segments of one sequence share their trigger time across channels
+            self.trigger_time[0] = wfm.trigger_time
+            self.trigger_offset[0] = wfm.trigger_offset
+            self.intervals[channel_idx][0] = wfm.dt
+            self.horiz_offsets[channel_idx][0] = wfm.horiz_offset
+            self.voltages[channel_idx][:num_samples] = wfm.volts
+            if self.windowed:
+                self.start_indices[channel_idx][0] = wfm.start_index
+            if not self.legacy:
+                continue
+            if wfm.explicit_times is not None:
+                self.times[channel_idx][:num_samples] = wfm.explicit_times
+            else:
+                np.add(self.sample_index[:num_samples], wfm.start_index, out=self.times[channel_idx][:num_samples])
+                self.times[channel_idx][:num_samples] *= wfm.dt
+                self.times[channel_idx][:num_samples] += wfm.horiz_offset
+
+        self.tree.Fill()
+
+    def fill_summary(self, features):
+        """
+        Fills one event of the summary tree, booked on the first call
+        The tree is a friend of wfm, so its branches can be drawn next to the waveforms
+        :param features: dict of feature name to value
+        :return: None
+        """
+        if self.summary_tree is None:
+            import ROOT
+
+            self.tree_file.cd()
+            self.summary_tree = ROOT.TTree("summary", "per event waveform features")
+            for name in features:
+                self.summary_values[name] = np.zeros(1, dtype=np.float64)
+                self.summary_tree.Branch(name, self.summary_values[name], "{}/D".format(name))
+            self.apply_flush_policy(self.summary_tree)
+            self.tree.AddFriend(self.summary_tree)
+        for name, value in features.items():
+            self.summary_values[name][0] = value
+        self.summary_tree.Fill()
+
+    def close(self):
+        """
+        Writes the tree and closes the file
+        """
+        self.tree_file.Write()
+        self.tree_file.Close()
+
+
+class CompactWriter(object):
+    """
+    Base for backends storing int16 ADC codes with per channel scale factors
+    """
+
+    def __init__(self, channels, windowed=False, auto_flush=None):
+        """
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param windowed: also store start1..start4, the index of the first sample of ROI windowed records
+        :param auto_flush: events between flushes to disk, None to flush on close only
+        """
+        self.channels = channels
+        self.windowed = windowed
+        self.auto_flush = auto_flush
+        self.scales = [None] * len(channels)
+        self.held_records = [[] for _ in channels]
+        self.num_events = 0
+        self.summary_dtype = None
+
+    def append_record(self, channel_idx, wfm):
+        """
+        Appends the codes of a channel record
+        The scale of a channel is fixed by its first record sent as raw codes,
+        or with at least two distinct values. Flat records ahead of it tell
+        nothing of the ADC step and are held back until then
+        :param channel_idx: 0-3 channel index
+        :param wfm: Waveform, None for a missing record
+        :return: None
+        """
+        held = self.held_records[channel_idx]
+        if self.scales[channel_idx] is None and (wfm is not None or held):
+            held.append(wfm)
+            if wfm is not None and (wfm.codes is not None or len(np.unique(wfm.volts)) > 1):
+                self.fix_scale(channel_idx, wfm)
+            elif len(held) >= MAX_HELD_RECORDS:
+                self.fix_scale(channel_idx)
+            return
+        self.append_row("w{}".format(channel_idx + 1), None if wfm is None else self.channel_codes(channel_idx, wfm))
+
+    def fix_scale(self, channel_idx, wfm=None):
+        """
+        Sets the scale of a channel and appends its held back records
+        :param channel_idx: 0-3 channel index
+        :param wfm: Waveform to take the scale from, None to estimate it from the held records
+        :return: None
+        """
+        records = [held_wfm for held_wfm in self.held_records[channel_idx] if held_wfm is not None]
+        if wfm is None:
+            volts = np.concatenate([held_wfm.volts for held_wfm in records])
+            if len(np.unique(volts)) < 2:
+                print("Channel {} records are flat at {} V, storing them with a unit gain".format(channel_idx + 1,
+                                                                                                 volts[0]))
+            gain, offset = estimate_scale(volts)
+        elif wfm.codes is not None:
+            gain, offset = wfm.gain, wfm.offset
+        else:
+            gain, offset = estimate_scale(wfm.volts)
+        self.scales[channel_idx] = {"gain": gain, "offset": offset, "dt": records[0].dt,
+                                    "horiz_offset": records[0].horiz_offset}
+        for held_wfm in self.held_records[channel_idx]:
+            self.append_row("w{}".format(channel_idx + 1),
+                            None if held_wfm is None else self.channel_codes(channel_idx, held_wfm))
+        self.held_records[channel_idx] = []
+
+    def release_held_records(self):
+        """
+        Fixes the scale of channels still holding back flat records, so a flush writes every event
+        :return: None
+        """
+        for channel_idx, held in enumerate(self.held_records):
+            if held:
+                self.fix_scale(channel_idx)
+
+    def channel_codes(self, channel_idx, wfm):
+        """
+        Gets the int16 codes of a channel record
+        Records sent as raw codes with the channel's scale are stored without conversion
+        :param channel_idx: 0-3 channel index
+        :param wfm: Waveform
+        :return: int16 array
+        """
+        scale = self.scales[channel_idx]
+        if wfm.codes is not None and wfm.gain == scale["gain"] and wfm.offset == scale["offset"]:
+            return wfm.codes.astype(np.int16, copy=False)
+        return quantize(wfm.volts, scale["gain"], scale["offset"])
+
+    def fill(self, event, event_info=None):
+        """
+        Appends one event
+        :param event: list of Waveforms, 4 per scope, None for missing channels
+        :param event_info: EVENT_DTYPE row of the event, None to number events as they come
+        :return: None
+        """
+        trigger_time = 0.
+        trigger_offset = 0.
+        for channel_idx, active_channel in enumerate(self.channels):
+            if not active_channel:
+                continue
+            wfm = event[channel_idx]
+            if wfm is None or not len(wfm):
+                # Keep rows aligned across channels, a missing record reads back as zeros
+                self.append_record(channel_idx, None)
+                if self.windowed:
+                    self.append_row("start{}".format(channel_idx + 1), np.int32(0))
+                continue
+            trigger_time = wfm.trigger_time
+            trigger_offset = wfm.trigger_offset
+            self.append_record(channel_idx, wfm)
+            if self.windowed:
+                self.append_row("start{}".format(channel_idx + 1), np.int32(wfm.start_index))
+
+        self.append_row("trig_time", np.float64(trigger_time))
+        self.append_row("trig_offset", np.float64(trigger_offset))
+        if event_info is None:
+            event_info = np.array((self.num_events, 0., 0), dtype=EVENT_DTYPE)
+        self.append_row("event_info", np.asarray(event_info, dtype=EVENT_DTYPE))
+        self.num_events += 1
+        if self.auto_flush and not self.num_events % self.auto_flush:
+            self.flush()
+
+    def fill_summary(self, features):
+        """
+        Appends one event of features as a row of the structured summary array
+        :param features: dict of feature name to value
+        :return: None
+        """
+        if self.summary_dtype is None:
+            self.summary_dtype = np.dtype([(name, np.float64) for name in features])
+        self.append_row("summary", np.array(tuple(features.values()), dtype=self.summary_dtype))
+
+    def metadata(self):
+        """
+        Scale factors needed to turn the stored codes back into volts
+        volts = code * gain - offset, time = horiz_offset + dt * (start + index)
+        with start the stored window start of ROI windowed records, 0 otherwise
+        :return: dict
+        """
+        return {
+            "events": self.num_events,
+            "channels": {"w{}".format(channel_idx + 1): scale
+                         for channel_idx, scale in enumerate(self.scales) if scale is not None},
+        }
+
+
+class NpyStream(object):
+    """
+    Appends rows to a .npy file, patching the row count into the header on close
+    """
+
+    def __init__(self, filename, dtype, row_shape):
+        """
+        :param filename: .npy file to create
+        :param dtype: numpy dtype of the rows
+        :param row_shape: shape of a single row
+        """
+        self.file = open(filename, "wb")
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        # Room for any row count, rounded up to the 64 byte alignment numpy uses
+        self.header_size = max(256, (len(self.header_text(10 ** 15)) + 11 + 63) // 64 * 64)
+        self.write_header()
+
+    def header_text(self, rows):
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), (rows,) + self.row_shape)
+
+    def write_header(self):
+        # Fixed size v1.0 header, so the shape can be rewritten in place
+        header = self.header_text(self.rows).ljust(self.header_size - 11) + "\n"
+        self.file.write(b"\x93NUMPY\x01\x00" + pack("<H", len(header)) + header.encode("latin1"))
+
+    def append(self, row):
+        if row is None:
+            row = np.zeros(self.row_shape, dtype=self.dtype)
+        elif np.shape(row) != self.row_shape:
+            raise ValueError("Record length changed from {} to {}".format(self.row_shape, np.shape(row)))
+        np.asarray(row, dtype=self.dtype).tofile(self.file)
+        self.rows += 1
+
+    def flush(self):
+        """
+        Writes out buffered rows and the current row count, leaving a readable file
+        """
+        self.file.seek(0)
+        self.write_header()
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        self.file.seek(0)
+        self.write_header()
+        self.file.close()
+
+
+class NpyWriter(CompactWriter):
+    """
+    Directory of memory-mappable .npy arrays, one per channel, plus meta.json
+    Arrays stay uncompressed so they can be memory mapped
+    """
+
+    def __init__(self, filename, channels, record_length=1024, windowed=False, auto_flush=None, compression=None,
+                 compression_level=None, **root_options):
+        """
+        :param filename: output directory
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param record_length: unused, rows are sized from the first record
+        :param windowed: also store the window start of ROI windowed records
+        :param auto_flush: events between flushes of the arrays and meta.json
+        :param compression: only none is supported
+        :param compression_level: unused
+        :param root_options: options of the ROOT backend, not used here
+        """
+        if compression not in (None, "none"):
+            raise ValueError("The npy backend stores uncompressed arrays, not {}".format(compression))
+        CompactWriter.__init__(self, channels, windowed, auto_flush)
+        self.directory = filename
+        os.makedirs(self.directory, exist_ok=True)
+        self.streams = {}
+        self.pending_rows = {}
+
+    def append_row(self, name, row):
+        if name not in self.streams:
+            if row is None:
+                # Wait for the first real record to size the array
+                self.pending_rows[name] = self.pending_rows.get(name, 0) + 1
+                return
+            self.streams[name] = NpyStream(os.path.join(self.directory, name + ".npy"),
+                                           row.dtype, np.shape(row))
+            for _ in range(self.pending_rows.pop(name, 0)):
+                self.streams[name].append(None)
+        self.streams[name].append(row)
+
+    def write_metadata(self):
+        with open(os.path.join(self.directory, "meta.json"), "w") as meta_file:
+            json.dump(self.metadata(), meta_file, indent=2)
+
+    def flush(self):
+        self.release_held_records()
+        for stream in self.streams.values():
+            stream.flush()
+        self.write_metadata()
+
+    def close(self):
+        self.release_held_records()
+        for stream in self.streams.values():
+            stream.close()
+        self.write_metadata()
+
+
+class Hdf5Writer(CompactWriter):
+    """
+    HDF5 file with chunked int16 datasets and scale factors as attributes
+    """
+
+    def __init__(self, filename, channels, record_length=1024, chunk_events=64, windowed=False, compression=None,
+                 compression_level=None, auto_flush=None, **root_options):
+        """
+        :param filename: .h5 file to create
+        :param channels: list of booleans, 4 per scope, True for active channels
+        :param record_length: unused, rows are sized from the first record
+        :param chunk_events: events per HDF5 chunk
+        :param windowed: also store the window start of ROI windowed records
+        :param compression: none or zlib, lz4 and zstd with the hdf5plugin package, else gzip, None for none
+        :param compression_level: 1-9, None for the filter default
+        :param auto_flush: events between flushes to disk, None to flush on close only, rounded up to whole chunks
+        :param root_options: options of the ROOT backend, not used here
+        """
+        import h5py
+
+        check_compression(compression, compression_level)
+        if auto_flush and auto_flush % chunk_events:
+            # A flush writes the partial chunk, which the next rows would rewrite and compress again
+            rounded = (auto_flush // chunk_events + 1) * chunk_events
+            print("Flushing hdf5 output every {} events, whole chunks of {}".format(rounded, chunk_events))
+            auto_flush = rounded
+        CompactWriter.__init__(self, channels, windowed, auto_flush)
+        self.dataset_options = {}
+        if compression in ("lz4", "zstd"):
+            try:
+                import hdf5plugin
+            except ImportError:
+                print("hdf5plugin is not installed, compressing with gzip instead of {}".format(compression))
+                compression, compression_level = "zlib", None
+        if compression == "zlib":
+            self.dataset_options = {"compression": "gzip", "compression_opts": compression_level or 4}
+        elif compression in ("lz4", "zstd"):
+            if compression == "lz4":
+                self.dataset_options = dict(hdf5plugin.LZ4())
+            else:
+                self.dataset_options = dict(hdf5plugin.Zstd(clevel=compression_level or 3))
+        elif compression not in (None, "none"):
+            raise ValueError("The hdf5 backend does not support {} compression".format(compression))
+        self.h5_file = h5py.File(filename, "w")
+        self.chunk_events = chunk_events
+        self.pending_rows = {}
+        self.row_buffers = {}
+        self.buffered_rows = {}
+
+    def append_row(self, name, row):
+        if name not in self.row_buffers:
+            if row is None:
+                self.pending_rows[name] = self.pending_rows.get(name, 0) + 1
+                return
+            row_shape = np.shape(row)
+            self.h5_file.create_dataset(name, shape=(self.pending_rows.pop(name, 0),) + row_shape,
+                                        maxshape=(None,) + row_shape, dtype=row.dtype,
+                                        chunks=(self.chunk_events,) + row_shape, **self.dataset_options)
+            # Rows are collected and written a chunk at a time, so every chunk is compressed once
+            self.row_buffers[name] = np.zeros((self.chunk_events,) + row_shape, dtype=row.dtype)
+            self.buffered_rows[name] = 0
+        rows = self.row_buffers[name]
+        if row is not None and np.shape(row) != rows.shape[1:]:
+            raise ValueError("Record length changed from {} to {}".format(rows.shape[1:], np.shape(row)))
+        if row is None:
+            rows[self.buffered_rows[name]] = np.zeros((), dtype=rows.dtype)
+        else:
+            rows[self.buffered_rows[name]] = row
+        self.buffered_rows[name] += 1
+        if self.buffered_rows[name] == self.chunk_events:
+            self.write_rows(name)
+
+    def write_rows(self, name):
+        """
+        Appends the buffered rows of one dataset to the file
+        :param name: dataset name
+        :return: None
+        """
+        num_rows = self.buffered_rows[name]
+        if not num_rows:
+            return
+        dataset = self.h5_file[name]
+        dataset.resize(dataset.shape[0] + num_rows, axis=0)
+        dataset[-num_rows:] = self.row_buffers[name][:num_rows]
+        self.buffered_rows[name] = 0
+
+    def write_metadata(self):
+        for name in self.row_buffers:
+            self.write_rows(name)
+        metadata = self.metadata()
+        self.h5_file.attrs["events"] = metadata["events"]
+        for name, scale in metadata["channels"].items():
+            if name not in self.h5_file:
+                continue
+            for key, value in scale.items():
+                self.h5_file[name].attrs[key] = value
+
+    def flush(self):
+        self.release_held_records()
+        self.write_metadata()
+        self.h5_file.flush()
+
+    def close(self):
+        self.release_held_records()
+        self.write_metadata()
+        self.h5_file.close()
+
+
+# Writer class and file extension for each [daq] backend setting
+WRITER_BACKENDS = {
+    "root": (RootWriter, ".root"),
+    "npy": (NpyWriter, ""),
+    "hdf5": (Hdf5Writer, ".h5"),
+}
+
+
+def open_writer(backend, base_filename, channels, record_length=1024, **options):
+    """
+    Opens an output file for the configured backend
+    :param backend: root, npy or hdf5
+    :param base_filename: output name without extension
+    :param channels: list of booleans, 4 per scope, True for active channels
+    :param record_length: expected samples per record
+    :param options: backend options, e.g. schema for the ROOT tree layout or windowed for ROI records
+    :return: writer with fill(event, event_info), fill_summary(features) and close()
+    """
+    if backend not in WRITER_BACKENDS:
+        raise ValueError("Unknown output backend {}".format(backend))
+    writer_class, extension = WRITER_BACKENDS[backend]
+    return writer_class(base_filename + extension, channels, record_length, **options)
+
+
+def load_backend(backend):
+    """
+    Imports the library of a backend ahead of its first file, a long running
+    process then pays the import, seconds for ROOT, once at startup
+    :param backend: root, npy or hdf5
+    :return: None
+    """
+    if backend not in WRITER_BACKENDS:
+        raise ValueError("Unknown output backend {}".format(backend))
+    if backend == "root":
+        import ROOT
+
+        ROOT.TFile
+    elif backend == "hdf5":
+        import h5py